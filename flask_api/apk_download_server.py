@@ -0,0 +1,218 @@
+import email.utils
+import logging
+import os
+import sys
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPES = {'.apk': 'application/vnd.android.package-archive', '.json': 'application/json'}
+
+
+def parse_range(header, size):
+    """Returns (start, end) inclusive for a single "bytes=" range, None to send the whole file,
+    or raises ValueError if the range can't be satisfied."""
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None  # Absent, another unit, or several ranges: a full 200 is always allowed
+    start, _, end = header[len('bytes='):].strip().partition('-')
+    try:
+        if not start:
+            length = int(end)  # "bytes=-N" is the last N bytes
+            if length <= 0 or not size:
+                return None
+            return max(size - length, 0), size - 1
+        start = int(start)
+        end = int(end) if end else size - 1
+    except ValueError:
+        return None  # Malformed ranges are ignored, as RFC 9110 allows
+    if start >= size or end < start:
+        raise ValueError(header)
+    return start, min(end, size - 1)
+
+
+class ApkRequestHandler(BaseHTTPRequestHandler):
+    """GET/HEAD for the files directly inside server.directory, with ETag, Range and sendfile."""
+
+    protocol_version = 'HTTP/1.1'  # Keep-alive, so a resuming phone doesn't reconnect per range
+    timeout = 30  # Seconds an idle keep-alive or stalled connection keeps its thread
+
+    def do_HEAD(self):
+        self.send_limited(head=True)
+
+    def do_GET(self):
+        self.send_limited(head=False)
+
+    def send_limited(self, head):
+        # A slot is held per request, not per connection, so an idle keep-alive connection holds none.
+        # The wait happens on this connection's own thread, never on the server's accept loop.
+        if not self.server.acquire_slot(self.client_address):
+            self.send_response(503)
+            self.send_header('Retry-After', str(self.server.retry_after))
+            self.send_header('Content-Length', '0')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.close_connection = True
+            return
+        try:
+            self.send_apk(head)
+        finally:
+            self.server.release_slot()
+
+    def send_apk(self, head):
+        url = urllib.parse.urlsplit(self.path)
+        name = urllib.parse.unquote(url.path).lstrip('/')
+        if name == 'patch':
+            self.send_patch(urllib.parse.parse_qs(url.query).get('from', [None])[0], head)
+            return
+        if not name or '/' in name or name.startswith('.'):
+            self.send_error(404)
+            return
+        content_type = CONTENT_TYPES.get(os.path.splitext(name)[1], 'application/octet-stream')
+        self.send_path(self.server.resolve(name), content_type, head)
+
+    def send_patch(self, from_version, head):
+        """Sends the patch from from_version to the published APK, or redirects to the full APK."""
+        if not from_version:
+            self.send_error(400, "Missing from=<version>")
+            return
+        patches = self.server.patches
+        patch = patches['patches'].get(from_version) if patches else None
+        if patch is None:
+            # Unknown, too old or not worth patching: the full APK always works
+            self.send_response(302)
+            self.send_header('Location', f"/{patches['apk'] if patches else 'RRHE.apk'}")
+            if patches:
+                self.send_header('X-Target-SHA256', patches['sha256'])
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_path(patch['path'], 'application/octet-stream', head, {
+            'X-Patch-From': from_version,
+            'X-Patch-To': patches['version'],
+            'X-Patch-SHA256': patch['sha256'],
+            'X-Source-SHA256': patch['from_sha256'],
+            'X-Target-SHA256': patches['sha256'],
+        })
+
+    def send_path(self, path, content_type, head, extra_headers=None):
+        try:
+            file = open(path, 'rb')
+        except (FileNotFoundError, IsADirectoryError):
+            self.send_error(404)
+            return
+
+        with file:
+            # Stat the open file, so headers describe the bytes sent even if a new release replaces it meanwhile
+            stat = os.fstat(file.fileno())
+            size = stat.st_size
+            etag = f'"{stat.st_ino:x}-{size:x}-{stat.st_mtime_ns:x}"'
+
+            if etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+
+            if_range = self.headers.get('If-Range')
+            try:
+                # A resumed download of an older release must start over rather than splice two versions
+                byte_range = parse_range(self.headers.get('Range'), size) if if_range in (None, etag) else None
+            except ValueError:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            if byte_range is None:
+                start, end = 0, size - 1
+                self.send_response(200)
+            else:
+                start, end = byte_range
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+            length = end - start + 1 if size else 0
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(length))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', email.utils.formatdate(stat.st_mtime, usegmt=True))
+            self.send_header('Cache-Control', 'no-cache')  # Same URL for every release, so always revalidate
+            for header, value in (extra_headers or {}).items():
+                self.send_header(header, value)
+            self.end_headers()
+            if head or not length:
+                return
+            self.wfile.flush()
+            # os.sendfile where the platform has it: the kernel copies page cache to the socket
+            self.connection.sendfile(file, start, length)
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+class ApkDownloadServer(ThreadingHTTPServer):
+    """Threaded file server for release downloads, with at most max_connections requests served at once.
+
+    A request over the cap waits on its own thread up to queue_timeout seconds for a slot and is then
+    answered 503 with Retry-After, which Android's DownloadManager honours by retrying later.
+
+    publish() points a name at another file while the server keeps running: requests after it get
+    the new file, while downloads already under way keep reading the one they opened.
+    publish_patches() does the same for the patches /patch?from=<version> serves.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 128  # Room in the listen backlog for everyone a release notification reaches
+
+    def __init__(self, address, directory, max_connections, queue_timeout=5, retry_after=10):
+        self.directory = directory
+        self.max_connections = max_connections
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._published = {}  # Name -> path; replaced whole, so a request sees either the old or new mapping
+        self.patches = None  # apk_patches manifest of the published APK, with absolute patch paths
+        super().__init__(address, ApkRequestHandler)
+
+    def publish(self, name, path):
+        self._published = {**self._published, name: path}
+        logger.info(f"Publishing {path} as /{name}")
+
+    def unpublish(self, name):
+        """Stops serving name's published file; name then falls back to the file in directory, if any."""
+        if name in self._published:
+            self._published = {key: path for key, path in self._published.items() if key != name}
+            logger.info(f"Unpublished /{name}")
+
+    def publish_patches(self, manifest, directory):
+        """Serves manifest's patches (files relative to directory); None stops serving patches."""
+        if manifest is not None:
+            manifest = {**manifest, 'patches': {
+                version: {**patch, 'path': os.path.join(directory, patch['file'])}
+                for version, patch in manifest['patches'].items()
+            }}
+        self.patches = manifest
+        logger.info(f"Serving {len(manifest['patches']) if manifest else 0} patches")
+
+    def resolve(self, name):
+        """Path served for name: its published file, otherwise the file of that name in directory."""
+        return self._published.get(name) or os.path.join(self.directory, name)
+
+    def acquire_slot(self, client_address):
+        if self._slots.acquire(timeout=self.queue_timeout):
+            return True
+        logger.warning(f"{self.max_connections} downloads in progress, turning away {client_address[0]}")
+        return False
+
+    def release_slot(self):
+        self._slots.release()
+
+    def handle_error(self, request, client_address):
+        if isinstance(sys.exc_info()[1], (ConnectionError, TimeoutError)):
+            logger.debug(f"Download to {client_address[0]} ended early: {sys.exc_info()[1]}")
+        else:
+            logger.exception(f"Error serving {client_address[0]}")
@@ -0,0 +1,99 @@
+import hashlib
+import json
+import logging
+import os
+
+try:
+    import bsdiff4
+except ImportError:
+    bsdiff4 = None
+
+logger = logging.getLogger(__name__)
+
+PATCH_MANIFEST = 'patches.json'  # Written into each version folder next to its APK
+PATCH_DIR = 'patches'
+
+
+def folder_version(folder):
+    """'1.3' for RRHE_1.3; the string clients pass as /patch?from=."""
+    return folder.split('_', 1)[1]
+
+
+def version_folders(version_control_folder):
+    """RRHE_* folders, oldest version first."""
+    folders = [d for d in os.listdir(version_control_folder) if d.startswith('RRHE_')]
+    return sorted(folders, key=lambda folder: float(folder_version(folder)))
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def build_patches(version_control_folder, version_folder, apk_name, history, max_ratio):
+    """Writes bsdiff patches from the previous history versions to version_folder's APK; returns the manifest.
+
+    The manifest (also saved as patches.json in version_folder) carries the SHA-256 of the target APK
+    and, per source version, the patch's file, size and SHA-256 and the source APK's SHA-256, so a
+    client can check both what it patches and what it gets. A patch larger than max_ratio of the full
+    APK is dropped, since downloading the APK is then about as cheap and simpler.
+    """
+    folder_path = os.path.join(version_control_folder, version_folder)
+    target_path = os.path.join(folder_path, apk_name)
+    manifest = {
+        'version': folder_version(version_folder),
+        'apk': apk_name,
+        'size': os.path.getsize(target_path),
+        'sha256': file_sha256(target_path),
+        'patches': {},
+    }
+
+    if bsdiff4 is None:
+        logger.warning("bsdiff4 is not installed, clients will download the full APK")
+    else:
+        os.makedirs(os.path.join(folder_path, PATCH_DIR), exist_ok=True)
+        folders = version_folders(version_control_folder)
+        older = [folder for folder in folders
+                 if float(folder_version(folder)) < float(manifest['version'])][-history:]
+        for source_folder in older:
+            source_path = os.path.join(version_control_folder, source_folder, apk_name)
+            if not os.path.exists(source_path):
+                continue
+            source_sha256 = file_sha256(source_path)
+            if source_sha256 == manifest['sha256']:
+                continue  # Same build republished; a client on it has nothing to download
+            source_version = folder_version(source_folder)
+            patch_file = os.path.join(PATCH_DIR, f"from_{source_version}.bsdiff")
+            patch_path = os.path.join(folder_path, patch_file)
+            bsdiff4.file_diff(source_path, target_path, f"{patch_path}.tmp")
+            os.replace(f"{patch_path}.tmp", patch_path)
+            size = os.path.getsize(patch_path)
+            if size > manifest['size'] * max_ratio:
+                logger.info(f"Patch from {source_version} is {size} bytes, not worth it against the full APK")
+                os.remove(patch_path)
+                continue
+            manifest['patches'][source_version] = {
+                'file': patch_file,
+                'size': size,
+                'sha256': file_sha256(patch_path),
+                'from_sha256': source_sha256,
+            }
+            logger.info(f"Built patch {source_version} -> {manifest['version']}: {size} of {manifest['size']} bytes")
+
+    manifest_path = os.path.join(folder_path, PATCH_MANIFEST)
+    with open(f"{manifest_path}.tmp", 'w') as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+    return manifest
+
+
+def load_patches(version_control_folder, version_folder):
+    """The manifest build_patches() saved for version_folder, or None if it has none."""
+    try:
+        with open(os.path.join(version_control_folder, version_folder, PATCH_MANIFEST)) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
@@ -0,0 +1,76 @@
+import asyncio
+import threading
+
+
+class ChangeNotifier:
+    """Latest committed change-log position, with blocking waits for it to move past a given one.
+
+    Writers publish() after commit; /rrhe/watch requests wait() on a shared condition, so an idle
+    watcher costs a parked thread rather than a database query per poll.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self.change_id = None  # Unknown until the first publish()
+        self.watchers = 0
+        self.wakeups = 0
+
+    def publish(self, change_id):
+        with self._condition:
+            if self.change_id is None or change_id > self.change_id:
+                self.change_id = change_id
+                self.wakeups += 1
+                self._condition.notify_all()
+
+    def wait(self, after, timeout):
+        """Blocks until the position moves past after or timeout seconds pass; returns the current position."""
+        with self._condition:
+            self.watchers += 1
+            try:
+                self._condition.wait_for(lambda: self.change_id is not None and self.change_id > after, timeout)
+            finally:
+                self.watchers -= 1
+            return self.change_id
+
+    def stats(self):
+        with self._condition:
+            return {'change_id': self.change_id, 'watchers': self.watchers, 'wakeups': self.wakeups}
+
+
+class AsyncChangeNotifier:
+    """ChangeNotifier for an asyncio server: a waiting watcher is a suspended task, not a thread."""
+
+    def __init__(self):
+        self._condition = None  # Created on first use, inside the serving event loop
+        self.change_id = None
+        self.watchers = 0
+        self.wakeups = 0
+
+    def _get_condition(self):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    async def publish(self, change_id):
+        condition = self._get_condition()
+        async with condition:
+            if self.change_id is None or change_id > self.change_id:
+                self.change_id = change_id
+                self.wakeups += 1
+                condition.notify_all()
+
+    async def wait(self, after, timeout):
+        condition = self._get_condition()
+        async with condition:
+            self.watchers += 1
+            try:
+                await asyncio.wait_for(
+                    condition.wait_for(lambda: self.change_id is not None and self.change_id > after), timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self.watchers -= 1
+            return self.change_id
+
+    def stats(self):
+        return {'change_id': self.change_id, 'watchers': self.watchers, 'wakeups': self.wakeups}
@@ -0,0 +1,731 @@
+#! /home/mcmeister/myflaskenv/bin/python
+
+"""asyncio serving mode for the db_server API: the same routes and wire formats on Quart and aiomysql.
+
+Run it instead of db_server (same port), e.g. `hypercorn -b 0.0.0.0:5000 db_async_server:app`,
+or directly for Quart's development server. Query text, serializers, cursor formats and request
+validation are imported from db_server rather than copied, so the two modes don't drift apart; the
+responses have not been compared byte for byte against db_server's, so check a sync against it
+before switching. Importing db_server also sets up its connection pool (connections are opened on
+first use) and photo store, which the photo rename worker started here runs on.
+
+Differences from the threaded server:
+- Sync feeds (/rrhe, /rrhe/changes without paging) are read in keyset pages of STREAM_FETCH_SIZE
+  rows on (Stamp, StockID), and the MySQL connection is returned to the pool between pages. A slow
+  phone then holds neither an OS thread nor a database connection while it downloads. Rows arrive
+  in (Stamp, StockID) order; the array itself is unchanged.
+- The in-memory stock replica (RRHE_STOCK_REPLICA) is not available here.
+"""
+
+import asyncio
+import contextlib
+import hashlib
+import json
+import logging
+import time
+from datetime import datetime
+
+import aiomysql
+from quart import Quart, Response, request, jsonify
+
+import db_server
+from change_notifier import AsyncChangeNotifier
+from db_pool import PoolTimeout
+from db_server import (
+    CHANGES_PAGE_DEFAULT, CHANGES_PAGE_MAX, CHANGES_PAGE_QUERY, CHANGE_LOG_INSERT, CHANGE_LOG_PAGE_QUERY,
+    CHANGE_POSITION_QUERY, COMPRESSED_ENDPOINTS, COMPRESSION_LEVELS, CURSOR_END_OF_SECOND, DB_POOL_SIZE,
+    DB_POOL_TIMEOUT, INSERT_STOCK_QUERY, MAX_BATCH_UPDATES, PHOTO_RENAME_JOB_INSERT, STATS_VERSION_QUERY,
+    STOCK_COLUMN_INDEX, STOCK_VERSION_BUMP, STOCK_VERSION_CHANGE_ID, STOCK_VERSION_QUERY, STREAM_CHUNK_SIZE,
+    STREAM_FETCH_SIZE, UPDATE_STAMP_INDEX, UPDATE_STOCK_QUERY, WATCH_DEFAULT_TIMEOUT, WATCH_HEARTBEAT_INTERVAL,
+    WATCH_MAX_TIMEOUT, WATCH_POLL_INTERVAL, WATCH_STREAM_DURATION, as_datetime, change_log_rows,
+    changed_update_columns, changes_page_body, decode_change_cursor, delta_body, encode_change_cursor,
+    encode_stock_row, flatten_stats, hash_password, insert_stock_values, merge_change_log,
+    parse_changes_page_args, parse_photo_updates, parse_stats_args, stats_bucket_queries, stats_buckets,
+    stats_rows, stats_rows_query, stock_rows_query, update_columns_query, update_stock_params, wire_formats
+)
+from stream_compression import available_encodings, compress_chunks_async
+
+app = Quart(__name__)
+logging.basicConfig(level=logging.DEBUG)
+
+# Sync streams run for as long as the slowest phone takes; Quart would otherwise cut them off after 60s
+app.config['RESPONSE_TIMEOUT'] = None
+
+DB_POOL_RECYCLE = 3600  # Seconds before an idle pooled connection is replaced, ahead of MySQL's wait_timeout
+
+db_pool = None
+change_notifier = AsyncChangeNotifier()
+stop_background_workers = []  # Stop functions of db_server's worker threads started in before_serving
+
+@app.before_serving
+async def open_db_pool():
+    global db_pool
+    # autocommit so reads never leave a transaction open; aiomysql closes connections released mid-transaction
+    db_pool = await aiomysql.create_pool(
+        host='0.0.0.0',
+        user='root',
+        password='online12',
+        db='rrhe_db',
+        charset='utf8mb4',
+        use_unicode=True,
+        autocommit=True,
+        minsize=1,
+        maxsize=DB_POOL_SIZE,
+        pool_recycle=DB_POOL_RECYCLE
+    )
+    # Blocking, on db_server's sync pool, so in a thread; before anything queries the tables it creates
+    await asyncio.get_running_loop().run_in_executor(None, db_server.ensure_schema)
+    app.add_background_task(poll_change_position)
+
+@app.before_serving
+async def start_background_workers():
+    # Here rather than under __main__, so they run under hypercorn or any other ASGI launcher too.
+    # Change-log pruning and photo renames are shared with the threaded server and run on its sync
+    # pool, in threads, off the event loop.
+    stop_background_workers.append(db_server.start_change_log_pruner())
+    stop_background_workers.append(db_server.start_photo_rename_worker())
+
+@app.after_serving
+async def stop_workers():
+    loop = asyncio.get_running_loop()
+    while stop_background_workers:
+        await loop.run_in_executor(None, stop_background_workers.pop())
+
+@app.after_serving
+async def close_db_pool():
+    db_pool.close()
+    await db_pool.wait_closed()
+
+@contextlib.asynccontextmanager
+async def db_connection():
+    try:
+        connection = await asyncio.wait_for(db_pool.acquire(), DB_POOL_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise PoolTimeout(f"No database connection available after {DB_POOL_TIMEOUT}s (pool size {DB_POOL_SIZE})")
+    try:
+        yield connection
+    finally:
+        db_pool.release(connection)
+
+@contextlib.asynccontextmanager
+async def db_transaction():
+    """A pooled connection inside an explicit transaction, rolled back if the block raises."""
+    async with db_connection() as connection:
+        await connection.begin()
+        try:
+            yield connection
+        except BaseException:
+            await connection.rollback()
+            raise
+
+async def fetch_all(query, params=()):
+    async with db_connection() as connection:
+        async with connection.cursor() as cursor:
+            await cursor.execute(query, params)
+            return await cursor.fetchall()
+
+async def fetch_one(query, params=()):
+    rows = await fetch_all(query, params)
+    return rows[0] if rows else None
+
+@app.errorhandler(PoolTimeout)
+async def handle_pool_timeout(e):
+    app.logger.error(f"Database pool exhausted: {str(e)}")
+    return jsonify({'error': 'Server busy, please retry'}), 503
+
+@app.route('/pool/stats', methods=['GET'])
+async def get_pool_stats():
+    return jsonify({
+        'size': db_pool.maxsize,
+        'in_use': db_pool.size - db_pool.freesize,
+        'idle': db_pool.freesize,
+    }), 200
+
+def negotiated_wire_format():
+    mimetype = request.accept_mimetypes.best_match(list(wire_formats))
+    return wire_formats.get(mimetype, wire_formats['application/json'])
+
+def negotiated_encoding():
+    if request.endpoint not in COMPRESSED_ENDPOINTS:
+        return None
+    return request.accept_encodings.best_match(available_encodings())
+
+def make_etag(*parts):
+    parts = (request.full_path, negotiated_encoding(), negotiated_wire_format().mimetype) + parts
+    return hashlib.sha1('|'.join(str(part) for part in parts).encode('utf-8')).hexdigest()[:24]
+
+def not_modified(etag):
+    if request.if_none_match.contains(etag):
+        response = Response('', status=304)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    return None
+
+def with_etag(response, etag):
+    if response.status_code == 200:
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+async def single_chunk(body):
+    yield body
+
+def body_response(chunks, content_type):
+    """Builds a 200 response from bytes or an async iterator of chunks, compressed if the client asked for it."""
+    if isinstance(chunks, bytes):
+        chunks = single_chunk(chunks)
+    encoding = negotiated_encoding()
+    if encoding is not None:
+        chunks = compress_chunks_async(chunks, encoding, COMPRESSION_LEVELS)
+    response = Response(chunks, content_type=content_type)
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+@app.after_request
+async def add_vary(response):
+    if request.endpoint in COMPRESSED_ENDPOINTS:
+        response.vary.add('Accept-Encoding')
+        response.vary.add('Accept')
+    return response
+
+async def conditional_stock_response(build_response):
+    version = await fetch_one(STOCK_VERSION_QUERY)
+    etag = make_etag(*version)
+    response = not_modified(etag)
+    if response is None:
+        response = await build_response()
+        if isinstance(response, Response):
+            response = with_etag(response, etag)
+    if isinstance(response, Response):
+        response.headers['X-Change-Cursor'] = encode_change_cursor(version[STOCK_VERSION_CHANGE_ID])
+    return response
+
+@app.route('/login', methods=['POST'])
+async def login():
+    data = await request.get_json()
+    user_name = data.get('user_name')
+    password = data.get('password')
+
+    if not user_name or not password:
+        return jsonify({'error': 'Username and password are required'}), 400
+
+    try:
+        user = await fetch_one("SELECT user_id, user_name, lang_id FROM users WHERE user_name = %s AND password = %s",
+                               (user_name, hash_password(password)))
+    except PoolTimeout:
+        raise
+    except Exception as e:
+        app.logger.error(f"Error during login: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+    if user:
+        return jsonify({'user_id': user[0], 'user_name': user[1], 'lang_id': user[2]}), 200
+    return jsonify({'error': 'Invalid credentials'}), 401
+
+@app.route('/update_fcm_token', methods=['POST'])
+async def update_fcm_token():
+    data = await request.get_json()
+    app.logger.debug(f"Received data: {data}")
+
+    user_name = data.get('user_name')
+    fcm_token = data.get('fcm_token')
+
+    if not user_name or not fcm_token:
+        app.logger.error(f"Missing user_name or fcm_token. user_name: {user_name}, fcm_token: {fcm_token}")
+        return jsonify({'error': 'Username and FCM token are required'}), 400
+
+    try:
+        async with db_transaction() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute("UPDATE users SET fcm_token = %s WHERE user_name = %s", (fcm_token, user_name))
+            await connection.commit()
+        return jsonify({'message': 'FCM token updated successfully'}), 200
+    except PoolTimeout:
+        raise
+    except Exception as e:
+        app.logger.error(f"Error updating FCM token: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+async def stock_stream(wire_format, stamp, after_stock_id, first_page):
+    """Yields the stream body page by page; no connection is held while the client reads a page."""
+    page = first_page
+    chunk = [wire_format.stream_prefix()]
+    chunk_size = len(chunk[0])
+    first = True
+    while True:
+        for row in page[:STREAM_FETCH_SIZE]:
+            encoded = encode_stock_row(wire_format, row)
+            if encoded is None:
+                continue
+            if not first:
+                chunk.append(wire_format.separator)
+                chunk_size += len(wire_format.separator)
+            first = False
+            chunk.append(encoded)
+            chunk_size += len(encoded)
+            if chunk_size >= STREAM_CHUNK_SIZE:
+                yield b''.join(chunk)
+                chunk = []
+                chunk_size = 0
+        if len(page) <= STREAM_FETCH_SIZE:
+            break
+        last_row = page[STREAM_FETCH_SIZE - 1]
+        stamp, after_stock_id = last_row[STOCK_COLUMN_INDEX['Stamp']], last_row[0]
+        page = await fetch_all(CHANGES_PAGE_QUERY, (stamp, stamp, after_stock_id, STREAM_FETCH_SIZE + 1))
+    chunk.append(wire_format.stream_suffix())
+    yield b''.join(chunk)
+
+async def stream_rrhe_changes(last_sync_time, wire_format):
+    # Passed to MySQL as given, as db_server does: (last_sync_time, CURSOR_END_OF_SECOND) in the keyset
+    # query is exactly "Stamp > last_sync_time", with MySQL deciding which timestamp strings it accepts
+    # The first page is read before the response starts, so a database error is still a clean 500
+    first_page = await fetch_all(CHANGES_PAGE_QUERY, (last_sync_time, last_sync_time, CURSOR_END_OF_SECOND,
+                                                      STREAM_FETCH_SIZE + 1))
+    return body_response(stock_stream(wire_format, last_sync_time, CURSOR_END_OF_SECOND, first_page),
+                         wire_format.content_type)
+
+async def get_rrhe_changes_page(cursor_token, last_sync_time, limit, wire_format):
+    try:
+        stamp, after_stock_id, limit = parse_changes_page_args(cursor_token, last_sync_time, limit)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        rows = await fetch_all(CHANGES_PAGE_QUERY, (stamp, stamp, after_stock_id, limit + 1))
+    except PoolTimeout:
+        raise
+    except Exception as e:
+        app.logger.error(f"Error reading changes page: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+    return body_response(changes_page_body(wire_format, rows, limit, stamp, after_stock_id), wire_format.content_type)
+
+@app.route('/rrhe/changes', methods=['GET'])
+async def get_rrhe_changes():
+    last_sync_time = request.args.get('last_sync_time')
+    cursor_token = request.args.get('cursor')
+    limit = request.args.get('limit')
+    if cursor_token is None and limit is None and last_sync_time is None:
+        return jsonify({'error': 'Missing last_sync_time parameter'}), 400
+
+    wire_format = negotiated_wire_format()
+    if cursor_token is not None or limit is not None:
+        return await conditional_stock_response(
+            lambda: get_rrhe_changes_page(cursor_token, last_sync_time, limit, wire_format))
+    return await conditional_stock_response(lambda: stream_rrhe_changes(last_sync_time, wire_format))
+
+@app.route('/rrhe', methods=['GET'])
+async def get_rrhe():
+    wire_format = negotiated_wire_format()
+    return await conditional_stock_response(lambda: stream_rrhe_changes("1970-01-01T00:00:00", wire_format))
+
+@app.route('/rrhe/changes/delta', methods=['GET'])
+async def get_rrhe_changes_delta():
+    cursor_token = request.args.get('cursor')
+    if not cursor_token:
+        return jsonify({'error': 'Missing cursor parameter'}), 400
+    try:
+        since = decode_change_cursor(cursor_token)
+        limit = int(request.args.get('limit', CHANGES_PAGE_DEFAULT))
+    except (ValueError, TypeError, UnicodeError):
+        return jsonify({'error': 'Invalid cursor or limit'}), 400
+    limit = max(1, min(limit, CHANGES_PAGE_MAX))
+
+    try:
+        async with db_connection() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute("SELECT version FROM sync_state WHERE name = 'changes_floor'")
+                floor = (await cursor.fetchone())[0]
+                if since < floor:
+                    return jsonify({'error': 'Cursor too old, full resync required', 'resync_required': True}), 410
+
+                await cursor.execute(CHANGE_LOG_PAGE_QUERY, (since, limit + 1))
+                log = await cursor.fetchall()
+                has_more = len(log) > limit
+                log = log[:limit]
+                touched, deleted = merge_change_log(log)
+
+                rows = {}
+                if touched:
+                    await cursor.execute(stock_rows_query(len(touched)), list(touched))
+                    rows = {row[0]: row for row in await cursor.fetchall()}
+    except PoolTimeout:
+        raise
+    except Exception as e:
+        app.logger.error(f"Error reading change log: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+    return body_response(delta_body(since, log, has_more, touched, deleted, rows), 'application/json; charset=utf-8')
+
+async def record_stock_write(cursor, changes=()):
+    """Same bookkeeping as db_server.record_stock_write(): bump first, so ChangeIDs commit in order."""
+    await cursor.execute(STOCK_VERSION_BUMP)
+    rows = change_log_rows(changes)
+    if rows:
+        await cursor.executemany(CHANGE_LOG_INSERT, rows)
+
+async def read_update_columns(cursor, stock_ids, for_update=False):
+    await cursor.execute(update_columns_query(len(stock_ids), for_update), list(stock_ids))
+    return {row[0]: row[1:] for row in await cursor.fetchall()}
+
+async def after_stock_commit(cursor):
+    """Wakes /rrhe/watch clients with the change-log position read after commit."""
+    try:
+        await cursor.execute(CHANGE_POSITION_QUERY)
+        await change_notifier.publish((await cursor.fetchone())[0])
+    except Exception as e:
+        app.logger.error(f"Error publishing change notification: {str(e)}")
+
+async def current_change_position():
+    if change_notifier.change_id is None:
+        await change_notifier.publish((await fetch_one(CHANGE_POSITION_QUERY))[0])
+    return change_notifier.change_id
+
+async def poll_change_position():
+    """Publishes writes committed by other processes (or the delete trigger) while anyone is watching."""
+    while True:
+        if change_notifier.watchers:
+            try:
+                await change_notifier.publish((await fetch_one(CHANGE_POSITION_QUERY))[0])
+            except Exception as e:
+                app.logger.error(f"Error polling change log for watchers: {str(e)}")
+        await asyncio.sleep(WATCH_POLL_INTERVAL)
+
+async def watch_event_stream(since):
+    deadline = time.monotonic() + WATCH_STREAM_DURATION
+    position = since
+    yield b'retry: 5000\n\n'
+    while time.monotonic() < deadline:
+        timeout = min(WATCH_HEARTBEAT_INTERVAL, deadline - time.monotonic())
+        current = await change_notifier.wait(position, timeout)
+        if current is not None and current > position:
+            position = current
+            data = json.dumps({'cursor': encode_change_cursor(position), 'change_id': position})
+            yield f"id: {encode_change_cursor(position)}\nevent: change\ndata: {data}\n\n".encode('utf-8')
+        else:
+            yield b': keep-alive\n\n'
+
+@app.route('/rrhe/watch', methods=['GET'])
+async def watch_rrhe():
+    cursor_token = request.args.get('cursor') or request.headers.get('Last-Event-ID')
+    try:
+        since = decode_change_cursor(cursor_token) if cursor_token else None
+        timeout = min(float(request.args.get('timeout', WATCH_DEFAULT_TIMEOUT)), WATCH_MAX_TIMEOUT)
+    except (ValueError, TypeError, UnicodeError):
+        return jsonify({'error': 'Invalid cursor or timeout'}), 400
+
+    current = await current_change_position()
+    if since is None:
+        since = current
+
+    if request.accept_mimetypes.best == 'text/event-stream':
+        response = Response(watch_event_stream(since), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+    if current <= since:
+        current = await change_notifier.wait(since, max(timeout, 0))
+    changed = current > since
+    return jsonify({'changed': changed, 'cursor': encode_change_cursor(current if changed else since)}), 200
+
+@app.route('/rrhe/watch/stats', methods=['GET'])
+async def get_watch_stats():
+    return jsonify(change_notifier.stats()), 200
+
+@app.route('/rrhe/update', methods=['POST'])
+async def update_rrhe():
+    data = await request.get_json()
+    app.logger.debug(f"Received update request: {data}")
+    if not data:
+        return jsonify({'error': 'No input data provided'}), 400
+
+    stock_id = data.get('StockID')
+    stamp_str = data.get('Stamp')
+    if not stock_id or not stamp_str:
+        return jsonify({'error': 'StockID and Stamp are required'}), 400
+
+    try:
+        incoming_stamp = datetime.strptime(stamp_str, '%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        return jsonify({'error': 'Invalid Stamp format. Expected yyyy-MM-dd HH:mm:ss'}), 400
+
+    try:
+        async with db_transaction() as connection:
+            async with connection.cursor() as cursor:
+                before = next(iter((await read_update_columns(cursor, [stock_id], for_update=True)).values()), None)
+                if before and as_datetime(before[UPDATE_STAMP_INDEX]) >= incoming_stamp:
+                    await connection.rollback()
+                    return jsonify({'error': 'A more recent update already exists'}), 409
+
+                await cursor.execute(UPDATE_STOCK_QUERY, update_stock_params(data, incoming_stamp, stock_id))
+
+                changes = []
+                if before:
+                    after = next(iter((await read_update_columns(cursor, [stock_id])).values()), None)
+                    if after:
+                        changes.append((stock_id, 'update', changed_update_columns(before, after)))
+                await record_stock_write(cursor, changes)
+                await connection.commit()
+                await after_stock_commit(cursor)
+        app.logger.debug(f"Plant updated successfully for StockID: {stock_id}")
+        return jsonify({'message': 'Plant updated successfully'}), 200
+    except PoolTimeout:
+        raise
+    except Exception as e:
+        app.logger.error(f"Error updating plant: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/rrhe/update/batch', methods=['POST'])
+async def update_rrhe_batch():
+    data = await request.get_json()
+    updates = data.get('updates') if isinstance(data, dict) else data
+    if not updates or not isinstance(updates, list):
+        return jsonify({'error': 'Expected a non-empty list of updates'}), 400
+    if len(updates) > MAX_BATCH_UPDATES:
+        return jsonify({'error': f'At most {MAX_BATCH_UPDATES} updates per batch'}), 413
+    app.logger.debug(f"Received batch update request with {len(updates)} entries")
+
+    results = [None] * len(updates)
+    pending = []
+    for index, entry in enumerate(updates):
+        stock_id = entry.get('StockID') if isinstance(entry, dict) else None
+        stamp_str = entry.get('Stamp') if isinstance(entry, dict) else None
+        if not stock_id or not stamp_str:
+            results[index] = {'StockID': stock_id, 'status': 'error', 'error': 'StockID and Stamp are required'}
+            continue
+        try:
+            stock_id = int(stock_id)
+        except (TypeError, ValueError):
+            results[index] = {'StockID': stock_id, 'status': 'error', 'error': 'StockID must be an integer'}
+            continue
+        try:
+            incoming_stamp = datetime.strptime(stamp_str, '%Y-%m-%d %H:%M:%S')
+        except (TypeError, ValueError):
+            results[index] = {'StockID': stock_id, 'status': 'error',
+                              'error': 'Invalid Stamp format. Expected yyyy-MM-dd HH:mm:ss'}
+            continue
+        pending.append((index, stock_id, incoming_stamp, entry))
+
+    try:
+        async with db_transaction() as connection:
+            async with connection.cursor() as cursor:
+                applied_params = []
+                if pending:
+                    stock_ids = sorted({stock_id for _, stock_id, _, _ in pending})
+                    before = await read_update_columns(cursor, stock_ids, for_update=True)
+                    current_stamps = {stock_id: as_datetime(values[UPDATE_STAMP_INDEX])
+                                      for stock_id, values in before.items()}
+
+                    for index, stock_id, incoming_stamp, entry in pending:
+                        if stock_id not in current_stamps:
+                            results[index] = {'StockID': stock_id, 'status': 'error', 'error': 'StockID not found'}
+                        elif current_stamps[stock_id] >= incoming_stamp:
+                            results[index] = {'StockID': stock_id, 'status': 'conflict',
+                                              'error': 'A more recent update already exists'}
+                        else:
+                            applied_params.append(update_stock_params(entry, incoming_stamp, stock_id))
+                            current_stamps[stock_id] = incoming_stamp
+                            results[index] = {'StockID': stock_id, 'status': 'applied'}
+
+                if applied_params:
+                    await cursor.executemany(UPDATE_STOCK_QUERY, applied_params)
+                    applied_ids = sorted({params[-1] for params in applied_params})
+                    after = await read_update_columns(cursor, applied_ids)
+                    await record_stock_write(cursor, [
+                        (stock_id, 'update', changed_update_columns(before[stock_id], after[stock_id]))
+                        for stock_id in applied_ids if stock_id in after
+                    ])
+                await connection.commit()
+                if applied_params:
+                    await after_stock_commit(cursor)
+    except PoolTimeout:
+        raise
+    except Exception as e:
+        app.logger.error(f"Error applying batch update: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+    counts = {status: sum(1 for result in results if result['status'] == status)
+              for status in ('applied', 'conflict', 'error')}
+    app.logger.debug(f"Batch update finished: {counts}")
+    return jsonify({'results': results, **counts}), 200
+
+async def allocate_stock_ids(count):
+    """Reserves count StockIDs from the shared sequence in one statement (no hi/lo block caching here)."""
+    async with db_connection() as connection:
+        async with connection.cursor() as cursor:
+            await cursor.execute("UPDATE id_sequences SET next_id = LAST_INSERT_ID(next_id + %s) WHERE name = 'stock'",
+                                 (count,))
+            await cursor.execute("SELECT LAST_INSERT_ID()")
+            end = (await cursor.fetchone())[0]
+    return list(range(end - count, end))
+
+async def insert_plants(plants, temp_stock_ids):
+    """Inserts plants with a photo rename job each and returns (id_map, inserted rows as dicts)."""
+    new_stock_ids = await allocate_stock_ids(len(plants))
+    id_map = dict(zip(temp_stock_ids, new_stock_ids))
+
+    async with db_transaction() as connection:
+        async with connection.cursor() as cursor:
+            await cursor.executemany(INSERT_STOCK_QUERY, [
+                insert_stock_values(plant, new_stock_id) for plant, new_stock_id in zip(plants, new_stock_ids)
+            ])
+            await cursor.executemany(PHOTO_RENAME_JOB_INSERT, [(new_id, temp_id) for temp_id, new_id in id_map.items()])
+            await record_stock_write(cursor, [(new_stock_id, 'insert', ['*']) for new_stock_id in new_stock_ids])
+            await connection.commit()
+            await after_stock_commit(cursor)
+            # The renames run on db_server's worker thread in this process, off the event loop
+            db_server.photo_rename_wakeup.set()
+            app.logger.debug(f"Inserted {len(plants)} plants: {id_map}")
+
+            placeholders = ','.join(['%s'] * len(new_stock_ids))
+            await cursor.execute(f"SELECT * FROM stock WHERE StockID IN ({placeholders}) ORDER BY StockID", new_stock_ids)
+            columns = [desc[0] for desc in cursor.description]
+            inserted = [dict(zip(columns, row)) for row in await cursor.fetchall()]
+    return id_map, inserted
+
+@app.route('/rrhe/insert', methods=['POST'])
+async def insert_new_plant():
+    data = await request.get_json()
+    app.logger.debug(f"Received insert request: {data}")
+
+    if not data:
+        return jsonify({'error': 'No input data provided'}), 400
+
+    temp_stock_id = data.get('StockID')
+    if temp_stock_id is None or temp_stock_id >= 0:
+        return jsonify({'error': 'Invalid or missing negative StockID'}), 400
+
+    try:
+        id_map, inserted = await insert_plants([data], [temp_stock_id])
+        if not inserted:
+            raise ValueError(f"Failed to retrieve the inserted plant with StockID: {id_map[temp_stock_id]}")
+        return jsonify(inserted[0]), 201
+    except PoolTimeout:
+        raise
+    except Exception as e:
+        app.logger.error(f"Error inserting new plant: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/rrhe/insert/batch', methods=['POST'])
+async def insert_new_plants_batch():
+    data = await request.get_json()
+    plants = data.get('plants') if isinstance(data, dict) else data
+    if not plants or not isinstance(plants, list):
+        return jsonify({'error': 'Expected a non-empty list of plants'}), 400
+    if len(plants) > MAX_BATCH_UPDATES:
+        return jsonify({'error': f'At most {MAX_BATCH_UPDATES} plants per batch'}), 413
+
+    temp_stock_ids = [plant.get('StockID') if isinstance(plant, dict) else None for plant in plants]
+    if any(not isinstance(temp_id, int) or temp_id >= 0 for temp_id in temp_stock_ids):
+        return jsonify({'error': 'Every plant needs a negative temporary StockID'}), 400
+    if len(set(temp_stock_ids)) != len(temp_stock_ids):
+        return jsonify({'error': 'Temporary StockIDs must be unique within a batch'}), 400
+    app.logger.debug(f"Received batch insert request with {len(plants)} plants")
+
+    try:
+        id_map, inserted = await insert_plants(plants, temp_stock_ids)
+        return jsonify({
+            'id_map': {str(temp_id): new_id for temp_id, new_id in id_map.items()},
+            'plants': inserted
+        }), 201
+    except PoolTimeout:
+        raise
+    except Exception as e:
+        app.logger.error(f"Error inserting batch of new plants: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/update_photo_column', methods=['POST'])
+async def update_photo_column():
+    data = await request.get_json()
+    stock_id = data.get('stockID')
+    photo_index = data.get('photoIndex')
+    photo_url = data.get('photoUrl')
+
+    if not stock_id or not photo_index:
+        return jsonify({'error': 'StockID and photoIndex are required'}), 400
+
+    photo_column = f'Photo{photo_index}'
+
+    try:
+        async with db_transaction() as connection:
+            async with connection.cursor() as cursor:
+                changed = await cursor.execute(f"UPDATE stock SET {photo_column} = %s WHERE StockID = %s",
+                                               (photo_url, stock_id))
+                await record_stock_write(cursor, [(stock_id, 'update', [photo_column])] if changed else [])
+                await connection.commit()
+                if changed:
+                    await after_stock_commit(cursor)
+        app.logger.debug(f"Updated {photo_column} for StockID: {stock_id} with URL: {photo_url}")
+    except PoolTimeout:
+        raise
+    except Exception as e:
+        app.logger.error(f"Error updating {photo_column} for StockID {stock_id}: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+    return jsonify({'message': f'{photo_column} updated successfully for StockID {stock_id}'}), 200
+
+@app.route('/update_photo_column/batch', methods=['POST'])
+async def update_photo_column_batch():
+    try:
+        updates = parse_photo_updates(await request.get_json())
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        async with db_transaction() as connection:
+            async with connection.cursor() as cursor:
+                writes = []
+                for stock_id, photo_column, photo_url in updates:
+                    if await cursor.execute(f"UPDATE stock SET {photo_column} = %s WHERE StockID = %s",
+                                            (photo_url, stock_id)):
+                        writes.append((stock_id, 'update', [photo_column]))
+                await record_stock_write(cursor, writes)
+                await connection.commit()
+                if writes:
+                    await after_stock_commit(cursor)
+        app.logger.debug(f"Applied {len(updates)} photo column updates, {len(writes)} changed")
+    except PoolTimeout:
+        raise
+    except Exception as e:
+        app.logger.error(f"Error applying batch of photo column updates: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+    return jsonify({'message': f'{len(updates)} photo columns updated', 'changed': len(writes)}), 200
+
+@app.route('/stats', methods=['GET'])
+async def get_stats():
+    try:
+        bucket, aggregate, where, params = parse_stats_args(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    etag = make_etag(*await fetch_one(STATS_VERSION_QUERY))
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+
+    async with db_connection() as connection:
+        async with connection.cursor() as cursor:
+            if bucket is not None:
+                grouped_query, last_query = stats_bucket_queries(bucket, where)
+                await cursor.execute(grouped_query, params)
+                grouped = await cursor.fetchall()
+                await cursor.execute(last_query, params)
+                stats = stats_buckets(grouped, await cursor.fetchall())
+            else:
+                await cursor.execute(stats_rows_query(where), params)
+                stats = stats_rows(await cursor.fetchall())
+
+    if aggregate is not None:
+        stats = flatten_stats(stats, aggregate)
+    if not stats:
+        return jsonify({'error': 'No stats found'}), 404
+    # Encoded by the app's JSON provider so dates come out exactly as in db_server
+    body = app.json.dumps(stats).encode('utf-8')
+    return with_etag(body_response(body, 'application/json'), etag)
+
+if __name__ == '__main__':
+    app.run(host='0.0.0.0', port=5000)
@@ -7,12 +7,18 @@ from decimal import Decimal
 from datetime import datetime
 import re
 import logging
+import os
 import hashlib
+from db_pool import ConnectionPool, PoolTimeout
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.DEBUG)
 
-def get_db_connection():
+DB_POOL_SIZE = int(os.environ.get('RRHE_DB_POOL_SIZE', 10))  # Upper bound on concurrent MySQL connections
+DB_POOL_TIMEOUT = float(os.environ.get('RRHE_DB_POOL_TIMEOUT', 10))  # Seconds a request waits for a free connection
+DB_POOL_HEALTH_CHECK_INTERVAL = 30  # Ping connections that sat idle longer than this before handing them out
+
+def connect_db():
     return pymysql.connect(
         host='localhost',
         user='root',
@@ -22,6 +28,26 @@ def get_db_connection():
         use_unicode=True
     )
 
+db_pool = ConnectionPool(
+    connect_db,
+    size=DB_POOL_SIZE,
+    timeout=DB_POOL_TIMEOUT,
+    health_check_interval=DB_POOL_HEALTH_CHECK_INTERVAL
+)
+
+def get_db_connection():
+    # Connections come from the pool; calling close() on them hands them back
+    return db_pool.connection()
+
+@app.errorhandler(PoolTimeout)
+def handle_pool_timeout(e):
+    app.logger.error(f"Database pool exhausted: {str(e)}")
+    return jsonify({'error': 'Server busy, please retry'}), 503
+
+@app.route('/pool/stats', methods=['GET'])
+def get_pool_stats():
+    return jsonify(db_pool.stats()), 200
+
 def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
 
@@ -392,13 +418,16 @@ def get_rrhe():
 @app.route('/stats', methods=['GET'])
 def get_stats():
     connection = get_db_connection()
-    cursor = connection.cursor()
-    cursor.execute("""
-        SELECT Stamp, TotalRows, TotalPlants, TotalNonM, TotalM, NonMValue, MValue, TotalValue, WebPlants, WebQty, WebValue, USD, EUR 
-        FROM stats
-    """)
-
-    rows = cursor.fetchall()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT Stamp, TotalRows, TotalPlants, TotalNonM, TotalM, NonMValue, MValue, TotalValue, WebPlants, WebQty, WebValue, USD, EUR 
+                FROM stats
+            """)
+            rows = cursor.fetchall()
+    finally:
+        # Always hand the connection back, otherwise a failed query leaks a pool slot
+        connection.close()
     stats = []
     for row in rows:
         stats.append({
@@ -416,8 +445,6 @@ def get_stats():
             'USD': float(row[11]) if row[11] is not None else None,
             'EUR': float(row[12]) if row[12] is not None else None
         })
-    cursor.close()
-    connection.close()
     if stats:
         return jsonify(stats), 200
     else:
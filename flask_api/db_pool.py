@@ -0,0 +1,148 @@
+import logging
+import queue
+import threading
+import time
+
+import pymysql
+from pymysql.constants import SERVER_STATUS
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PooledConnection:
+    """Wraps a pymysql connection so that close() hands it back to the pool instead of disconnecting."""
+
+    def __init__(self, pool, connection):
+        self._pool = pool
+        self._connection = connection
+
+    def __getattr__(self, name):
+        connection = self.__dict__.get('_connection')
+        if connection is None:
+            raise pymysql.err.InterfaceError(0, 'Connection already returned to the pool')
+        return getattr(connection, name)
+
+    def close(self):
+        if self._connection is not None:
+            connection, self._connection = self._connection, None
+            self._pool.release(connection)
+
+    def discard(self):
+        """Really close the connection, e.g. after an aborted unbuffered query left it unusable."""
+        if self._connection is not None:
+            connection, self._connection = self._connection, None
+            self._pool.release(connection, discard=True)
+
+
+class ConnectionPool:
+    def __init__(self, connect, size=10, timeout=10, health_check_interval=30, slow_wait=0.1):
+        self._connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.slow_wait = slow_wait
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = queue.LifoQueue()  # Most recently used first, so surplus connections go stale and get pinged out
+        self._lock = threading.Lock()
+        self._in_use = 0
+        self._created = 0
+        self._reconnects = 0
+        self._checkouts = 0
+        self._timeouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def connection(self):
+        start = time.monotonic()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self._timeouts += 1
+            raise PoolTimeout(f"No database connection available after {self.timeout}s (pool size {self.size})")
+        wait = time.monotonic() - start
+
+        try:
+            connection = self._checkout()
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._in_use += 1
+            self._checkouts += 1
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+        if wait >= self.slow_wait:
+            logger.warning(f"Waited {wait * 1000:.1f} ms for a pooled DB connection ({self._in_use}/{self.size} in use)")
+        else:
+            logger.debug(f"Pooled DB connection acquired in {wait * 1000:.1f} ms")
+        return PooledConnection(self, connection)
+
+    def _checkout(self):
+        try:
+            connection, last_used = self._idle.get_nowait()
+        except queue.Empty:
+            return self._new_connection()
+
+        if time.monotonic() - last_used < self.health_check_interval:
+            return connection
+        try:
+            # Reconnects transparently if MySQL was restarted or dropped the idle session
+            thread_id = connection.thread_id()
+            connection.ping(reconnect=True)
+            if connection.thread_id() != thread_id:
+                with self._lock:
+                    self._reconnects += 1
+                logger.info("Pooled DB connection was stale and has been reconnected")
+            return connection
+        except Exception as e:
+            logger.warning(f"Discarding broken pooled DB connection: {str(e)}")
+            self._close_quietly(connection)
+            return self._new_connection()
+
+    def _new_connection(self):
+        connection = self._connect()
+        with self._lock:
+            self._created += 1
+        return connection
+
+    def release(self, connection, discard=False):
+        try:
+            if not discard and connection.open:
+                try:
+                    # Never hand out a connection holding an open transaction or an old REPEATABLE READ snapshot
+                    if connection.server_status & SERVER_STATUS.SERVER_STATUS_IN_TRANS:
+                        connection.rollback()
+                    self._idle.put((connection, time.monotonic()))
+                    return
+                except Exception as e:
+                    logger.warning(f"Failed to reset pooled DB connection, discarding it: {str(e)}")
+            self._close_quietly(connection)
+        finally:
+            with self._lock:
+                self._in_use -= 1
+            self._slots.release()
+
+    @staticmethod
+    def _close_quietly(connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self.size,
+                'in_use': self._in_use,
+                'idle': self._idle.qsize(),
+                'created': self._created,
+                'reconnects': self._reconnects,
+                'checkouts': self._checkouts,
+                'timeouts': self._timeouts,
+                'wait_avg_ms': round(self._wait_total / self._checkouts * 1000, 3) if self._checkouts else 0.0,
+                'wait_max_ms': round(self._wait_max * 1000, 3),
+            }
@@ -3,17 +3,70 @@
 from flask import Flask, Response, request, jsonify
 import json
 import pymysql
+import pymysql.cursors
 from decimal import Decimal
 from datetime import datetime
-import re
 import logging
 import hashlib
+import base64
 import os
+import threading
+import time
+from db_pool import ConnectionPool, PoolTimeout
+from id_allocator import BlockIdAllocator
+from stream_compression import available_encodings, compress_chunks
+from stock_serializer import STOCK_COLUMN_INDEX, STOCK_COLUMN_NAMES, StockRowSerializer, build_wire_formats
+from stock_replica import StockReplica
+from change_notifier import ChangeNotifier
+from photo_versions import PhotoVersions, versioned_url
+from photo_store import PHOTO_FOLDER, PHOTO_STORE_DIR, PhotoStore
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.DEBUG)
 
-def get_db_connection():
+DB_POOL_SIZE = int(os.environ.get('RRHE_DB_POOL_SIZE', 10))  # Upper bound on concurrent MySQL connections
+DB_POOL_TIMEOUT = float(os.environ.get('RRHE_DB_POOL_TIMEOUT', 10))  # Seconds a request waits for a free connection
+DB_POOL_HEALTH_CHECK_INTERVAL = 30  # Ping connections that sat idle longer than this before handing them out
+
+STREAM_FETCH_SIZE = 500  # Rows pulled from the server-side cursor per round trip
+STREAM_CHUNK_SIZE = 64 * 1024  # Flush the response once this many bytes are buffered
+STREAM_NET_WRITE_TIMEOUT = 600  # Seconds MySQL waits on a slow reader before aborting the stream
+
+# Response compression for the sync endpoints, negotiated from Accept-Encoding
+COMPRESSION_LEVELS = {
+    'gzip': int(os.environ.get('RRHE_GZIP_LEVEL', 5)),
+    'zstd': int(os.environ.get('RRHE_ZSTD_LEVEL', 3)),
+    'br': int(os.environ.get('RRHE_BROTLI_LEVEL', 4)),
+}
+COMPRESSED_ENDPOINTS = {'get_rrhe', 'get_rrhe_changes', 'get_rrhe_changes_delta', 'get_stats'}
+
+MAX_BATCH_UPDATES = 500  # Entries accepted by one /rrhe/update/batch or /rrhe/insert/batch call
+# StockIDs reserved from the sequence per round trip; IDs left in a block are skipped when the process restarts
+STOCK_ID_BLOCK_SIZE = int(os.environ.get('RRHE_STOCK_ID_BLOCK_SIZE', 1))
+
+PHOTO_RENAME_BATCH_SIZE = 100  # Rename jobs whose Photo columns are set in one transaction
+PHOTO_RENAME_INTERVAL = 30  # Seconds between sweeps for jobs when no insert wakes the worker
+PHOTO_RENAME_MAX_ATTEMPTS = 10  # Failed tries before a job is left in photo_rename_jobs for a person to look at
+
+CHANGE_LOG_RETENTION_DAYS = int(os.environ.get('RRHE_CHANGE_LOG_RETENTION_DAYS', 30))  # Delta cursors older than this need a resync
+CHANGE_LOG_PRUNE_INTERVAL = 3600  # Seconds between change-log pruning passes
+
+CHANGES_PAGE_DEFAULT = 500  # Rows per /rrhe/changes page when the client asks for paging without a limit
+CHANGES_PAGE_MAX = 2000
+CURSOR_END_OF_SECOND = 2 ** 31 - 1  # StockID upper bound, so (stamp, CURSOR_END_OF_SECOND) means "after this second"
+
+# Optional in-process copy of stock that answers the plain JSON /rrhe and /rrhe/changes feeds without MySQL
+STOCK_REPLICA_ENABLED = os.environ.get('RRHE_STOCK_REPLICA', '0') == '1'
+STOCK_REPLICA_MAX_BYTES = int(os.environ.get('RRHE_STOCK_REPLICA_MAX_MB', 64)) * 1024 * 1024
+STOCK_REPLICA_SYNC_INTERVAL = 5  # Seconds between catch-ups, which pick up writes made by other processes
+
+WATCH_DEFAULT_TIMEOUT = 25  # Seconds a /rrhe/watch long-poll is held when nothing changes
+WATCH_MAX_TIMEOUT = 60
+WATCH_HEARTBEAT_INTERVAL = 15  # SSE comment lines keep proxies and NAT from dropping an idle stream
+WATCH_STREAM_DURATION = 300  # An SSE stream ends after this long and the client reconnects, freeing its thread
+WATCH_POLL_INTERVAL = 2  # While anyone is watching, one shared query picks up writes made by other processes
+
+def connect_db():
     return pymysql.connect(
         host='0.0.0.0',
         user='root',
@@ -23,6 +76,26 @@ def get_db_connection():
         use_unicode=True
     )
 
+db_pool = ConnectionPool(
+    connect_db,
+    size=DB_POOL_SIZE,
+    timeout=DB_POOL_TIMEOUT,
+    health_check_interval=DB_POOL_HEALTH_CHECK_INTERVAL
+)
+
+def get_db_connection():
+    # Connections come from the pool; calling close() on them hands them back
+    return db_pool.connection()
+
+@app.errorhandler(PoolTimeout)
+def handle_pool_timeout(e):
+    app.logger.error(f"Database pool exhausted: {str(e)}")
+    return jsonify({'error': 'Server busy, please retry'}), 503
+
+@app.route('/pool/stats', methods=['GET'])
+def get_pool_stats():
+    return jsonify(db_pool.stats()), 200
+
 def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
 
@@ -82,107 +155,545 @@ def update_fcm_token():
     finally:
         connection.close()
 
-def escape_special_characters(data):
-    if isinstance(data, str):
-        return data.encode('unicode_escape').decode('utf-8')
-    return data
+STOCK_SELECT = "SELECT " + ", ".join(STOCK_COLUMN_NAMES) + " FROM stock "
 
-def validate_data(data):
+# Built once at import; converters are picked per column from STOCK_COLUMNS
+stock_serializer = StockRowSerializer()
+wire_formats = build_wire_formats(stock_serializer)
+
+def negotiated_wire_format():
+    # Plain JSON unless the client explicitly asks for a columnar format in Accept
+    mimetype = request.accept_mimetypes.best_match(list(wire_formats))
+    return wire_formats.get(mimetype, wire_formats['application/json'])
+
+def encode_stock_row(wire_format, row):
+    """Serializes one stock row, or returns None (and logs) if the row can't be encoded."""
     try:
-        json.dumps(data)
-        return True
-    except (TypeError, ValueError) as e:
-        app.logger.error(f"Data validation error: {str(e)} - Data: {data}")
-        return False
-
-def sanitize_data(data):
-    if isinstance(data, str):
-        data = re.sub(r'[^\x20-\x7E]', '', data)
-        return data
-    return data
-
-def stream_rrhe_changes(last_sync_time):
+        return wire_format.encode_row(row)
+    except Exception as e:
+        app.logger.error(f"Error serializing row: {row}, Error: {str(e)}")
+        return None
+
+stock_replica = StockReplica(
+    wire_formats['application/json'],
+    lambda row: encode_stock_row(wire_formats['application/json'], row),
+    STOCK_COLUMN_INDEX['Stamp'],
+    STOCK_REPLICA_MAX_BYTES
+) if STOCK_REPLICA_ENABLED else None
+
+def stock_rows_query(count):
+    return STOCK_SELECT + f"WHERE StockID IN ({','.join(['%s'] * count)})"
+
+def read_stock_rows(cursor, stock_ids):
+    cursor.execute(stock_rows_query(len(stock_ids)), list(stock_ids))
+    return cursor.fetchall()
+
+change_notifier = ChangeNotifier()
+
+def read_change_position(cursor):
+    cursor.execute(CHANGE_POSITION_QUERY)
+    return cursor.fetchone()[0]
+
+def after_stock_commit(cursor, stock_ids):
+    """Post-commit hook for every stock write path: refreshes the replica and wakes /rrhe/watch clients."""
+    refresh_stock_replica(cursor, stock_ids)
+    try:
+        # Read after commit, so every ChangeID up to this one is committed and safe to resume from
+        change_notifier.publish(read_change_position(cursor))
+    except Exception as e:
+        app.logger.error(f"Error publishing change notification: {str(e)}")
+
+def refresh_stock_replica(cursor, stock_ids):
+    """Copies just-committed rows into the replica; call right after commit on the writing connection."""
+    stock_ids = set(stock_ids)
+    if stock_replica is None or not stock_replica.ready or not stock_ids:
+        return
+    try:
+        rows = read_stock_rows(cursor, stock_ids)
+        stock_replica.upsert(rows)
+        stock_replica.remove(stock_ids - {row[0] for row in rows})
+    except Exception as e:
+        # The write itself is committed; a replica that missed it must not keep serving
+        stock_replica.invalidate(f"refresh after write failed: {str(e)}")
+
+STOCK_VERSION_BUMP = "UPDATE sync_state SET version = version + 1 WHERE name = 'stock'"
+CHANGE_LOG_INSERT = "INSERT INTO stock_changes (StockID, Op, ChangedColumns) VALUES (%s, %s, %s)"
+
+# Three single-row lookups (sync_state, the end of idx_stock_stamp_stockid, the end of the change-log
+# primary key), so a 304 costs no scan. Inserts and deletes made behind the server's back still move
+# the version, through the stock_after_insert/stock_after_delete triggers.
+STOCK_VERSION_QUERY = """
+    SELECT (SELECT version FROM sync_state WHERE name = 'stock'),
+           (SELECT MAX(Stamp) FROM stock),
+           (SELECT COALESCE(MAX(ChangeID), 0) FROM stock_changes)
+"""
+STOCK_VERSION_CHANGE_ID = 2  # Position of the change-log position in STOCK_VERSION_QUERY's row
+# Stats snapshots are only ever appended, so the newest Stamp (one lookup at the end of idx_stats_stamp)
+# identifies the table's contents without counting it
+STATS_VERSION_QUERY = "SELECT MAX(Stamp) FROM stats"
+CHANGE_POSITION_QUERY = "SELECT COALESCE(MAX(ChangeID), 0) FROM stock_changes"
+
+def bump_stock_version(cursor):
+    # Part of every stock write's transaction, so the ETag changes even when MAX(Stamp) doesn't
+    cursor.execute(STOCK_VERSION_BUMP)
+
+def change_log_rows(changes):
+    return [(stock_id, op, ','.join(columns)) for stock_id, op, columns in changes if columns]
+
+def record_stock_write(cursor, changes=()):
+    """Bumps the sync version and logs which columns each write touched; call just before commit.
+
+    changes is an iterable of (StockID, op, columns) with op 'insert' or 'update'. The sync_state row
+    lock taken by the bump is held until commit, so ChangeIDs are allocated and committed in the same
+    order and a delta reader can never skip past a ChangeID that is still uncommitted.
+    """
+    bump_stock_version(cursor)
+    rows = change_log_rows(changes)
+    if rows:
+        cursor.executemany(CHANGE_LOG_INSERT, rows)
+
+def get_stock_version():
     connection = get_db_connection()
-    cursor = connection.cursor()
-    cursor.execute("""
-        SELECT StockID, M_ID, F_ID, Family, Species, Subspecies, ThaiName, NameConcat, TableName, StockQty, StockPrice, 
-               Mother, Website, PlantedStart, PlantedEnd, PollinateDate, SeedsPlanted, SeedsHarvest, PlantStatus, Stamp, PlantDescription, 
-               StatusNote, PurchasePrice, TotalValue, USD, EUR, Photo1, Photo2, Photo3, Photo4, PhotoLink1, PhotoLink2, 
-               PhotoLink3, PhotoLink4, AddedBy, LastEditedBy, Weight, Grams, TraySize, TrayQty, Variegated
-        FROM stock 
-        WHERE Stamp > %s
-    """, (last_sync_time,))
-    
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(STOCK_VERSION_QUERY)
+            return cursor.fetchone()
+    finally:
+        connection.close()
+
+def get_stats_version():
+    connection = get_db_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(STATS_VERSION_QUERY)
+            return cursor.fetchone()
+    finally:
+        connection.close()
+
+def negotiated_encoding():
+    if request.endpoint not in COMPRESSED_ENDPOINTS:
+        return None
+    # Clients that send nothing or only "identity" (the Android app today) get the uncompressed body
+    return request.accept_encodings.best_match(available_encodings())
+
+def make_etag(*parts):
+    # The request path, query, wire format and content coding are part of the tag, so each representation has its own
+    parts = (request.full_path, negotiated_encoding(), negotiated_wire_format().mimetype) + parts
+    return hashlib.sha1('|'.join(str(part) for part in parts).encode('utf-8')).hexdigest()[:24]
+
+def not_modified(etag):
+    """Returns a 304 response if the client already holds this version of the data, otherwise None."""
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    return None
+
+def with_etag(response, etag):
+    if isinstance(response, Response) and response.status_code == 200:
+        response.set_etag(etag)
+        # Let clients keep the body but revalidate with If-None-Match on every use
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def conditional_stock_response(build_response):
+    """Serves a stock read with ETag/304 handling and the change-log cursor a client can continue from."""
+    if stock_replica is not None and stock_replica.ready:
+        version = stock_replica.version()
+    else:
+        version = get_stock_version()
+    etag = make_etag(*version)
+    response = not_modified(etag)
+    if response is None:
+        response = with_etag(build_response(), etag)
+    if isinstance(response, Response):
+        # Taken before the rows are read, so a delta sync from here replays rather than misses later writes
+        response.headers['X-Change-Cursor'] = encode_change_cursor(version[STOCK_VERSION_CHANGE_ID])
+    return response
+
+@app.after_request
+def compress_response(response):
+    encoding = negotiated_encoding()
+    if response.status_code == 200 and encoding is not None and 'Content-Encoding' not in response.headers:
+        # Wraps the body iterable, so streamed responses stay streamed and are compressed chunk by chunk
+        response.response = compress_chunks(response.response, encoding, COMPRESSION_LEVELS)
+        response.headers['Content-Encoding'] = encoding
+        response.headers.pop('Content-Length', None)
+    if request.endpoint in COMPRESSED_ENDPOINTS:
+        response.vary.add('Accept-Encoding')
+        response.vary.add('Accept')
+    return response
+
+def stream_rrhe_changes(last_sync_time, wire_format):
+    connection = get_db_connection()
+    # Unbuffered server-side cursor: rows are pulled from MySQL as the client consumes them
+    # instead of the whole result set being loaded into memory before the first byte goes out.
+    cursor = connection.cursor(pymysql.cursors.SSCursor)
+    try:
+        # A slow phone can leave the result set half-read for a while; don't let MySQL drop us
+        cursor.execute("SET SESSION net_write_timeout = %s", (STREAM_NET_WRITE_TIMEOUT,))
+        cursor.execute(STOCK_SELECT + "WHERE Stamp > %s", (last_sync_time,))
+    except Exception:
+        connection.discard()
+        raise
+
+    drained = [False]
+
     def generate():
-        yield '['
+        chunk = [wire_format.stream_prefix()]
+        chunk_size = len(chunk[0])
         first = True
-        for row in cursor:
-            if not first:
-                yield ','
-            first = False
-            try:
-                json_data = {
-                    'StockID': row[0],
-                    'M_ID': row[1],
-                    'F_ID': row[2],
-                    'Family': row[3],
-                    'Species': row[4],
-                    'Subspecies': row[5] if row[5] is not None else "",
-                    'ThaiName': sanitize_data(escape_special_characters(row[6])),
-                    'NameConcat': sanitize_data(escape_special_characters(row[7])),
-                    'TableName': sanitize_data(escape_special_characters(row[8])) if row[8] is not None else None,
-                    'StockQty': row[9],
-                    'StockPrice': float(row[10]) if row[10] is not None else None,
-                    'Mother': row[11],
-                    'Website': row[12],
-                    'PlantedStart': row[13].strftime('%Y-%m-%d') if row[13] is not None else None,
-                    'PlantedEnd': row[14].strftime('%Y-%m-%d') if row[14] is not None else None,
-                    'PollinateDate': row[15].strftime('%Y-%m-%d') if row[15] is not None else None,
-                    'SeedsPlanted': row[16].strftime('%Y-%m-%d') if row[16] is not None else None,
-                    'SeedsHarvest': row[17].strftime('%Y-%m-%d') if row[17] is not None else None,
-                    'PlantStatus': sanitize_data(escape_special_characters(row[18])),
-                    'Stamp': row[19].strftime('%Y-%m-%d %H:%M:%S'),
-                    'PlantDescription': sanitize_data(escape_special_characters(row[20])) if row[20] is not None else "",
-                    'StatusNote': sanitize_data(escape_special_characters(row[21])) if row[21] is not None else "",
-                    'PurchasePrice': float(row[22]) if row[22] is not None else None,
-                    'TotalValue': float(row[23]) if row[23] is not None else None,
-                    'USD': float(row[24]) if row[24] is not None else None,
-                    'EUR': float(row[25]) if row[25] is not None else None,
-                    'Photo1': sanitize_data(escape_special_characters(row[26])) if row[26] is not None else None,
-                    'Photo2': sanitize_data(escape_special_characters(row[27])) if row[27] is not None else None,
-                    'Photo3': sanitize_data(escape_special_characters(row[28])) if row[28] is not None else None,
-                    'Photo4': sanitize_data(escape_special_characters(row[29])) if row[29] is not None else None,
-                    'PhotoLink1': sanitize_data(escape_special_characters(row[30])) if row[30] is not None else None,
-                    'PhotoLink2': sanitize_data(escape_special_characters(row[31])) if row[31] is not None else None,
-                    'PhotoLink3': sanitize_data(escape_special_characters(row[32])) if row[32] is not None else None,
-                    'PhotoLink4': sanitize_data(escape_special_characters(row[33])) if row[33] is not None else None,
-                    'AddedBy': sanitize_data(escape_special_characters(row[34])) if row[34] is not None else None,
-                    'LastEditedBy': sanitize_data(escape_special_characters(row[35])),
-                    'Weight': row[36] if row[36] is not None else None,
-                    'Grams': row[37] if row[37] is not None else None,
-                    'TraySize': sanitize_data(escape_special_characters(row[38])) if row[38] is not None else None,
-                    'TrayQty': row[39],
-                    'Variegated': row[40]
-                }
-                if not validate_data(json_data):
-                    app.logger.error(f"Invalid data: {json_data}")
-                yield json.dumps(json_data)
-            except Exception as e:
-                app.logger.error(f"Error serializing row: {row}, Error: {str(e)}")
-                app.logger.error(f"Row data causing error: {json_data}")
-        yield ']'
-    
-    cursor.close()
-    connection.close()
-    
-    return Response(generate(), content_type='application/json; charset=utf-8')
+        while True:
+            rows = cursor.fetchmany(STREAM_FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                encoded = encode_stock_row(wire_format, row)
+                if encoded is None:
+                    continue
+                if not first:
+                    chunk.append(wire_format.separator)
+                    chunk_size += len(wire_format.separator)
+                first = False
+                chunk.append(encoded)
+                chunk_size += len(encoded)
+                if chunk_size >= STREAM_CHUNK_SIZE:
+                    yield b''.join(chunk)
+                    chunk = []
+                    chunk_size = 0
+        drained[0] = True
+        chunk.append(wire_format.stream_suffix())
+        yield b''.join(chunk)
+
+    def release():
+        # Called when the WSGI server closes the response: on completion, on client disconnect,
+        # and also when the body was never iterated at all (where a generator's finally wouldn't run)
+        if drained[0]:
+            cursor.close()
+            connection.close()
+        else:
+            # Rows may still be pending on the server, so the connection can't go back to the pool
+            app.logger.warning("Stream ended early (client disconnect or error), dropping MySQL connection")
+            connection.discard()
+
+    response = Response(generate(), content_type=wire_format.content_type)
+    response.call_on_close(release)
+    return response
+
+def stream_stock_rows(last_sync_time, wire_format):
+    """Rows with Stamp > last_sync_time, from the replica when it can answer, otherwise streamed from MySQL."""
+    if stock_replica is not None:
+        try:
+            stamp = datetime.fromisoformat(last_sync_time)
+        except (TypeError, ValueError):
+            stamp = None
+        if stamp is not None and stamp.tzinfo is not None:
+            stamp = None  # Leave zone-qualified timestamps to MySQL's own comparison
+        chunks = stock_replica.chunks_since(wire_format, stamp, STREAM_CHUNK_SIZE)
+        if chunks is not None:
+            return Response(chunks, content_type=wire_format.content_type)
+    return stream_rrhe_changes(last_sync_time, wire_format)
+
+def normalize_stamp(value):
+    # Accepts both 'yyyy-MM-dd HH:mm:ss' and the ISO 'T' form used by /rrhe
+    return datetime.fromisoformat(value).strftime('%Y-%m-%d %H:%M:%S')
+
+def encode_sync_cursor(stamp, stock_id):
+    raw = json.dumps([stamp, stock_id], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_sync_cursor(token):
+    padded = token + '=' * (-len(token) % 4)
+    stamp, stock_id = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    return normalize_stamp(stamp), int(stock_id)
+
+# Written as a range on the leading index column so MySQL can seek idx_stock_stamp_stockid
+CHANGES_PAGE_QUERY = STOCK_SELECT + """
+    WHERE Stamp >= %s AND (Stamp > %s OR StockID > %s)
+    ORDER BY Stamp, StockID
+    LIMIT %s
+"""
+
+def parse_changes_page_args(cursor_token, last_sync_time, limit):
+    """Returns (stamp, after_stock_id, limit) for a page request, or raises ValueError with the client-facing reason."""
+    try:
+        limit = int(limit) if limit is not None else CHANGES_PAGE_DEFAULT
+    except ValueError:
+        raise ValueError('limit must be an integer')
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    limit = min(limit, CHANGES_PAGE_MAX)
+
+    if not cursor_token and last_sync_time is None:
+        raise ValueError('Missing cursor or last_sync_time parameter')
+    try:
+        if cursor_token:
+            stamp, after_stock_id = decode_sync_cursor(cursor_token)
+        else:
+            # Starting from a plain timestamp keeps the old "Stamp > last_sync_time" semantics
+            stamp, after_stock_id = normalize_stamp(last_sync_time), CURSOR_END_OF_SECOND
+    except (ValueError, TypeError, UnicodeError):
+        raise ValueError('Invalid cursor')
+    return stamp, after_stock_id, limit
+
+def get_rrhe_changes_page(cursor_token, last_sync_time, limit, wire_format):
+    """Returns one page of the change feed ordered by (Stamp, StockID), plus the cursor to resume after it."""
+    try:
+        stamp, after_stock_id, limit = parse_changes_page_args(cursor_token, last_sync_time, limit)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    connection = get_db_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(CHANGES_PAGE_QUERY, (stamp, stamp, after_stock_id, limit + 1))
+            rows = cursor.fetchall()
+    except Exception as e:
+        app.logger.error(f"Error reading changes page: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+    finally:
+        connection.close()
+
+    return Response(changes_page_body(wire_format, rows, limit, stamp, after_stock_id),
+                    content_type=wire_format.content_type)
+
+def changes_page_body(wire_format, rows, limit, stamp, after_stock_id):
+    """Encodes a page read with LIMIT limit + 1; the extra row only tells whether there is more."""
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if rows:
+        last_row = rows[-1]
+        next_cursor = encode_sync_cursor(last_row[STOCK_COLUMN_INDEX['Stamp']].strftime('%Y-%m-%d %H:%M:%S'), last_row[0])
+    else:
+        next_cursor = encode_sync_cursor(stamp, after_stock_id)
+
+    encoded_rows = [encoded for encoded in (encode_stock_row(wire_format, row) for row in rows) if encoded is not None]
+    return wire_format.page_prefix() + wire_format.separator.join(encoded_rows) + \
+        wire_format.page_suffix(next_cursor, has_more)
 
 @app.route('/rrhe/changes', methods=['GET'])
 def get_rrhe_changes():
     last_sync_time = request.args.get('last_sync_time')
-    if last_sync_time is None:
+    cursor_token = request.args.get('cursor')
+    limit = request.args.get('limit')
+    if cursor_token is None and limit is None and last_sync_time is None:
         return jsonify({'error': 'Missing last_sync_time parameter'}), 400
-    return stream_rrhe_changes(last_sync_time)
+
+    if cursor_token is not None or limit is not None:
+        return conditional_stock_response(
+            lambda: get_rrhe_changes_page(cursor_token, last_sync_time, limit, negotiated_wire_format()))
+    return conditional_stock_response(lambda: stream_stock_rows(last_sync_time, negotiated_wire_format()))
+
+def encode_change_cursor(change_id):
+    return base64.urlsafe_b64encode(json.dumps(['c', change_id]).encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_change_cursor(token):
+    padded = token + '=' * (-len(token) % 4)
+    kind, change_id = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    if kind != 'c':
+        raise ValueError('Not a change-log cursor')
+    return int(change_id)
+
+@app.route('/rrhe/changes/delta', methods=['GET'])
+def get_rrhe_changes_delta():
+    """Field-level change feed: {StockID, changed columns...} per plant edited since the cursor.
+
+    Start from the X-Change-Cursor header of a /rrhe or /rrhe/changes response. Inserted plants are
+    sent in full; edits carry only the columns the change log recorded, with their current values;
+    removed plants are listed in "deleted". A cursor older than the retention window gets 410 and
+    the client has to do a full /rrhe resync.
+    """
+    cursor_token = request.args.get('cursor')
+    if not cursor_token:
+        return jsonify({'error': 'Missing cursor parameter'}), 400
+    try:
+        since = decode_change_cursor(cursor_token)
+        limit = int(request.args.get('limit', CHANGES_PAGE_DEFAULT))
+    except (ValueError, TypeError, UnicodeError):
+        return jsonify({'error': 'Invalid cursor or limit'}), 400
+    limit = max(1, min(limit, CHANGES_PAGE_MAX))
+
+    connection = get_db_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT version FROM sync_state WHERE name = 'changes_floor'")
+            floor = cursor.fetchone()[0]
+            if since < floor:
+                # Entries after this cursor have been pruned, so the delta would silently miss them
+                return jsonify({'error': 'Cursor too old, full resync required', 'resync_required': True}), 410
+
+            cursor.execute(CHANGE_LOG_PAGE_QUERY, (since, limit + 1))
+            log = cursor.fetchall()
+            has_more = len(log) > limit
+            log = log[:limit]
+            touched, deleted = merge_change_log(log)
+
+            rows = {}
+            if touched:
+                rows = {row[0]: row for row in read_stock_rows(cursor, touched)}
+    except Exception as e:
+        app.logger.error(f"Error reading change log: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+    finally:
+        connection.close()
+
+    return Response(delta_body(since, log, has_more, touched, deleted, rows), content_type='application/json; charset=utf-8')
+
+CHANGE_LOG_PAGE_QUERY = """
+    SELECT ChangeID, StockID, Op, ChangedColumns FROM stock_changes
+    WHERE ChangeID > %s ORDER BY ChangeID LIMIT %s
+"""
+
+def merge_change_log(log):
+    """Returns ({StockID: touched columns}, deleted StockIDs) for a page of change-log entries.
+
+    Several edits of one plant collapse into one entry with the union of their columns.
+    """
+    touched = {}
+    deleted = set()
+    for _, stock_id, op, changed in log:
+        if op == 'delete':
+            touched.pop(stock_id, None)
+            deleted.add(stock_id)
+            continue
+        deleted.discard(stock_id)
+        columns = touched.setdefault(stock_id, set())
+        if op == 'insert':
+            columns.add('*')
+        else:
+            columns.update(changed.split(','))
+    return touched, deleted
+
+def delta_body(since, log, has_more, touched, deleted, rows):
+    changes = []
+    for stock_id, columns in touched.items():
+        row = rows.get(stock_id)
+        if row is None:
+            continue  # Deleted after this page's log entries; its tombstone comes in a later page
+        try:
+            values = stock_serializer.to_dict(row)
+        except Exception as e:
+            app.logger.error(f"Error serializing row: {row}, Error: {str(e)}")
+            continue
+        if '*' in columns:
+            changes.append(values)
+        else:
+            entry = {'StockID': stock_id}
+            entry.update((column, values[column]) for column in STOCK_COLUMN_NAMES if column in columns)
+            changes.append(entry)
+
+    next_cursor = encode_change_cursor(log[-1][0] if log else since)
+    return stock_serializer.dumps({
+        'changes': changes,
+        'deleted': sorted(deleted),
+        'next_cursor': next_cursor,
+        'has_more': has_more
+    })
+
+# Columns written by /rrhe/update, in the order of update_stock_params()
+UPDATE_STOCK_COLUMNS = (
+    'Family', 'Species', 'Subspecies', 'NameConcat', 'StockQty', 'StockPrice', 'PurchasePrice', 'PlantDescription', 'ThaiName',
+    'M_ID', 'F_ID', 'PlantStatus', 'StatusNote', 'Mother', 'Website', 'Variegated', 'TableName', 'TraySize', 'Grams',
+    'TotalValue', 'USD', 'EUR', 'PlantedStart', 'PlantedEnd', 'PollinateDate', 'SeedsPlanted', 'SeedsHarvest',
+    'PhotoLink1', 'PhotoLink2', 'PhotoLink3', 'PhotoLink4', 'LastEditedBy', 'AddedBy', 'Stamp'
+)
+UPDATE_STAMP_INDEX = UPDATE_STOCK_COLUMNS.index('Stamp')
+
+UPDATE_STOCK_QUERY = "UPDATE stock SET " + ", ".join(f"{column}=%s" for column in UPDATE_STOCK_COLUMNS) + " WHERE StockID=%s"
+
+def read_update_columns(cursor, stock_ids, for_update=False):
+    """Returns {StockID: values of UPDATE_STOCK_COLUMNS} for the given plants, optionally row-locked."""
+    cursor.execute(update_columns_query(len(stock_ids), for_update), list(stock_ids))
+    return {row[0]: row[1:] for row in cursor.fetchall()}
+
+def update_columns_query(count, for_update=False):
+    placeholders = ','.join(['%s'] * count)
+    return (f"SELECT StockID, {', '.join(UPDATE_STOCK_COLUMNS)} FROM stock WHERE StockID IN ({placeholders})"
+            + (" FOR UPDATE" if for_update else ""))
+
+def changed_update_columns(before, after):
+    return [column for column, old, new in zip(UPDATE_STOCK_COLUMNS, before, after) if old != new]
+
+def update_stock_params(data, incoming_stamp, stock_id):
+    return (data.get('Family'), data.get('Species'), data.get('Subspecies'), data.get('NameConcat'),
+            data.get('StockQty'), data.get('StockPrice'), data.get('PurchasePrice'), data.get('PlantDescription'),
+            data.get('ThaiName'), data.get('M_ID'), data.get('F_ID'), data.get('PlantStatus'), data.get('StatusNote'),
+            data.get('Mother'), data.get('Website'), data.get('Variegated'), data.get('TableName'), data.get('TraySize'), data.get('Grams'),
+            data.get('TotalValue'), data.get('USD'), data.get('EUR'), data.get('PlantedStart'), data.get('PlantedEnd'),
+            data.get('PollinateDate'), data.get('SeedsPlanted'), data.get('SeedsHarvest'), data.get('PhotoLink1'),
+            data.get('PhotoLink2'), data.get('PhotoLink3'), data.get('PhotoLink4'), data.get('LastEditedBy'), data.get('AddedBy'), incoming_stamp, stock_id)
+
+def as_datetime(stamp):
+    if isinstance(stamp, str):
+        return datetime.strptime(stamp, '%Y-%m-%d %H:%M:%S')
+    return stamp
+
+def current_change_position():
+    """The notifier's position, read from MySQL once if no write has been published yet."""
+    if change_notifier.change_id is None:
+        connection = get_db_connection()
+        try:
+            with connection.cursor() as cursor:
+                change_notifier.publish(read_change_position(cursor))
+        finally:
+            connection.close()
+    return change_notifier.change_id
+
+def watch_event_stream(since):
+    deadline = time.monotonic() + WATCH_STREAM_DURATION
+
+    def generate():
+        position = since
+        # Tells EventSource clients how long to wait before reconnecting after the stream ends
+        yield b'retry: 5000\n\n'
+        while time.monotonic() < deadline:
+            timeout = min(WATCH_HEARTBEAT_INTERVAL, deadline - time.monotonic())
+            current = change_notifier.wait(position, timeout)
+            if current is not None and current > position:
+                position = current
+                data = json.dumps({'cursor': encode_change_cursor(position), 'change_id': position})
+                yield f"id: {encode_change_cursor(position)}\nevent: change\ndata: {data}\n\n".encode('utf-8')
+            else:
+                yield b': keep-alive\n\n'
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # Stop nginx from holding events back in its buffer
+    return response
+
+@app.route('/rrhe/watch', methods=['GET'])
+def watch_rrhe():
+    """Waits for stock writes after ?cursor= (an X-Change-Cursor / delta cursor) instead of polling /rrhe/changes.
+
+    With Accept: text/event-stream this is a server-sent event stream with one "change" event per
+    new position; otherwise it is a long-poll that answers {"changed", "cursor"} as soon as a write
+    commits, or with changed=false after ?timeout= seconds. Either way, follow up with
+    /rrhe/changes/delta from the old cursor to fetch what changed. Without a cursor, watching starts
+    from the current position. SSE reconnects send Last-Event-ID, which is used as the cursor.
+    """
+    cursor_token = request.args.get('cursor') or request.headers.get('Last-Event-ID')
+    try:
+        since = decode_change_cursor(cursor_token) if cursor_token else None
+        timeout = min(float(request.args.get('timeout', WATCH_DEFAULT_TIMEOUT)), WATCH_MAX_TIMEOUT)
+    except (ValueError, TypeError, UnicodeError):
+        return jsonify({'error': 'Invalid cursor or timeout'}), 400
+
+    current = current_change_position()
+    if since is None:
+        since = current
+
+    if request.accept_mimetypes.best == 'text/event-stream':
+        return watch_event_stream(since)
+
+    if current <= since:
+        current = change_notifier.wait(since, max(timeout, 0))
+    changed = current > since
+    return jsonify({'changed': changed, 'cursor': encode_change_cursor(current if changed else since)}), 200
+
+@app.route('/rrhe/watch/stats', methods=['GET'])
+def get_watch_stats():
+    return jsonify(change_notifier.stats()), 200
 
 @app.route('/rrhe/update', methods=['POST'])
 def update_rrhe():
@@ -204,34 +715,26 @@ def update_rrhe():
     connection = get_db_connection()
     try:
         with connection.cursor() as cursor:
-            cursor.execute("SELECT Stamp FROM stock WHERE StockID = %s", (stock_id,))
-            result = cursor.fetchone()
+            # Locks the row and keeps its old values so the change log can record exactly what changed
+            before = next(iter(read_update_columns(cursor, [stock_id], for_update=True).values()), None)
 
-            if result:
-                current_stamp = result[0]
-                if isinstance(current_stamp, str):
-                    current_stamp = datetime.strptime(current_stamp, '%Y-%m-%d %H:%M:%S')
+            if before:
+                current_stamp = as_datetime(before[UPDATE_STAMP_INDEX])
 
                 if current_stamp >= incoming_stamp:
                     return jsonify({'error': 'A more recent update already exists'}), 409
 
             # Proceed with the update if the current stamp is older than the new stamp
-            cursor.execute("""
-                UPDATE stock
-                SET Family=%s, Species=%s, Subspecies=%s, NameConcat=%s, StockQty=%s, StockPrice=%s, PurchasePrice=%s, PlantDescription=%s, ThaiName=%s, 
-                    M_ID=%s, F_ID=%s, PlantStatus=%s, StatusNote=%s, Mother=%s, Website=%s, Variegated=%s, TableName=%s, TraySize=%s, Grams=%s, 
-                    TotalValue=%s, USD=%s, EUR=%s, PlantedStart=%s, PlantedEnd=%s, PollinateDate=%s, SeedsPlanted=%s, SeedsHarvest=%s,
-                    PhotoLink1=%s, PhotoLink2=%s, PhotoLink3=%s, PhotoLink4=%s, LastEditedBy=%s, AddedBy=%s, Stamp=%s
-                WHERE StockID=%s
-            """, (data.get('Family'), data.get('Species'), data.get('Subspecies'), data.get('NameConcat'),
-                  data.get('StockQty'), data.get('StockPrice'), data.get('PurchasePrice'), data.get('PlantDescription'),
-                  data.get('ThaiName'), data.get('M_ID'), data.get('F_ID'), data.get('PlantStatus'), data.get('StatusNote'),
-                  data.get('Mother'), data.get('Website'), data.get('Variegated'), data.get('TableName'), data.get('TraySize'), data.get('Grams'),
-                  data.get('TotalValue'), data.get('USD'), data.get('EUR'), data.get('PlantedStart'), data.get('PlantedEnd'),
-                  data.get('PollinateDate'), data.get('SeedsPlanted'), data.get('SeedsHarvest'), data.get('PhotoLink1'),
-                  data.get('PhotoLink2'), data.get('PhotoLink3'), data.get('PhotoLink4'), data.get('LastEditedBy'), data.get('AddedBy'), incoming_stamp, stock_id))
+            cursor.execute(UPDATE_STOCK_QUERY, update_stock_params(data, incoming_stamp, stock_id))
 
+            changes = []
+            if before:
+                after = next(iter(read_update_columns(cursor, [stock_id]).values()), None)
+                if after:
+                    changes.append((stock_id, 'update', changed_update_columns(before, after)))
+            record_stock_write(cursor, changes)
             connection.commit()
+            after_stock_commit(cursor, [stock_id])
             app.logger.debug(f"Plant updated successfully for StockID: {stock_id}")
             return jsonify({'message': 'Plant updated successfully'}), 200
     except Exception as e:
@@ -241,6 +744,88 @@ def update_rrhe():
     finally:
         connection.close()
 
+@app.route('/rrhe/update/batch', methods=['POST'])
+def update_rrhe_batch():
+    """Applies a list of offline edits in one transaction and reports applied/conflict/error per entry.
+
+    Each entry is judged by the same Stamp rule as /rrhe/update: it is only applied if it is newer than
+    the stored row (or than an earlier entry for the same StockID in this batch).
+    """
+    data = request.json
+    updates = data.get('updates') if isinstance(data, dict) else data
+    if not updates or not isinstance(updates, list):
+        return jsonify({'error': 'Expected a non-empty list of updates'}), 400
+    if len(updates) > MAX_BATCH_UPDATES:
+        return jsonify({'error': f'At most {MAX_BATCH_UPDATES} updates per batch'}), 413
+    app.logger.debug(f"Received batch update request with {len(updates)} entries")
+
+    results = [None] * len(updates)
+    pending = []  # (index, stock_id, incoming_stamp, entry) that passed validation
+    for index, entry in enumerate(updates):
+        stock_id = entry.get('StockID') if isinstance(entry, dict) else None
+        stamp_str = entry.get('Stamp') if isinstance(entry, dict) else None
+        if not stock_id or not stamp_str:
+            results[index] = {'StockID': stock_id, 'status': 'error', 'error': 'StockID and Stamp are required'}
+            continue
+        try:
+            stock_id = int(stock_id)
+        except (TypeError, ValueError):
+            results[index] = {'StockID': stock_id, 'status': 'error', 'error': 'StockID must be an integer'}
+            continue
+        try:
+            incoming_stamp = datetime.strptime(stamp_str, '%Y-%m-%d %H:%M:%S')
+        except (TypeError, ValueError):
+            results[index] = {'StockID': stock_id, 'status': 'error',
+                              'error': 'Invalid Stamp format. Expected yyyy-MM-dd HH:mm:ss'}
+            continue
+        pending.append((index, stock_id, incoming_stamp, entry))
+
+    connection = get_db_connection()
+    try:
+        with connection.cursor() as cursor:
+            applied_params = []
+            applied_ids = []
+            if pending:
+                stock_ids = sorted({stock_id for _, stock_id, _, _ in pending})
+                # One round trip for every current row; FOR UPDATE keeps them valid until commit
+                before = read_update_columns(cursor, stock_ids, for_update=True)
+                current_stamps = {stock_id: as_datetime(values[UPDATE_STAMP_INDEX]) for stock_id, values in before.items()}
+
+                for index, stock_id, incoming_stamp, entry in pending:
+                    if stock_id not in current_stamps:
+                        results[index] = {'StockID': stock_id, 'status': 'error', 'error': 'StockID not found'}
+                    elif current_stamps[stock_id] >= incoming_stamp:
+                        results[index] = {'StockID': stock_id, 'status': 'conflict',
+                                          'error': 'A more recent update already exists'}
+                    else:
+                        applied_params.append(update_stock_params(entry, incoming_stamp, stock_id))
+                        # A later entry for the same plant must be newer than this one to win
+                        current_stamps[stock_id] = incoming_stamp
+                        results[index] = {'StockID': stock_id, 'status': 'applied'}
+
+            if applied_params:
+                cursor.executemany(UPDATE_STOCK_QUERY, applied_params)
+                applied_ids = sorted({params[-1] for params in applied_params})
+                after = read_update_columns(cursor, applied_ids)
+                record_stock_write(cursor, [
+                    (stock_id, 'update', changed_update_columns(before[stock_id], after[stock_id]))
+                    for stock_id in applied_ids if stock_id in after
+                ])
+            connection.commit()
+            if applied_ids:
+                after_stock_commit(cursor, applied_ids)
+    except Exception as e:
+        connection.rollback()
+        app.logger.error(f"Error applying batch update: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+    finally:
+        connection.close()
+
+    counts = {status: sum(1 for result in results if result['status'] == status)
+              for status in ('applied', 'conflict', 'error')}
+    app.logger.debug(f"Batch update finished: {counts}")
+    return jsonify({'results': results, **counts}), 200
+
 def handle_value(value):
     if isinstance(value, str):
         if value == "":
@@ -249,6 +834,203 @@ def handle_value(value):
         return value.replace("'", "''")
     return value
 
+INSERT_STOCK_QUERY = """
+    INSERT INTO stock (
+        StockID, M_ID, F_ID, Family, Species, Subspecies, ThaiName, NameConcat, TableName, StockQty, StockPrice,
+        Mother, Website, PlantedStart, PlantedEnd, PollinateDate, SeedsPlanted, SeedsHarvest, PlantStatus,
+        PlantDescription, StatusNote, PurchasePrice, TotalValue, USD, EUR, Photo1, Photo2, Photo3, Photo4,
+        PhotoLink1, PhotoLink2, PhotoLink3, PhotoLink4, AddedBy, LastEditedBy, Weight, Grams, TraySize, TrayQty, Variegated, Stamp
+    ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
+"""
+
+def update_photos_query(photo_columns):
+    # Only the renamed columns: a photo the client set after the insert became visible is left alone
+    assignments = ', '.join(f"{column} = %s" for column in photo_columns)
+    return f"UPDATE stock SET {assignments} WHERE StockID = %s"
+
+def insert_stock_values(data, new_stock_id):
+    # Convert empty strings to None, and properly handle strings and None values
+    return tuple(handle_value(val) for val in (
+        new_stock_id,  # Use new generated StockID
+        data.get('M_ID'),
+        data.get('F_ID'),
+        data.get('Family'),
+        data.get('Species'),
+        data.get('Subspecies'),
+        data.get('ThaiName'),
+        data.get('NameConcat'),
+        data.get('TableName'),
+        data.get('StockQty'),
+        data.get('StockPrice'),
+        1 if data.get('Mother') else 0,
+        1 if data.get('Website') else 0,
+        data.get('PlantedStart'),
+        data.get('PlantedEnd'),
+        data.get('PollinateDate'),
+        data.get('SeedsPlanted'),
+        data.get('SeedsHarvest'),
+        data.get('PlantStatus'),
+        data.get('PlantDescription'),
+        data.get('StatusNote'),
+        data.get('PurchasePrice'),
+        data.get('TotalValue'),
+        data.get('USD'),
+        data.get('EUR'),
+        None, None, None, None,  # Photo columns will be updated after renaming
+        data.get('PhotoLink1'),
+        data.get('PhotoLink2'),
+        data.get('PhotoLink3'),
+        data.get('PhotoLink4'),
+        data.get('AddedBy'),
+        data.get('LastEditedBy'),
+        data.get('Weight'),
+        data.get('Grams'),
+        data.get('TraySize'),
+        data.get('TrayQty'),
+        1 if data.get('Variegated') else 0,
+        data.get('Stamp')
+    ))
+
+def reserve_sequence_ids(name, count):
+    """Advances the id_sequences row name by count and returns the first ID of the reserved range."""
+    connection = get_db_connection()
+    try:
+        with connection.cursor() as cursor:
+            # Single-row atomic increment committed on its own, so the row lock is held for microseconds
+            # instead of for a whole insert (the old SELECT MAX(StockID) ... FOR UPDATE serialized every insert)
+            cursor.execute("UPDATE id_sequences SET next_id = LAST_INSERT_ID(next_id + %s) WHERE name = %s",
+                           (count, name))
+            cursor.execute("SELECT LAST_INSERT_ID()")
+            end = cursor.fetchone()[0]
+        connection.commit()
+        return end - count
+    finally:
+        connection.close()
+
+def reserve_stock_ids(count):
+    return reserve_sequence_ids('stock', count)
+
+stock_id_allocator = BlockIdAllocator(reserve_stock_ids, block_size=STOCK_ID_BLOCK_SIZE)
+
+photo_versions = PhotoVersions()
+photo_store = PhotoStore(PHOTO_FOLDER, PHOTO_STORE_DIR)  # Shared with http_server, which writes the photos
+
+def rename_temp_photos(temp_stock_id, new_stock_id):
+    """Renames {temp}_n.jpg to {new}_n.jpg and returns the new Photo column URLs keyed by column.
+
+    Safe to repeat: photos already renamed by an interrupted earlier call are picked up as they are.
+    """
+    photo_folder = photo_store.photo_dir
+    photos_to_rename = {
+        'Photo1': f"{temp_stock_id}_1.jpg",
+        'Photo2': f"{temp_stock_id}_2.jpg",
+        'Photo3': f"{temp_stock_id}_3.jpg",
+        'Photo4': f"{temp_stock_id}_4.jpg"
+    }
+
+    updated_photo_urls = {}
+
+    for photo_column, old_filename in photos_to_rename.items():
+        new_filename = f"{new_stock_id}_{old_filename.split('_')[1]}"
+        old_filepath = os.path.join(photo_folder, old_filename)
+        new_filepath = os.path.join(photo_folder, new_filename)
+
+        if os.path.exists(old_filepath):
+            photo_store.rename(old_filename, new_filename)
+            app.logger.debug(f"Renamed {old_filepath} to {new_filepath}")
+        if os.path.exists(new_filepath):
+            # Also reached when an earlier attempt renamed the file but crashed before the UPDATE
+            updated_photo_urls[photo_column] = versioned_url(
+                f"http://183.88.230.187:55004/{new_filename}", photo_versions.version(new_filepath))
+        else:
+            app.logger.warning(f"File {old_filepath} does not exist, skipping renaming.")
+
+    return updated_photo_urls
+
+PHOTO_RENAME_JOB_INSERT = "INSERT INTO photo_rename_jobs (NewStockID, TempStockID) VALUES (%s, %s)"
+
+photo_rename_wakeup = threading.Event()  # Set after an insert commits a job, so it's applied right away
+
+def apply_photo_rename_jobs(limit):
+    """Renames the photos of up to limit pending jobs and sets their Photo columns in one transaction.
+
+    A job row is written in the same transaction as its plant and deleted in the same transaction as
+    its Photo columns, so a crash at any point leaves the job to be finished by the next pass.
+    A job that failed PHOTO_RENAME_MAX_ATTEMPTS times is skipped; its LastError says why.
+    Returns the number of jobs completed.
+    """
+    connection = get_db_connection()
+    try:
+        with connection.cursor() as cursor:
+            # FOR UPDATE keeps a second server process from working on the same jobs meanwhile
+            cursor.execute("""
+                SELECT NewStockID, TempStockID, Attempts FROM photo_rename_jobs
+                WHERE Attempts < %s
+                ORDER BY NewStockID LIMIT %s FOR UPDATE
+            """, (PHOTO_RENAME_MAX_ATTEMPTS, limit))
+            renamed = {}
+            for new_stock_id, temp_stock_id, attempts in cursor.fetchall():
+                try:
+                    renamed[new_stock_id] = rename_temp_photos(temp_stock_id, new_stock_id)
+                except Exception as e:
+                    app.logger.error(f"Error renaming photos of {temp_stock_id} to {new_stock_id}: {str(e)}")
+                    if attempts + 1 >= PHOTO_RENAME_MAX_ATTEMPTS:
+                        app.logger.error(f"Giving up on photo rename job for {new_stock_id} "
+                                         f"after {PHOTO_RENAME_MAX_ATTEMPTS} attempts")
+                    cursor.execute("""
+                        UPDATE photo_rename_jobs SET Attempts = Attempts + 1, LastError = %s WHERE NewStockID = %s
+                    """, (str(e)[:255], new_stock_id))
+
+            with_photos = {new_id: photo_urls for new_id, photo_urls in renamed.items() if photo_urls}
+            if with_photos:
+                for new_id, photo_urls in with_photos.items():
+                    photo_columns = sorted(photo_urls)
+                    cursor.execute(update_photos_query(photo_columns),
+                                   [photo_urls[column] for column in photo_columns] + [new_id])
+                record_stock_write(cursor, [(new_id, 'update', list(photo_urls))
+                                            for new_id, photo_urls in with_photos.items()])
+            if renamed:
+                cursor.executemany("DELETE FROM photo_rename_jobs WHERE NewStockID = %s",
+                                   [(new_id,) for new_id in renamed])
+            connection.commit()
+            if with_photos:
+                after_stock_commit(cursor, sorted(with_photos))
+                app.logger.debug(f"Photo columns updated for StockIDs: {sorted(with_photos)}")
+            return len(renamed)
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+def start_photo_rename_worker():
+    """Applies photo rename jobs in the background; its first pass finishes any a crash left behind.
+
+    Returns a function that stops the worker once its current pass is done.
+    """
+    stopping = threading.Event()
+
+    def run():
+        while not stopping.is_set():
+            try:
+                while apply_photo_rename_jobs(PHOTO_RENAME_BATCH_SIZE) == PHOTO_RENAME_BATCH_SIZE:
+                    if stopping.is_set():
+                        return
+            except Exception as e:
+                app.logger.error(f"Error applying photo rename jobs: {str(e)}")
+            photo_rename_wakeup.wait(PHOTO_RENAME_INTERVAL)
+            photo_rename_wakeup.clear()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+
+    def stop():
+        stopping.set()
+        photo_rename_wakeup.set()
+        thread.join()
+
+    return stop
+
 @app.route('/rrhe/insert', methods=['POST'])
 def insert_new_plant():
     data = request.json
@@ -261,117 +1043,26 @@ def insert_new_plant():
     if temp_stock_id is None or temp_stock_id >= 0:
         return jsonify({'error': 'Invalid or missing negative StockID'}), 400
 
+    # Before checking out this request's connection: a block refill needs a pooled connection of its own
+    new_stock_id = stock_id_allocator.allocate()[0]
+    app.logger.debug(f"Generated new StockID: {new_stock_id}")
+
     connection = get_db_connection()
     try:
         with connection.cursor() as cursor:
-            # Start the transaction
-            cursor.execute("BEGIN;")
-
-            # Lock the table by selecting MAX(StockID) with FOR UPDATE to prevent concurrent inserts
-            cursor.execute("SELECT MAX(StockID) FROM stock FOR UPDATE;")
-            max_stock_id = cursor.fetchone()[0]
-
-            new_stock_id = (max_stock_id or 0) + 1  # Generate the next StockID
-            app.logger.debug(f"Generated new StockID: {new_stock_id}")
-
-            # Convert empty strings to None, and properly handle strings and None values
-            values = tuple(handle_value(val) for val in (
-                new_stock_id,  # Use new generated StockID
-                data.get('M_ID'),
-                data.get('F_ID'),
-                data.get('Family'),
-                data.get('Species'),
-                data.get('Subspecies'),
-                data.get('ThaiName'),
-                data.get('NameConcat'),
-                data.get('TableName'),
-                data.get('StockQty'),
-                data.get('StockPrice'),
-                1 if data.get('Mother') else 0,
-                1 if data.get('Website') else 0,
-                data.get('PlantedStart'),
-                data.get('PlantedEnd'),
-                data.get('PollinateDate'),
-                data.get('SeedsPlanted'),
-                data.get('SeedsHarvest'),
-                data.get('PlantStatus'),
-                data.get('PlantDescription'),
-                data.get('StatusNote'),
-                data.get('PurchasePrice'),
-                data.get('TotalValue'),
-                data.get('USD'),
-                data.get('EUR'),
-                None, None, None, None,  # Photo columns will be updated after renaming
-                data.get('PhotoLink1'),
-                data.get('PhotoLink2'),
-                data.get('PhotoLink3'),
-                data.get('PhotoLink4'),
-                data.get('AddedBy'),
-                data.get('LastEditedBy'),
-                data.get('Weight'),
-                data.get('Grams'),
-                data.get('TraySize'),
-                data.get('TrayQty'),
-                1 if data.get('Variegated') else 0,
-                data.get('Stamp')
-            ))
-
+            values = insert_stock_values(data, new_stock_id)
             app.logger.debug(f"Prepared values: {values}")
 
-            # Execute the insert query
-            insert_query = """
-                INSERT INTO stock (
-                    StockID, M_ID, F_ID, Family, Species, Subspecies, ThaiName, NameConcat, TableName, StockQty, StockPrice,
-                    Mother, Website, PlantedStart, PlantedEnd, PollinateDate, SeedsPlanted, SeedsHarvest, PlantStatus,
-                    PlantDescription, StatusNote, PurchasePrice, TotalValue, USD, EUR, Photo1, Photo2, Photo3, Photo4,
-                    PhotoLink1, PhotoLink2, PhotoLink3, PhotoLink4, AddedBy, LastEditedBy, Weight, Grams, TraySize, TrayQty, Variegated, Stamp
-                ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-            """
-            cursor.execute(insert_query, values)
+            # Execute the insert query; the photo rename job commits with the plant, so neither exists without the other
+            cursor.execute(INSERT_STOCK_QUERY, values)
+            cursor.execute(PHOTO_RENAME_JOB_INSERT, (new_stock_id, temp_stock_id))
+            record_stock_write(cursor, [(new_stock_id, 'insert', ['*'])])
             connection.commit()  # Commit the transaction
+            after_stock_commit(cursor, [new_stock_id])
+            photo_rename_wakeup.set()
 
             app.logger.debug(f"New plant inserted successfully with StockID: {new_stock_id}")
 
-            # Renaming the photo files from tempStockID (negative StockID) to {new_stock_id}
-            photo_folder = "/home/mcmeister/Documents/GDrive_Photos/"
-            photos_to_rename = {
-                'Photo1': f"{temp_stock_id}_1.jpg",
-                'Photo2': f"{temp_stock_id}_2.jpg",
-                'Photo3': f"{temp_stock_id}_3.jpg",
-                'Photo4': f"{temp_stock_id}_4.jpg"
-            }
-
-            updated_photo_urls = {}
-
-            for photo_column, old_filename in photos_to_rename.items():
-                new_filename = f"{new_stock_id}_{old_filename.split('_')[1]}"
-                old_filepath = os.path.join(photo_folder, old_filename)
-                new_filepath = os.path.join(photo_folder, new_filename)
-
-                if os.path.exists(old_filepath):
-                    os.rename(old_filepath, new_filepath)
-                    updated_photo_urls[photo_column] = f"http://183.88.230.187:55004/{new_stock_id}_{old_filename.split('_')[1]}"
-                    app.logger.debug(f"Renamed {old_filepath} to {new_filepath}")
-                else:
-                    app.logger.warning(f"File {old_filepath} does not exist, skipping renaming.")
-
-            # Update the photo columns in the database for the newly inserted plant
-            update_photos_query = """
-                UPDATE stock
-                SET Photo1 = %s, Photo2 = %s, Photo3 = %s, Photo4 = %s
-                WHERE StockID = %s
-            """
-            cursor.execute(update_photos_query, (
-                updated_photo_urls.get('Photo1'),
-                updated_photo_urls.get('Photo2'),
-                updated_photo_urls.get('Photo3'),
-                updated_photo_urls.get('Photo4'),
-                new_stock_id
-            ))
-
-            connection.commit()
-            app.logger.debug(f"Photo columns updated for StockID: {new_stock_id}")
-
             # Fetch the inserted plant's data to return
             cursor.execute("SELECT * FROM stock WHERE StockID = %s", (new_stock_id,))
             updated_plant = cursor.fetchone()
@@ -393,6 +1084,57 @@ def insert_new_plant():
     finally:
         connection.close()
 
+@app.route('/rrhe/insert/batch', methods=['POST'])
+def insert_new_plants_batch():
+    """Inserts several offline-created plants at once and returns the temp (negative) to real StockID mapping."""
+    data = request.json
+    plants = data.get('plants') if isinstance(data, dict) else data
+    if not plants or not isinstance(plants, list):
+        return jsonify({'error': 'Expected a non-empty list of plants'}), 400
+    if len(plants) > MAX_BATCH_UPDATES:
+        return jsonify({'error': f'At most {MAX_BATCH_UPDATES} plants per batch'}), 413
+
+    temp_stock_ids = [plant.get('StockID') if isinstance(plant, dict) else None for plant in plants]
+    if any(not isinstance(temp_id, int) or temp_id >= 0 for temp_id in temp_stock_ids):
+        return jsonify({'error': 'Every plant needs a negative temporary StockID'}), 400
+    if len(set(temp_stock_ids)) != len(temp_stock_ids):
+        return jsonify({'error': 'Temporary StockIDs must be unique within a batch'}), 400
+    app.logger.debug(f"Received batch insert request with {len(plants)} plants")
+
+    # One sequence round trip for the whole batch, made before this request holds a connection
+    new_stock_ids = stock_id_allocator.allocate(len(plants))
+    id_map = dict(zip(temp_stock_ids, new_stock_ids))
+
+    connection = get_db_connection()
+    try:
+        with connection.cursor() as cursor:
+            # pymysql sends this as a single multi-row INSERT
+            cursor.executemany(INSERT_STOCK_QUERY, [
+                insert_stock_values(plant, new_stock_id) for plant, new_stock_id in zip(plants, new_stock_ids)
+            ])
+            cursor.executemany(PHOTO_RENAME_JOB_INSERT, [(new_id, temp_id) for temp_id, new_id in id_map.items()])
+            record_stock_write(cursor, [(new_stock_id, 'insert', ['*']) for new_stock_id in new_stock_ids])
+            connection.commit()
+            after_stock_commit(cursor, new_stock_ids)
+            photo_rename_wakeup.set()
+            app.logger.debug(f"Inserted {len(plants)} plants: {id_map}")
+
+            placeholders = ','.join(['%s'] * len(new_stock_ids))
+            cursor.execute(f"SELECT * FROM stock WHERE StockID IN ({placeholders}) ORDER BY StockID", new_stock_ids)
+            columns = [desc[0] for desc in cursor.description]
+            inserted = [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+            return jsonify({
+                'id_map': {str(temp_id): new_id for temp_id, new_id in id_map.items()},
+                'plants': inserted
+            }), 201
+    except Exception as e:
+        connection.rollback()
+        app.logger.error(f"Error inserting batch of new plants: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+    finally:
+        connection.close()
+
 @app.route('/update_photo_column', methods=['POST'])
 def update_photo_column():
     data = request.json
@@ -414,7 +1156,12 @@ def update_photo_column():
             SET {photo_column} = %s
             WHERE StockID = %s
         """, (photo_url, stock_id))
+        # rowcount only counts rows whose value actually changed
+        changed = cursor.rowcount
+        record_stock_write(cursor, [(stock_id, 'update', [photo_column])] if changed else [])
         connection.commit()
+        if changed:
+            after_stock_commit(cursor, [stock_id])
         app.logger.debug(f"Updated {photo_column} for StockID: {stock_id} with URL: {photo_url}")
     except Exception as e:
         connection.rollback()
@@ -427,43 +1174,420 @@ def update_photo_column():
     connection.close()
     return jsonify({'message': f'{photo_column} updated successfully for StockID {stock_id}'}), 200
 
+PHOTO_COLUMNS = ('Photo1', 'Photo2', 'Photo3', 'Photo4')
+
+def parse_photo_updates(data):
+    """Validates a /update_photo_column/batch body into (stock_id, column, url) tuples; raises ValueError."""
+    updates = data.get('updates') if isinstance(data, dict) else data
+    if not updates or not isinstance(updates, list):
+        raise ValueError('Expected a non-empty list of updates')
+    if len(updates) > MAX_BATCH_UPDATES:
+        raise ValueError(f'At most {MAX_BATCH_UPDATES} updates per batch')
+    parsed = []
+    for entry in updates:
+        if not isinstance(entry, dict) or not entry.get('stockID') or not entry.get('photoIndex'):
+            raise ValueError('StockID and photoIndex are required')
+        photo_column = f"Photo{entry['photoIndex']}"
+        if photo_column not in PHOTO_COLUMNS:
+            raise ValueError(f"Invalid photoIndex {entry['photoIndex']}")
+        parsed.append((entry['stockID'], photo_column, entry.get('photoUrl')))
+    return parsed
+
+@app.route('/update_photo_column/batch', methods=['POST'])
+def update_photo_column_batch():
+    """Sets several Photo columns in one transaction; used by http_server's photo update queue."""
+    try:
+        updates = parse_photo_updates(request.json)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    connection = get_db_connection()
+    try:
+        with connection.cursor() as cursor:
+            writes = []
+            for stock_id, photo_column, photo_url in updates:
+                # rowcount only counts rows whose value actually changed
+                if cursor.execute(f"UPDATE stock SET {photo_column} = %s WHERE StockID = %s", (photo_url, stock_id)):
+                    writes.append((stock_id, 'update', [photo_column]))
+            record_stock_write(cursor, writes)
+            connection.commit()
+            if writes:
+                after_stock_commit(cursor, sorted({stock_id for stock_id, _, _ in writes}))
+        app.logger.debug(f"Applied {len(updates)} photo column updates, {len(writes)} changed")
+    except Exception as e:
+        connection.rollback()
+        app.logger.error(f"Error applying batch of photo column updates: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+    finally:
+        connection.close()
+
+    return jsonify({'message': f'{len(updates)} photo columns updated', 'changed': len(writes)}), 200
+
 @app.route('/rrhe', methods=['GET'])
 def get_rrhe():
-    return stream_rrhe_changes("1970-01-01T00:00:00")
+    return conditional_stock_response(lambda: stream_stock_rows("1970-01-01T00:00:00", negotiated_wire_format()))
+
+STATS_METRICS = ('TotalRows', 'TotalPlants', 'TotalNonM', 'TotalM', 'NonMValue', 'MValue', 'TotalValue',
+                 'WebPlants', 'WebQty', 'WebValue', 'USD', 'EUR')
+# Counts, declared Int in the app's Stats model, so a flattened avg has to be a whole number too
+STATS_COUNT_METRICS = ('TotalRows', 'TotalPlants', 'TotalNonM', 'TotalM', 'WebPlants', 'WebQty')
+
+# First day of the bucket a snapshot falls in; weeks start on Monday
+STATS_BUCKETS = {
+    'day': "DATE(Stamp)",
+    'week': "DATE_SUB(DATE(Stamp), INTERVAL WEEKDAY(Stamp) DAY)",
+    'month': "DATE_SUB(DATE(Stamp), INTERVAL DAYOFMONTH(Stamp) - 1 DAY)",
+}
+STATS_AGGREGATES = ('last', 'avg', 'min', 'max')
+
+def stats_value(value):
+    return float(value) if isinstance(value, Decimal) else value
+
+def stats_range(args):
+    """Builds the WHERE clause for the from/to parameters; a date-only 'to' includes that whole day."""
+    clauses, params = [], []
+    start = args.get('from')
+    end = args.get('to')
+    if start:
+        clauses.append("Stamp >= %s")
+        params.append(datetime.fromisoformat(start))
+    if end:
+        if len(end) == 10:
+            clauses.append("Stamp < %s + INTERVAL 1 DAY")
+        else:
+            clauses.append("Stamp <= %s")
+        params.append(datetime.fromisoformat(end))
+    return ("WHERE " + " AND ".join(clauses) + " ") if clauses else "", params
+
+def parse_stats_args(args):
+    """Returns (bucket, aggregate, where, params) for /stats, or raises ValueError with the client-facing reason."""
+    bucket = args.get('bucket')
+    aggregate = args.get('agg')
+    if bucket is not None and bucket not in STATS_BUCKETS:
+        raise ValueError(f"bucket must be one of: {', '.join(STATS_BUCKETS)}")
+    if aggregate is not None and (bucket is None or aggregate not in STATS_AGGREGATES):
+        raise ValueError(f"agg needs a bucket and must be one of: {', '.join(STATS_AGGREGATES)}")
+    try:
+        where, params = stats_range(args)
+    except ValueError:
+        raise ValueError('from and to must be yyyy-MM-dd or yyyy-MM-dd HH:mm:ss')
+    return bucket, aggregate, where, params
+
+def stats_rows_query(where):
+    return f"SELECT Stamp, {', '.join(STATS_METRICS)} FROM stats {where}ORDER BY Stamp"
+
+def stats_rows(rows):
+    return [dict(zip(('Stamp',) + STATS_METRICS, [row[0]] + [stats_value(value) for value in row[1:]])) for row in rows]
+
+def stats_bucket_queries(bucket, where):
+    """The per-bucket aggregate query and the query for each bucket's last snapshot (its MAX(Stamp) row)."""
+    bucket_expr = STATS_BUCKETS[bucket]
+    aggregates = ", ".join(f"AVG({metric}), MIN({metric}), MAX({metric})" for metric in STATS_METRICS)
+    grouped_query = f"""
+        SELECT {bucket_expr} AS Bucket, COUNT(*), MIN(Stamp), MAX(Stamp), {aggregates}
+        FROM stats {where}
+        GROUP BY Bucket
+        ORDER BY Bucket
+    """
+    last_query = f"""
+        SELECT s.Stamp, {", ".join("s." + metric for metric in STATS_METRICS)}
+        FROM stats s
+        JOIN (SELECT MAX(Stamp) AS Stamp FROM stats {where} GROUP BY {bucket_expr}) latest ON s.Stamp = latest.Stamp
+    """
+    return grouped_query, last_query
+
+def stats_buckets(grouped, last_rows):
+    """One entry per bucket with last/avg/min/max of every metric."""
+    last_rows = {row[0]: row[1:] for row in last_rows}
+    buckets = []
+    for row in grouped:
+        bucket_start, samples, first_stamp, last_stamp = row[:4]
+        last_values = last_rows.get(last_stamp, (None,) * len(STATS_METRICS))
+        entry = {'Bucket': bucket_start.isoformat(), 'Samples': samples, 'From': first_stamp, 'To': last_stamp}
+        for index, metric in enumerate(STATS_METRICS):
+            average, minimum, maximum = row[4 + index * 3:7 + index * 3]
+            entry[metric] = {
+                'last': stats_value(last_values[index]),
+                'avg': stats_value(average),
+                'min': stats_value(minimum),
+                'max': stats_value(maximum),
+            }
+        buckets.append(entry)
+    return buckets
+
+def flatten_stats_value(metric, value):
+    if metric in STATS_COUNT_METRICS and value is not None:
+        return int(value + 0.5)  # Half up, as MySQL's ROUND does; counts are never negative
+    return value
+
+def flatten_stats(buckets, aggregate):
+    # Back to the plain row shape, stamped with the bucket's last snapshot
+    return [
+        dict(Stamp=entry['To'], **{
+            metric: flatten_stats_value(metric, entry[metric][aggregate]) for metric in STATS_METRICS
+        })
+        for entry in buckets
+    ]
 
 @app.route('/stats', methods=['GET'])
 def get_stats():
+    """Stats snapshots, optionally limited to ?from=&to= and downsampled with ?bucket=day|week|month.
+
+    Bucketed entries carry last/avg/min/max per metric; adding ?agg=last (or avg/min/max) flattens
+    them back into the plain row shape, with Stamp set to the bucket's last snapshot.
+    """
+    try:
+        bucket, aggregate, where, params = parse_stats_args(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    etag = make_etag(*get_stats_version())
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+
     connection = get_db_connection()
-    cursor = connection.cursor()
-    cursor.execute("""
-        SELECT Stamp, TotalRows, TotalPlants, TotalNonM, TotalM, NonMValue, MValue, TotalValue, WebPlants, WebQty, WebValue, USD, EUR 
-        FROM stats
-    """)
-
-    rows = cursor.fetchall()
-    stats = []
-    for row in rows:
-        stats.append({
-            'Stamp': row[0],
-            'TotalRows': row[1],
-            'TotalPlants': row[2],
-            'TotalNonM': row[3],
-            'TotalM': row[4],
-            'NonMValue': float(row[5]) if row[5] is not None else None,
-            'MValue': float(row[6]) if row[6] is not None else None,
-            'TotalValue': float(row[7]) if row[7] is not None else None,
-            'WebPlants': row[8],
-            'WebQty': row[9],
-            'WebValue': float(row[10]) if row[10] is not None else None,
-            'USD': float(row[11]) if row[11] is not None else None,
-            'EUR': float(row[12]) if row[12] is not None else None
-        })
-    cursor.close()
-    connection.close()
+    try:
+        with connection.cursor() as cursor:
+            if bucket is not None:
+                grouped_query, last_query = stats_bucket_queries(bucket, where)
+                cursor.execute(grouped_query, params)
+                grouped = cursor.fetchall()
+                cursor.execute(last_query, params)
+                stats = stats_buckets(grouped, cursor.fetchall())
+            else:
+                cursor.execute(stats_rows_query(where), params)
+                stats = stats_rows(cursor.fetchall())
+    finally:
+        # Always hand the connection back, otherwise a failed query leaks a pool slot
+        connection.close()
+
+    if aggregate is not None:
+        stats = flatten_stats(stats, aggregate)
     if stats:
-        return jsonify(stats), 200
+        return with_etag(jsonify(stats), etag)
     else:
         return jsonify({'error': 'No stats found'}), 404
 
+def ensure_index(cursor, table, index_name, columns):
+    cursor.execute("""
+        SELECT COUNT(*) FROM information_schema.statistics
+        WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+    """, (table, index_name))
+    if cursor.fetchone()[0] == 0:
+        app.logger.info(f"Creating index {index_name} on {table} ({columns})")
+        cursor.execute(f"CREATE INDEX {index_name} ON {table} ({columns})")
+
+def ensure_trigger(cursor, trigger_name, definition):
+    cursor.execute("""
+        SELECT COUNT(*) FROM information_schema.triggers
+        WHERE trigger_schema = DATABASE() AND trigger_name = %s
+    """, (trigger_name,))
+    if cursor.fetchone()[0] == 0:
+        app.logger.info(f"Creating trigger {trigger_name}")
+        cursor.execute(definition)
+
+def ensure_schema():
+    """Creates the indexes and bookkeeping tables the sync endpoints rely on if they are missing."""
+    connection = get_db_connection()
+    try:
+        with connection.cursor() as cursor:
+            # Keyset paging of /rrhe/changes seeks on (Stamp, StockID)
+            ensure_index(cursor, 'stock', 'idx_stock_stamp_stockid', 'Stamp, StockID')
+            # /stats range filters and bucketing scan stats by Stamp; its ETag reads the newest Stamp
+            ensure_index(cursor, 'stats', 'idx_stats_stamp', 'Stamp')
+            # Change counter behind the /rrhe, /rrhe/changes ETags
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS sync_state (
+                    name VARCHAR(32) NOT NULL PRIMARY KEY,
+                    version BIGINT UNSIGNED NOT NULL DEFAULT 0
+                )
+            """)
+            cursor.execute("INSERT IGNORE INTO sync_state (name, version) VALUES ('stock', 0)")
+            # Field-level change log behind /rrhe/changes/delta
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS stock_changes (
+                    ChangeID BIGINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+                    StockID INT NOT NULL,
+                    Op VARCHAR(8) NOT NULL,
+                    ChangedColumns VARCHAR(1024) NOT NULL,
+                    ChangedAt TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            # Photo renames still owed to inserted plants, applied by start_photo_rename_worker()
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS photo_rename_jobs (
+                    NewStockID INT NOT NULL PRIMARY KEY,
+                    TempStockID INT NOT NULL,
+                    CreatedAt TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    Attempts INT NOT NULL DEFAULT 0,
+                    LastError VARCHAR(255) NULL
+                )
+            """)
+            # StockID sequence used by the insert endpoints, kept ahead of any rows inserted behind its back
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS id_sequences (
+                    name VARCHAR(32) NOT NULL PRIMARY KEY,
+                    next_id BIGINT NOT NULL
+                )
+            """)
+            cursor.execute("""
+                INSERT INTO id_sequences (name, next_id)
+                SELECT 'stock', COALESCE(MAX(StockID), 0) + 1 FROM stock
+                ON DUPLICATE KEY UPDATE next_id = GREATEST(next_id, VALUES(next_id))
+            """)
+            # Tombstones: any delete from stock, through this server or not, lands in the change log
+            cursor.execute("INSERT IGNORE INTO sync_state (name, version) VALUES ('changes_floor', 0)")
+            ensure_trigger(cursor, 'stock_after_delete', """
+                CREATE TRIGGER stock_after_delete AFTER DELETE ON stock FOR EACH ROW
+                BEGIN
+                    UPDATE sync_state SET version = version + 1 WHERE name = 'stock';
+                    INSERT INTO stock_changes (StockID, Op, ChangedColumns) VALUES (OLD.StockID, 'delete', '');
+                END
+            """)
+            # Rows inserted by other tools change the ETag too (this server's inserts bump it anyway)
+            ensure_trigger(cursor, 'stock_after_insert', """
+                CREATE TRIGGER stock_after_insert AFTER INSERT ON stock FOR EACH ROW
+                UPDATE sync_state SET version = version + 1 WHERE name = 'stock'
+            """)
+        connection.commit()
+    finally:
+        connection.close()
+
+def prune_change_log():
+    """Drops change-log entries (including tombstones) older than the retention window.
+
+    The highest pruned ChangeID is stored as the 'changes_floor' first, so a delta cursor below it
+    gets an explicit resync-required answer instead of a feed with holes in it.
+    """
+    connection = get_db_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT MAX(ChangeID) FROM stock_changes WHERE ChangedAt < NOW() - INTERVAL %s DAY",
+                           (CHANGE_LOG_RETENTION_DAYS,))
+            floor = cursor.fetchone()[0]
+            if floor is None:
+                return
+            cursor.execute("UPDATE sync_state SET version = GREATEST(version, %s) WHERE name = 'changes_floor'",
+                           (floor,))
+            connection.commit()
+            while True:
+                deleted = cursor.execute("DELETE FROM stock_changes WHERE ChangeID <= %s LIMIT 5000", (floor,))
+                connection.commit()
+                if deleted < 5000:
+                    break
+            app.logger.info(f"Pruned change log up to ChangeID {floor}")
+    finally:
+        connection.close()
+
+def start_change_log_pruner():
+    """Prunes the change log every CHANGE_LOG_PRUNE_INTERVAL; returns a function that stops it."""
+    stopping = threading.Event()
+
+    def run():
+        while not stopping.is_set():
+            try:
+                prune_change_log()
+            except Exception as e:
+                app.logger.error(f"Error pruning change log: {str(e)}")
+            stopping.wait(CHANGE_LOG_PRUNE_INTERVAL)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+
+    def stop():
+        stopping.set()
+        thread.join()
+
+    return stop
+
+def sync_stock_replica():
+    """Loads the replica if it is empty, otherwise catches it up with writes made outside this process.
+
+    Plants named in the change log since the last pass are re-read (deleted ones drop out), along with
+    any row stamped at or after the newest Stamp held, which covers edits made directly in MySQL.
+    """
+    connection = get_db_connection()
+    try:
+        with connection.cursor() as cursor:
+            # The change-log position is read first, in the same snapshot, so a write racing the
+            # load is replayed on the next pass rather than lost
+            change_id = read_change_position(cursor)
+
+            if not stock_replica.ready:
+                stream = connection.cursor(pymysql.cursors.SSCursor)
+                try:
+                    stream.execute(STOCK_SELECT)
+                    stock_replica.load(stream, change_id)
+                finally:
+                    stream.close()
+                return
+
+            cursor.execute("SELECT DISTINCT StockID FROM stock_changes WHERE ChangeID > %s AND ChangeID <= %s",
+                           (stock_replica.change_id, change_id))
+            stock_ids = {row[0] for row in cursor.fetchall()}
+            max_stamp = stock_replica.max_stamp
+            if max_stamp is not None:
+                cursor.execute("SELECT StockID FROM stock WHERE Stamp >= %s", (max_stamp,))
+                stock_ids.update(row[0] for row in cursor.fetchall())
+            if stock_ids:
+                rows = read_stock_rows(cursor, stock_ids)
+                stock_replica.upsert(rows)
+                stock_replica.remove(stock_ids - {row[0] for row in rows})
+            stock_replica.caught_up(change_id)
+    finally:
+        connection.close()
+
+def start_stock_replica():
+    def run():
+        while True:
+            if stock_replica.enabled:
+                try:
+                    sync_stock_replica()
+                except Exception as e:
+                    app.logger.error(f"Error syncing stock replica: {str(e)}")
+            time.sleep(STOCK_REPLICA_SYNC_INTERVAL)
+
+    threading.Thread(target=run, daemon=True).start()
+
+def start_change_watch_poller():
+    """Publishes writes committed by other processes (or the delete trigger) while anyone is watching."""
+    def run():
+        while True:
+            if change_notifier.watchers:
+                connection = None
+                try:
+                    connection = get_db_connection()
+                    with connection.cursor() as cursor:
+                        change_notifier.publish(read_change_position(cursor))
+                except Exception as e:
+                    app.logger.error(f"Error polling change log for watchers: {str(e)}")
+                finally:
+                    if connection is not None:
+                        connection.close()
+            time.sleep(WATCH_POLL_INTERVAL)
+
+    threading.Thread(target=run, daemon=True).start()
+
+@app.route('/replica/stats', methods=['GET'])
+def get_replica_stats():
+    if stock_replica is None:
+        return jsonify({'error': 'Stock replica is not enabled (set RRHE_STOCK_REPLICA=1)'}), 404
+    return jsonify(stock_replica.stats()), 200
+
+@app.route('/replica/invalidate', methods=['POST'])
+def invalidate_replica():
+    """Drops the replica so the next catch-up reloads it from MySQL, e.g. after bulk edits made in SQL."""
+    if stock_replica is None:
+        return jsonify({'error': 'Stock replica is not enabled (set RRHE_STOCK_REPLICA=1)'}), 404
+    stock_replica.invalidate("requested via /replica/invalidate", enable=True)
+    return jsonify({'message': 'Stock replica invalidated'}), 200
+
 if __name__ == '__main__':
+    ensure_schema()
+    start_change_log_pruner()
+    start_change_watch_poller()
+    start_photo_rename_worker()
+    if stock_replica is not None:
+        start_stock_replica()
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,153 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import time
+
+logger = logging.getLogger(__name__)
+
+# inotify(7) constants
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+# A file counts as finished once its writer closes it or it is renamed into place; a plain IN_CREATE
+# only matters for directories, since a created file is still being written. IN_MODIFY is watched only
+# so that ongoing writes keep the debounce window open.
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF)
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, name length
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    _libc.inotify_init1
+except (OSError, AttributeError):
+    _libc = None
+
+
+class FolderWatcher:
+    """Calls on_change(names) once files in directory have finished changing.
+
+    On Linux this sleeps in inotify until a file is closed after writing, renamed in or out, or
+    deleted; elsewhere (or if inotify can't be set up) it polls every poll_interval seconds and only
+    reports a file once its size and mtime held still for a whole interval. Either way, events are
+    collected until debounce seconds pass without another (writes still in progress count, though
+    only finished files are reported), so a build that writes a dozen files in a row yields one call.
+    """
+
+    def __init__(self, directory, on_change, debounce=1.0, poll_interval=5):
+        self.directory = directory
+        self.on_change = on_change
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+
+    def run(self):
+        """Watches forever; meant as a thread target."""
+        while True:
+            fd = self._start_inotify()
+            if fd is None:
+                self._run_polling()
+                return
+            try:
+                self._run_inotify(fd)
+            finally:
+                os.close(fd)
+            # The directory itself was deleted or moved; rescan once it is back, since we missed its contents
+            while not os.path.isdir(self.directory):
+                time.sleep(self.poll_interval)
+            self._notify(set())
+
+    def _start_inotify(self):
+        if _libc is None:
+            logger.info(f"inotify unavailable, polling {self.directory} every {self.poll_interval}s")
+            return None
+        fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            logger.warning(f"inotify_init1 failed ({os.strerror(ctypes.get_errno())}), polling {self.directory}")
+            return None
+        if _libc.inotify_add_watch(fd, os.fsencode(self.directory), WATCH_MASK) < 0:
+            logger.warning(f"Can't watch {self.directory} ({os.strerror(ctypes.get_errno())}), polling it instead")
+            os.close(fd)
+            return None
+        logger.debug(f"Watching {self.directory} with inotify")
+        return fd
+
+    def _run_inotify(self, fd):
+        """Returns when the watched directory goes away."""
+        names = set()
+        while True:
+            # Blocks until something happens, then keeps collecting until a debounce-long quiet spell
+            ready, _, _ = select.select([fd], [], [], self.debounce if names else None)
+            if not ready:
+                self._notify(names)
+                names = set()
+                continue
+            for mask, name in self._read_events(fd):
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                    return
+                if mask & IN_Q_OVERFLOW:
+                    logger.warning(f"inotify queue overflowed for {self.directory}")
+                    names.add('')  # Unknown names; callers rescan the directory anyway
+                elif mask & IN_MODIFY or (mask & IN_CREATE and not mask & IN_ISDIR):
+                    continue  # Still being written; the close or rename that ends it is reported
+                elif name:
+                    names.add(name)
+
+    @staticmethod
+    def _read_events(fd):
+        try:
+            data = os.read(fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0').decode(errors='replace')
+            offset += length
+            yield mask, name
+
+    def _run_polling(self):
+        previous = self._snapshot()
+        settling = set()  # Names that changed in the last interval and are waiting to hold still
+        while True:
+            time.sleep(self.poll_interval)
+            current = self._snapshot()
+            changed = {name for name in previous.keys() | current.keys() if previous.get(name) != current.get(name)}
+            stable = settling - changed
+            if stable:
+                self._notify(stable)
+            settling = changed
+            previous = current
+
+    def _snapshot(self):
+        snapshot = {}
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return snapshot
+        for entry in entries:
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue  # Deleted since the scan; it will show up as gone next time
+            snapshot[entry.name] = (entry.is_dir(), stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def _notify(self, names):
+        try:
+            self.on_change(names)
+        except Exception as e:
+            logger.error(f"Error handling changes in {self.directory}: {e}")
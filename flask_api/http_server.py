@@ -1,35 +1,69 @@
 #! /home/mcmeister/myflaskenv/bin/python
 
-from flask import Flask, request, send_from_directory, abort, jsonify
+from flask import Flask, request, send_file, abort, jsonify
 import os
 import requests
 import logging
+import threading
+import time
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
+from thumbnails import ThumbnailCache
+from photo_versions import PhotoVersions, versioned_url
+from resumable_uploads import UploadStaging, UploadError
+from photo_update_queue import PhotoUpdateQueue, BatchRejected
+from photo_store import PhotoStore, PHOTO_STORE_DIR
 
 app = Flask(__name__)
 UPLOAD_FOLDER = '/home/mcmeister/Documents/GDrive_Photos/'
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 1024 * 1024 * 100  # Limit upload size to 100MB
+# Behind Apache (mod_xsendfile) or lighttpd, let the front server send photo bodies itself
+app.config['USE_X_SENDFILE'] = os.environ.get('RRHE_USE_X_SENDFILE', '0') == '1'
 
 DB_SERVER_URL = 'http://localhost:5000'  # Update this with your actual DB server address and port
 
+# Photo column updates are queued here and sent to the DB server in the background
+PHOTO_UPDATE_QUEUE_PATH = os.environ.get('RRHE_PHOTO_UPDATE_QUEUE',
+                                         os.path.expanduser('~/.cache/rrhe_photo_updates.json'))
+PHOTO_INDEXES = ('1', '2', '3', '4')  # Photo1..Photo4 in the stock table
+PHOTO_UPDATE_BATCH_SIZE = 100  # Well under db_server's MAX_BATCH_UPDATES
+PHOTO_UPDATE_MAX_BACKOFF = 300  # Seconds between retries while the DB server stays unreachable
+
+# Resized variants for ?w=<width>; kept outside UPLOAD_FOLDER so they are never synced to Drive
+THUMBNAIL_CACHE_DIR = os.environ.get('RRHE_THUMBNAIL_CACHE_DIR', os.path.expanduser('~/.cache/rrhe_thumbnails'))
+THUMBNAIL_CACHE_MAX_BYTES = int(os.environ.get('RRHE_THUMBNAIL_CACHE_MB', 512)) * 1024 * 1024
+THUMBNAIL_WORKERS = int(os.environ.get('RRHE_THUMBNAIL_WORKERS', max(1, (os.cpu_count() or 2) // 2)))
+
+PHOTO_IMMUTABLE_MAX_AGE = 365 * 24 * 3600  # For URLs whose ?v= matches the content, which then never changes
+
+# Partial resumable uploads; also outside UPLOAD_FOLDER so Drive never sees half a photo
+UPLOAD_STAGING_DIR = os.environ.get('RRHE_UPLOAD_STAGING_DIR', os.path.expanduser('~/.cache/rrhe_uploads'))
+UPLOAD_SESSION_TTL = 24 * 3600  # Seconds an unfinished upload is kept without any activity
+UPLOAD_GC_INTERVAL = 3600  # Seconds between sweeps for stale uploads
+UPLOAD_CHUNK_SIZE = 512 * 1024  # Suggested to clients; small enough to resend cheaply after a Wi-Fi drop
+
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def rename_file_if_exists(file_path):
-    """Renames the existing file by appending '_old' or a numeric suffix to avoid conflicts."""
-    name, ext = os.path.splitext(file_path)
-    old_file_path = f"{name}_old{ext}"
+photo_store = PhotoStore(UPLOAD_FOLDER, PHOTO_STORE_DIR)
+photo_versions = PhotoVersions()
+thumbnail_cache = ThumbnailCache(UPLOAD_FOLDER, THUMBNAIL_CACHE_DIR, THUMBNAIL_CACHE_MAX_BYTES, THUMBNAIL_WORKERS)
+if not thumbnail_cache.available:
+    logger.warning("Pillow is not installed, ?w= requests will get the full-size photo")
+db_session = requests.Session()  # Keeps the connection to the DB server alive between batches
 
-    # Check if the _old file already exists
-    counter = 1
-    while os.path.exists(old_file_path):
-        old_file_path = f"{name}_old_{counter}{ext}"
-        counter += 1
+def send_photo_updates(updates):
+    response = db_session.post(f"{DB_SERVER_URL}/update_photo_column/batch", json={'updates': updates}, timeout=10)
+    if response.status_code == 400:
+        raise BatchRejected(response.text)  # Retrying the same batch can't succeed
+    if response.status_code != 200:
+        raise RuntimeError(f"DB server answered {response.status_code}: {response.text}")
 
-    logger.info(f"Renaming existing file from {file_path} to {old_file_path}")
-    os.rename(file_path, old_file_path)
+photo_update_queue = PhotoUpdateQueue(PHOTO_UPDATE_QUEUE_PATH, send_photo_updates,
+                                      PHOTO_UPDATE_BATCH_SIZE, PHOTO_UPDATE_MAX_BACKOFF)
+upload_staging = UploadStaging(UPLOAD_STAGING_DIR, UPLOAD_SESSION_TTL, app.config['MAX_CONTENT_LENGTH'])
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
@@ -53,43 +87,122 @@ def upload_file():
     # Additional logging to confirm file path
     logger.info(f"Saving file to: {file_path}")
     
-    # Check if a file with the same name already exists
-    if os.path.exists(file_path):
-        logger.warning(f"File {filename} already exists, renaming it")
-        rename_file_if_exists(file_path)
-    
-    # Save the new file
+    # Written on the store's filesystem first, so a broken upload never replaces a good photo; the store
+    # then links it into place and keeps the previous version in its history
+    temp_path = photo_store.temp_path()
     try:
-        file.save(file_path)
+        file.save(temp_path)
+        photo_store.put(filename, temp_path)
         logger.info(f"File {filename} saved successfully at {file_path}")
     except Exception as e:
         logger.error(f"Failed to save file {filename}: {str(e)}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
         return jsonify({"error": "Failed to save file"}), 500
+    return publish_photo(filename, file_path)
+
+def publish_photo(filename, file_path):
+    """Points the Photo column named by filename at the newly saved file_path."""
+    thumbnail_cache.invalidate(filename)
 
     # Extract stockID and photoIndex from filename
     try:
         stockID, photoIndex = filename.split('_')[0], filename.split('_')[1].split('.')[0]
-        photoUrl = f"http://{request.host}/{filename}"
+        if not stockID or photoIndex not in PHOTO_INDEXES:
+            raise ValueError("expected <stockID>_<1-4>.jpg")
+        # The content hash makes the URL change whenever the photo does, so clients may cache it forever
+        photoUrl = versioned_url(f"http://{request.host}/{filename}", photo_versions.version(file_path))
     except Exception as e:
         logger.error(f"Error extracting stockID and photoIndex from filename {filename}: {str(e)}")
         return jsonify({"error": "Invalid filename format"}), 400
 
-    # Send request to the DB server to update the corresponding Photo column
+    # The file is safely on disk, so the phone needn't wait for the DB server; the queue retries until it's stored
+    photo_update_queue.put(stockID, photoIndex, photoUrl)
+    logger.info(f"Queued DB update for {filename}")
+    return jsonify({"message": "File uploaded and saved successfully, DB update queued"}), 200
+
+def upload_error_response(error):
+    body = {"error": str(error)}
+    if error.offset is not None:
+        body["offset"] = error.offset
+    return jsonify(body), error.status
+
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    """Starts a resumable upload: {"filename", "size", optional "sha256"} -> {"uploadId", "offset", "chunkSize"}.
+
+    The client then PUTs the file in pieces to /uploads/<uploadId>?offset=N and POSTs
+    /uploads/<uploadId>/finish; after a dropped connection, GET /uploads/<uploadId> says where to resume.
+    A 404 (unknown or expired session) or 410 (its data was lost) means starting over with a new upload.
+    """
+    data = request.get_json(silent=True) or {}
+    filename = secure_filename(data.get('filename') or '')
+    if not filename:
+        logger.error("No filename in upload request")
+        return jsonify({"error": "Missing filename"}), 400
     try:
-        response = requests.post(f"{DB_SERVER_URL}/update_photo_column", json={
-            'stockID': stockID,
-            'photoIndex': photoIndex,
-            'photoUrl': photoUrl
-        }, timeout=10)
-        if response.status_code == 200:
-            logger.info(f"DB updated successfully for {filename}")
-            return jsonify({"message": "File uploaded and saved successfully, DB updated"}), 200
-        else:
-            logger.error(f"DB update failed for {filename}: {response.text}")
-            return jsonify({"error": f"File uploaded but DB update failed: {response.text}"}), 500
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error updating DB for {filename}: {str(e)}")
-        return jsonify({"error": "DB update failed"}), 500
+        size = int(data.get('size'))
+        upload_id = upload_staging.create(filename, size, data.get('sha256'))
+    except (TypeError, ValueError):
+        return jsonify({"error": "Missing or invalid size"}), 400
+    except UploadError as e:
+        return upload_error_response(e)
+    return jsonify({"uploadId": upload_id, "offset": 0, "chunkSize": UPLOAD_CHUNK_SIZE}), 201
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def get_upload(upload_id):
+    try:
+        return jsonify(upload_staging.status(upload_id)), 200
+    except UploadError as e:
+        return upload_error_response(e)
+
+@app.route('/uploads/<upload_id>', methods=['PUT'])
+def put_upload_chunk(upload_id):
+    offset = request.args.get('offset', type=int)
+    if offset is None:
+        return jsonify({"error": "Missing or invalid offset"}), 400
+    try:
+        new_offset = upload_staging.write_chunk(upload_id, offset, request.stream, request.content_length)
+    except UploadError as e:
+        return upload_error_response(e)
+    except Exception as e:
+        logger.error(f"Error writing chunk of upload {upload_id} at {offset}: {str(e)}")
+        return jsonify({"error": "Failed to write chunk"}), 500
+    return jsonify({"uploadId": upload_id, "offset": new_offset}), 200
+
+@app.route('/uploads/<upload_id>/finish', methods=['POST'])
+def finish_upload(upload_id):
+    try:
+        filename = upload_staging.status(upload_id)['filename']
+        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        temp_path = photo_store.temp_path()
+        upload_staging.finish(upload_id, temp_path)
+        photo_store.put(filename, temp_path)
+    except UploadError as e:
+        return upload_error_response(e)
+    except Exception as e:
+        logger.error(f"Failed to finish upload {upload_id}: {str(e)}")
+        return jsonify({"error": "Failed to save file"}), 500
+    return publish_photo(filename, file_path)
+
+@app.route('/uploads/<upload_id>', methods=['DELETE'])
+def cancel_upload(upload_id):
+    try:
+        upload_staging.cancel(upload_id)
+    except UploadError as e:
+        return upload_error_response(e)
+    return jsonify({"message": "Upload cancelled"}), 200
+
+def start_upload_collector():
+    def run():
+        while True:
+            try:
+                upload_staging.collect_garbage()
+            except Exception as e:
+                logger.error(f"Error removing stale uploads: {str(e)}")
+            time.sleep(UPLOAD_GC_INTERVAL)
+
+    threading.Thread(target=run, daemon=True).start()
 
 @app.route('/delete_photo', methods=['POST'])
 def delete_photo():
@@ -100,45 +213,90 @@ def delete_photo():
     if not stockID or not photoIndex:
         logger.error("Missing stockID or photoIndex in request")
         return jsonify({"error": "Missing stockID or photoIndex"}), 400
+    if str(photoIndex) not in PHOTO_INDEXES:
+        logger.error(f"Invalid photoIndex {photoIndex} in request")
+        return jsonify({"error": "Invalid photoIndex"}), 400
 
     filename = f"{stockID}_{photoIndex}.jpg"
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
 
-    # Delete the file if it exists
-    if os.path.exists(file_path):
-        try:
-            os.remove(file_path)
+    # The store keeps the deleted version in its history until compaction
+    try:
+        if photo_store.delete(filename):
             logger.info(f"Photo {filename} deleted successfully")
-        except Exception as e:
-            logger.error(f"Failed to delete photo {filename}: {str(e)}")
-            return jsonify({"error": f"Failed to delete photo: {str(e)}"}), 500
+            thumbnail_cache.invalidate(filename)
+        else:
+            logger.warning(f"Photo {filename} not found, skipping deletion")
+    except Exception as e:
+        logger.error(f"Failed to delete photo {filename}: {str(e)}")
+        return jsonify({"error": f"Failed to delete photo: {str(e)}"}), 500
+
+    # Set the photo column to NULL in the database, via the same queue as uploads so the two stay in order
+    photo_update_queue.put(stockID, photoIndex, None)
+    logger.info(f"Queued DB update for deletion of {filename}")
+    return jsonify({"message": "Photo deleted, DB update queued"}), 200
+
+def send_photo(path, version, etag, mimetype=None):
+    """Sends a photo with a strong ETag, Last-Modified and Range support.
+
+    send_file answers If-None-Match / If-Modified-Since with 304 and Range with 206, and hands the
+    file to the WSGI server's file_wrapper (sendfile under gunicorn) or to X-Sendfile when enabled.
+    """
+    response = send_file(path, mimetype=mimetype, etag=etag, conditional=True, max_age=None)
+    if request.args.get('v') == version:
+        # This URL names one exact content version, so neither Glide nor a proxy ever needs to revalidate it
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = PHOTO_IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
     else:
-        logger.warning(f"Photo {filename} not found, skipping deletion")
+        # Unversioned (or outdated) URLs may change content in place, so clients revalidate with the ETag
+        response.cache_control.no_cache = True
+    return response
 
-    # Update the database to set the photo column to NULL
+def send_thumbnail(filename, version, width):
+    """Sends the cached variant of filename for ?w=width, or None to fall back to the original."""
+    if not thumbnail_cache.available or width <= 0:
+        return None
     try:
-        response = requests.post(f"{DB_SERVER_URL}/update_photo_column", json={
-            'stockID': stockID,
-            'photoIndex': photoIndex,
-            'photoUrl': None  # Set to NULL in the database
-        }, timeout=10)
-        if response.status_code == 200:
-            logger.info(f"DB updated successfully for deletion of {filename}")
-            return jsonify({"message": "Photo deleted and DB updated successfully"}), 200
-        else:
-            logger.error(f"DB update failed for deletion of {filename}: {response.text}")
-            return jsonify({"error": f"Photo deleted but DB update failed: {response.text}"}), 500
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error updating DB for deletion of {filename}: {str(e)}")
-        return jsonify({"error": "DB update failed"}), 500
+        path = thumbnail_cache.get(filename, width)
+        return send_photo(path, version, f"{version}-w{thumbnail_cache.snap_width(width)}", mimetype='image/jpeg')
+    except FileNotFoundError:
+        raise
+    except Exception as e:
+        logger.error(f"Error making {width}px thumbnail of {filename}, sending the original: {str(e)}")
+        return None
+
+@app.route('/history/<filename>', methods=['GET'])
+def get_photo_history(filename):
+    history = photo_store.history(filename)
+    return jsonify([{'hash': content_hash, 'at': at} for content_hash, at in history]), 200
+
+@app.route('/photo_updates/stats', methods=['GET'])
+def get_photo_update_stats():
+    return jsonify(photo_update_queue.stats()), 200
+
+@app.route('/thumbnails/stats', methods=['GET'])
+def get_thumbnail_stats():
+    return jsonify(thumbnail_cache.stats()), 200
 
 @app.route('/<filename>', methods=['GET'])
 def get_file(filename):
     try:
         # Strip query parameters (if any)
         filename = filename.split("?")[0]
-        logger.info(f"Fetching file: {filename}")
-        return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+        # Every list row fetches photos, so per-request logging stays at DEBUG
+        logger.debug(f"Fetching file: {filename}")
+        path = safe_join(app.config['UPLOAD_FOLDER'], filename)
+        if path is None or not os.path.isfile(path):
+            raise FileNotFoundError(filename)
+        version = photo_versions.version(path)
+
+        width = request.args.get('w', type=int)
+        if width is not None:
+            response = send_thumbnail(filename, version, width)
+            if response is not None:
+                return response
+        return send_photo(path, version, version)
     except FileNotFoundError:
         logger.error(f"File not found: {filename}")
         abort(404, description="Resource not found")
@@ -147,4 +305,6 @@ def get_file(filename):
         abort(500, description="Internal server error")
 
 if __name__ == '__main__':
+    start_upload_collector()
+    photo_update_queue.start()  # Sends whatever a previous run left queued
     app.run(host='0.0.0.0', port=8000, threaded=True)
\ No newline at end of file
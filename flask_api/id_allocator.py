@@ -0,0 +1,154 @@
+#! /home/mcmeister/myflaskenv/bin/python
+
+"""Block-based ID allocation backed by a sequence row.
+
+reserve_block(count) must atomically advance the shared sequence by count and return the first ID
+of the reserved range (db_server does this with a single UPDATE ... LAST_INSERT_ID() statement).
+IDs are then handed out from the reserved range in memory, so inserts never lock the stock table.
+
+Run this file directly for a concurrency check that threads in several processes never receive the
+same ID. Each process has its own allocator and reserves blocks through the database alone, with no
+lock shared between processes: by default from a throwaway SQLite sequence, and with --mysql through
+db_server's reservation query on a scratch id_sequences row.
+"""
+
+import argparse
+import multiprocessing
+import os
+import queue
+import sqlite3
+import tempfile
+import threading
+
+CHECK_SEQUENCE = 'allocator_check'  # id_sequences row the check uses, never 'stock'
+
+
+class BlockIdAllocator:
+    def __init__(self, reserve_block, block_size=1):
+        self._reserve_block = reserve_block
+        self.block_size = block_size
+        self._lock = threading.Lock()  # Guards _next/_end; never held across a reserve_block() round trip
+        self._refill_lock = threading.Lock()  # One refill at a time, so a drained block isn't replaced twice
+        self._next = 0
+        self._end = 0
+
+    def allocate(self, count=1):
+        """Returns count unused IDs, reserving a new block from the sequence when the current one runs out."""
+        ids = []
+        while True:
+            with self._lock:
+                take = min(count - len(ids), self._end - self._next)
+                if take > 0:
+                    ids.extend(range(self._next, self._next + take))
+                    self._next += take
+                if len(ids) == count:
+                    return ids
+            with self._refill_lock:
+                with self._lock:
+                    if self._next < self._end:
+                        continue  # Another thread refilled while this one waited for the refill lock
+                size = max(self.block_size, count - len(ids))
+                start = self._reserve_block(size)
+                with self._lock:
+                    self._next, self._end = start, start + size
+
+
+def sqlite_reserve_block(path):
+    def reserve_block(count):
+        # Same shape as the MySQL reservation: increment and read back in one transaction, made atomic
+        # by the database's write lock rather than anything in this process
+        connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute("UPDATE id_sequences SET next_id = next_id + ? WHERE name = ?", (count, CHECK_SEQUENCE))
+            end = connection.execute("SELECT next_id FROM id_sequences WHERE name = ?", (CHECK_SEQUENCE,)).fetchone()[0]
+            connection.execute("COMMIT")
+            return end - count
+        finally:
+            connection.close()
+    return reserve_block
+
+
+def mysql_reserve_block():
+    import db_server  # Imported in each worker process, so every one has its own connection pool
+    return lambda count: db_server.reserve_sequence_ids(CHECK_SEQUENCE, count)
+
+
+def reset_sequence(backend, path):
+    if backend == 'sqlite':
+        connection = sqlite3.connect(path)
+        connection.execute("CREATE TABLE IF NOT EXISTS id_sequences (name TEXT PRIMARY KEY, next_id INTEGER NOT NULL)")
+        connection.execute("INSERT OR REPLACE INTO id_sequences (name, next_id) VALUES (?, 1)", (CHECK_SEQUENCE,))
+        connection.commit()
+        connection.close()
+        return
+    import db_server
+    connection = db_server.get_db_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO id_sequences (name, next_id) VALUES (%s, 1)
+                ON DUPLICATE KEY UPDATE next_id = 1
+            """, (CHECK_SEQUENCE,))
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def run_worker(backend, path, threads, allocations, block_size, results):
+    reserve_block = sqlite_reserve_block(path) if backend == 'sqlite' else mysql_reserve_block()
+    allocator = BlockIdAllocator(reserve_block, block_size)
+    issued = []
+    issued_lock = threading.Lock()
+    start_barrier = threading.Barrier(threads)
+
+    def run(batch):
+        start_barrier.wait()
+        local = []
+        for _ in range(allocations):
+            local.extend(allocator.allocate(batch))
+        with issued_lock:
+            issued.extend(local)
+
+    workers = [threading.Thread(target=run, args=(1 + index % 3,)) for index in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    results.put(issued)
+
+
+def check_concurrency(backend='sqlite', workers=4, threads_per_worker=8, allocations=100, block_size=7):
+    """Several processes (as several server workers would be), each with its own allocator, share one sequence."""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'sequences.sqlite3')
+        reset_sequence(backend, path)
+        context = multiprocessing.get_context('spawn')  # Nothing inherited, as with separate servers
+        results = context.Queue()
+        processes = [
+            context.Process(target=run_worker,
+                            args=(backend, path, threads_per_worker, allocations, block_size, results))
+            for _ in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        issued = []
+        try:
+            for _ in processes:
+                issued.extend(results.get(timeout=300))
+        except queue.Empty:
+            raise AssertionError(f"a worker failed: exit codes {[process.exitcode for process in processes]}")
+        for process in processes:
+            process.join()
+
+    assert len(issued) == len(set(issued)), "duplicate IDs issued"
+    print(f"{len(issued)} IDs issued across {workers} processes x {threads_per_worker} threads "
+          f"from the {backend} sequence, no duplicates")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check that concurrent allocators never issue the same ID")
+    parser.add_argument('--mysql', action='store_true',
+                        help=f"reserve through db_server's query on the '{CHECK_SEQUENCE}' id_sequences row")
+    args = parser.parse_args()
+    check_concurrency('mysql' if args.mysql else 'sqlite')
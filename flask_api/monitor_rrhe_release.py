@@ -4,15 +4,15 @@ import os
 import time
 import shutil
 from shutil import move
-from http.server import SimpleHTTPRequestHandler
-from socketserver import TCPServer
-import socketserver
 import threading
 import requests
 import socket
 import logging
 from google.oauth2 import service_account
 from google.auth.transport.requests import Request
+from folder_watcher import FolderWatcher
+from apk_download_server import ApkDownloadServer
+from apk_patches import build_patches, load_patches, version_folders
 
 # Configuration
 watch_folder = '/home/mcmeister/StudioProjects/RRHE_Android_App/app/release/'
@@ -23,7 +23,16 @@ version_start = 1.0
 host_ip = '192.168.1.200'
 port = 8080
 external_ip = '183.88.230.187:55005'  # External IP for release server
+max_download_connections = 32  # Downloads served at once; later phones wait briefly, then get 503 + Retry-After
+patch_history = 3  # Previous versions a new release gets a /patch?from=<version> patch from
+patch_max_ratio = 0.6  # Patches bigger than this share of the full APK aren't offered
 log_file = '/home/mcmeister/rrhe_monitor.log'  # Update the path to a directory you have write access to
+release_debounce = 2.0  # Seconds without further writes before a Gradle build's output is handled
+version_control_debounce = 1.0  # Seconds without further changes before version folders are rescanned
+release_settle_interval = 2  # Seconds app-release.apk's size and mtime must hold still before it is handled
+release_settle_attempts = 30  # Checks before giving up on a still-changing APK until its next event
+release_poll_interval = 5  # Only used where inotify isn't available
+version_control_poll_interval = 10  # Only used where inotify isn't available
 
 # FCM Configuration
 service_account_file = '/home/mcmeister/Documents/RRHE_App_Dev/rrhe-2f654-e0f933ba832f.json'  # Path to your service account JSON file
@@ -32,6 +41,7 @@ fcm_topic = 'projects/rrhe-2f654/topics/new_apk_available'  # Replace YOUR_PROJE
 
 current_server = None  # Global variable to keep track of the current server
 last_version_folder = None  # Global variable to track the last processed version folder
+release_lock = threading.Lock()  # Both watchers may call process_new_apk; one release is handled at a time
 
 # Configure logging
 logging.basicConfig(
@@ -57,9 +67,7 @@ def get_next_version():
         return version_start
 
 # Function to copy the content of the release folder to version control
-def copy_to_version_control():
-    next_version = get_next_version()
-    new_version_folder = f"RRHE_{next_version}"
+def copy_to_version_control(new_version_folder):
     destination_path = os.path.join(version_control_folder, new_version_folder)
 
     logging.debug(f"Creating a new versioned folder: {destination_path}")
@@ -68,8 +76,6 @@ def copy_to_version_control():
     shutil.copytree(watch_folder, destination_path)
     logging.debug(f"Copied contents of {watch_folder} to {destination_path}")
 
-    return new_version_folder
-
 # Function to check if a port is already in use
 def is_port_in_use(port):
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
@@ -77,55 +83,73 @@ def is_port_in_use(port):
     logging.debug(f"Port {port} in use: {in_use}")
     return in_use
 
-# Custom TCPServer class to set SO_REUSEADDR option
-class ReusableTCPServer(TCPServer):
-    allow_reuse_address = True
-
 def start_hosting():
+    """Starts the download server once; new releases are published into it with publish_apk()."""
     global current_server
-    logging.debug("Checking if RRHE.apk is available for hosting...")
+    # Always use the external IP for the download link
+    download_link = f"http://{external_ip}/{rrhe_apk}"
+    logging.debug(f"APK will be hosted at: {download_link}")
 
-    if os.path.exists(os.path.join(watch_folder, rrhe_apk)):
-        logging.debug(f"Found {rrhe_apk}. Starting to host...")
+    # Attempt to start the server with retries
+    for attempt in range(3):
+        try:
+            # Threaded, with Range/ETag for resumed downloads and sendfile for the body
+            httpd = ApkDownloadServer(("", port), watch_folder, max_download_connections)
+            server_thread = threading.Thread(target=httpd.serve_forever)
+            server_thread.daemon = True
+            server_thread.start()
+            logging.debug(f"Serving at: {download_link}")
+            current_server = httpd
+            break
+        except OSError as e:
+            logging.error(f"Failed to bind to port {port}. Error: {e}")
+            if attempt < 2:
+                logging.debug(f"Retrying to start the server... (Attempt {attempt + 1})")
+                time.sleep(2)  # Wait before retrying
+            else:
+                logging.error("Exceeded maximum retry attempts to start the server.")
+                raise
 
-        # Ensure the previous server is properly shut down
-        if current_server:
-            logging.debug("Stopping the existing server before rehosting...")
-            current_server.shutdown()
-            current_server.server_close()
-            current_server = None
-            time.sleep(1)  # Ensure the port is fully released before trying to bind again
+    # Until a release is processed, serve the newest versioned copy (or the release folder's RRHE.apk)
+    existing_folders = version_folders(version_control_folder)
+    if existing_folders:
+        if publish_apk(existing_folders[-1]):
+            publish_patches(existing_folders[-1])
+    elif not os.path.exists(os.path.join(watch_folder, rrhe_apk)):
+        logging.debug(f"No {rrhe_apk} found to host yet.")
+    return current_server
 
-        # Attempt to start the server with retries
-        for attempt in range(3):
-            try:
-                # Always use the external IP for the download link
-                download_link = f"http://{external_ip}/{rrhe_apk}"
-                logging.debug(f"APK will be hosted at: {download_link}")
-                os.chdir(watch_folder)
-                handler = SimpleHTTPRequestHandler
-                httpd = ReusableTCPServer(("", port), handler)
-                server_thread = threading.Thread(target=httpd.serve_forever)
-                server_thread.daemon = True
-                server_thread.start()
-                logging.debug(f"Serving at: {download_link}")
-                current_server = httpd
-                return httpd
-            except OSError as e:
-                logging.error(f"Failed to bind to port {port}. Error: {e}")
-                if attempt < 2:
-                    logging.debug(f"Retrying to start the server... (Attempt {attempt + 1})")
-                    time.sleep(2)  # Wait before retrying
-                else:
-                    logging.error("Exceeded maximum retry attempts to start the server.")
-                    raise
+def publish_apk(version_folder):
+    """Points /RRHE.apk at the copy in version_folder, which never changes once written.
+
+    The swap is a single reference assignment in the running server: the next request gets the new
+    APK, and downloads already under way finish on the file they opened.
+    """
+    apk_path = os.path.join(version_control_folder, version_folder, rrhe_apk)
+    if not os.path.exists(apk_path):
+        logging.warning(f"{apk_path} not found, keeping the currently published APK")
+        return False
+    current_server.publish(rrhe_apk, apk_path)
+    return True
+
+def publish_patches(version_folder):
+    """Serves the patches built for version_folder; if it has none, or version_folder is None, withdraws
+    the current ones (so /patch redirects to the full APK and /patches.json is gone)."""
+    manifest = load_patches(version_control_folder, version_folder) if version_folder else None
+    folder_path = os.path.join(version_control_folder, version_folder or '')
+    current_server.publish_patches(manifest, folder_path)
+    if manifest is not None:
+        current_server.publish('patches.json', os.path.join(folder_path, 'patches.json'))
     else:
-        logging.debug(f"No {rrhe_apk} found to host.")
-        return None
+        current_server.unpublish('patches.json')
 
 # Function to process the new app-release.apk file
 def process_new_apk(file_path):
-    global current_server, last_version_folder  # Ensure you're modifying the global variables
+    with release_lock:
+        _process_new_apk(file_path)
+
+def _process_new_apk(file_path):
+    global last_version_folder  # Ensure you're modifying the global variable
     logging.debug(f"Processing new APK: {file_path}")
     
     # Rename the new app-release.apk to RRHE.apk
@@ -133,44 +157,74 @@ def process_new_apk(file_path):
     move(file_path, os.path.join(watch_folder, rrhe_apk))
     logging.debug(f"Successfully renamed {app_release_apk} to {rrhe_apk}")
 
+    # Claimed before the copy starts, so the version control watcher, which compares against
+    # last_version_folder under release_lock, never takes the folder being written for a new one
+    new_version_folder = f"RRHE_{get_next_version()}"
+    previous_version_folder, last_version_folder = last_version_folder, new_version_folder
+
     # Copy the release folder to version control
     logging.debug("Copying release folder to version control...")
-    new_version_folder = copy_to_version_control()
+    copy_to_version_control(new_version_folder)
 
     # If a new version folder was created, update the hosting and notify users
-    if new_version_folder != last_version_folder:
-        last_version_folder = new_version_folder
-        logging.debug("New version detected, reloading URL and notifying users...")
-        
-        # Stop the current hosting server if running
-        if current_server:
-            logging.debug("Stopping the existing server before rehosting...")
-            current_server.shutdown()
-            current_server.server_close()
-            current_server = None
+    if new_version_folder != previous_version_folder:
+        logging.debug("New version detected, publishing it and notifying users...")
 
-        # Start hosting the newly renamed RRHE.apk
-        logging.debug("Restarting to host the newly renamed RRHE.apk...")
-        current_server = start_hosting()
+        # The previous release's patches end at the APK being replaced, so they go first
+        publish_patches(None)
+        # The server keeps running; only what /RRHE.apk points at changes
+        if publish_apk(new_version_folder):
+            # Built before the notification goes out, so the burst of downloads it causes can use them
+            try:
+                build_patches(version_control_folder, new_version_folder, rrhe_apk, patch_history, patch_max_ratio)
+            except Exception as e:
+                logging.error(f"Error building patches for {new_version_folder}: {e}")
+            publish_patches(new_version_folder)
 
         # Send a notification to all devices subscribed to the topic
         send_fcm_notification(fcm_topic, "New APK Available", "A new version of RRHE is available for download.")
 
+def apk_is_settled(path):
+    """True once path's size and mtime held still for release_settle_interval; False if it vanished or kept changing."""
+    previous = None
+    for _ in range(release_settle_attempts):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return False
+        current = (stat.st_size, stat.st_mtime_ns)
+        if current == previous:
+            return True
+        previous = current
+        time.sleep(release_settle_interval)
+    return False
+
+def check_release_folder(names=None):
+    # None (startup), an empty set (folder recreated) or '' (inotify overflow) mean any file may have changed
+    if names and app_release_apk not in names and '' not in names:
+        return
+    apk_path = os.path.join(watch_folder, app_release_apk)
+    if not os.path.exists(apk_path):
+        return
+    # Gradle may close and reopen the APK while signing it, so a close event alone doesn't mean it's done
+    if not apk_is_settled(apk_path):
+        logging.warning(f"{app_release_apk} is still changing, waiting for its next write to finish")
+        return
+    logging.debug(f"New APK detected: {app_release_apk}")
+    process_new_apk(apk_path)
+
 # Monitor the release folder for new APK files
 def monitor_release_folder():
     logging.debug("Monitoring release folder for new APK files...")
-    while True:
-        time.sleep(5)  # Adjust the sleep time as necessary
-        if os.path.exists(os.path.join(watch_folder, app_release_apk)):
-            logging.debug(f"New APK detected: {app_release_apk}")
-            process_new_apk(os.path.join(watch_folder, app_release_apk))
+    check_release_folder()  # A build finished while the monitor wasn't running
+    # Fires once Gradle has closed (or renamed in) the APK and the build went quiet, never mid-write
+    FolderWatcher(watch_folder, check_release_folder, debounce=release_debounce,
+                  poll_interval=release_poll_interval).run()
 
-# Monitor the version control folder for new versions
-def monitor_version_control_folder():
+def check_version_control_folder(names=None):
     global last_version_folder
-    logging.debug("Monitoring version control folder for new versions...")
-    while True:
-        time.sleep(10)  # Adjust the sleep time as necessary
+    # Under release_lock, so a release being processed has already claimed its folder (or is done)
+    with release_lock:
         existing_folders = [
             d for d in os.listdir(version_control_folder)
             if d.startswith('RRHE_')
@@ -183,7 +237,15 @@ def monitor_version_control_folder():
                 # Trigger the notification and hosting update
                 current_apk_path = os.path.join(watch_folder, rrhe_apk)
                 if os.path.exists(current_apk_path):
-                    process_new_apk(current_apk_path)
+                    _process_new_apk(current_apk_path)
+
+# Monitor the version control folder for new versions
+def monitor_version_control_folder():
+    logging.debug("Monitoring version control folder for new versions...")
+    check_version_control_folder()
+    # Version folders are only listed and parsed again when one is added, renamed or removed
+    FolderWatcher(version_control_folder, check_version_control_folder, debounce=version_control_debounce,
+                  poll_interval=version_control_poll_interval).run()
 
 # Function to send FCM notification to a topic
 def send_fcm_notification(topic, title, body):
@@ -228,7 +290,7 @@ if __name__ == "__main__":
     logging.debug("Starting the APK monitoring script...")
 
     try:
-        # Start hosting RRHE.apk if it exists
+        # Start the download server; it runs until the script exits
         current_server = start_hosting()
 
         # Monitor the release folder and version control folder concurrently
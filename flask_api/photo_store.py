@@ -0,0 +1,378 @@
+#! /home/mcmeister/myflaskenv/bin/python
+"""Content-addressed storage behind the {StockID}_{n}.jpg photo files.
+
+Every photo's bytes are kept once, as blobs/<hash[:2]>/<hash>.jpg under the store directory, and the
+file in the photo folder is a hard link to its blob. Anything that reads the photo folder (get_file,
+thumbnails, Drive sync) still sees plain files, identical uploads take the space of one, and the
+versions a name has had are recorded in index.sqlite3 instead of as _old copies next to it.
+
+Names with the same content share one inode with their blob, so a write *into* one of those files
+would change every one of them and the stored version at once. Blobs (and so the linked photos) are
+therefore read-only: anything that edits a photo has to replace the file, as put() and Drive's sync
+client do, which gives it a new inode. compact() re-hashes the blobs as a backstop and re-indexes any
+whose bytes changed anyway. When the store is on another filesystem than the photo folder, photos
+are plain copies and none of this applies.
+
+New links and copies are prepared under a temp name outside the photo folder and renamed into place,
+so the synced folder never shows a half-written or temporary file.
+
+Run as a script to maintain the store:
+
+    photo_store.py migrate [--adopt-old]   # link existing photos (and their _old copies) into the store
+    photo_store.py compact [--keep-days N] [--skip-verify]
+                                           # delete blobs no photo or recent history entry refers to
+    photo_store.py history <filename>
+"""
+import argparse
+import hashlib
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+PHOTO_FOLDER = '/home/mcmeister/Documents/GDrive_Photos/'
+# Next to the photo folder, so blobs can be hard linked (same filesystem) but are never synced to Drive
+PHOTO_STORE_DIR = os.environ.get('RRHE_PHOTO_STORE_DIR', '/home/mcmeister/Documents/RRHE_PhotoStore')
+HISTORY_KEEP_DAYS = 90  # Replaced versions younger than this survive compaction
+TEMP_MAX_AGE = 24 * 3600  # Seconds before compaction treats a temp file as abandoned
+BLOB_MODE = 0o444  # Shared by every hard-linked name, so no one of them can be written in place
+COPY_MODE = 0o644  # Photos copied (not linked) from another filesystem's store are independent files
+# Where link and copy temp files go when the store can't be used for that: next to, not inside, the synced folder
+LINK_TEMP_DIR_NAME = '.rrhe_photo_tmp'
+
+OLD_COPY_PATTERN = re.compile(r'^(?P<base>.+?)_old(?:_(?P<counter>\d+))?(?P<ext>\.[^.]+)$')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS photos (
+    Name TEXT PRIMARY KEY,
+    Hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS history (
+    ID INTEGER PRIMARY KEY AUTOINCREMENT,
+    Name TEXT NOT NULL,
+    Hash TEXT,  -- NULL records a deletion
+    At REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_history_name ON history (Name, ID);
+CREATE INDEX IF NOT EXISTS idx_history_hash ON history (Hash);
+"""
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class PhotoStore:
+    """Hard-linked, deduplicated photo files with a history index; safe to share between processes.
+
+    Every change runs inside one SQLite write transaction, so compaction (which takes the same lock)
+    can never delete a blob that a concurrent put() is about to link.
+    """
+
+    def __init__(self, photo_dir, store_dir):
+        self.photo_dir = photo_dir
+        self.store_dir = store_dir
+        self.blob_dir = os.path.join(store_dir, 'blobs')
+        self.temp_dir = os.path.join(store_dir, 'tmp')
+        os.makedirs(self.blob_dir, exist_ok=True)
+        os.makedirs(self.temp_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(store_dir, 'index.sqlite3'), timeout=30,
+                                   isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+
+    def temp_path(self):
+        """A fresh path on the store's filesystem, for writing a file that will be passed to put()."""
+        return os.path.join(self.temp_dir, f"{uuid.uuid4().hex}.tmp")
+
+    def put(self, name, source_path, at=None):
+        """Stores source_path's bytes as photo name, consuming source_path; returns the content hash.
+
+        The previous file under name stays available as a history entry until compaction.
+        """
+        content_hash = file_hash(source_path)
+        with self._transaction():
+            self._adopt_unindexed(name)
+            blob_path = self._blob_path(content_hash)
+            if os.path.exists(blob_path):
+                os.remove(source_path)  # Already stored, by this name or another
+            else:
+                self._store_blob(source_path, blob_path)
+            self._record(name, content_hash, at)
+            self._link(blob_path, name)
+        return content_hash
+
+    def delete(self, name):
+        """Removes photo name; returns False if there was no such file."""
+        with self._transaction():
+            self._adopt_unindexed(name)
+            try:
+                os.remove(os.path.join(self.photo_dir, name))
+                existed = True
+            except FileNotFoundError:
+                existed = False
+            if self._current(name) is not None:
+                self._db.execute("DELETE FROM photos WHERE Name = ?", (name,))
+                self._db.execute("INSERT INTO history (Name, Hash, At) VALUES (?, NULL, ?)", (name, time.time()))
+        return existed
+
+    def rename(self, old_name, new_name):
+        """Moves photo old_name to new_name (e.g. a temporary StockID's photo to the real one)."""
+        with self._transaction():
+            os.replace(os.path.join(self.photo_dir, old_name), os.path.join(self.photo_dir, new_name))
+            content_hash = self._current(old_name)
+            if content_hash is not None:
+                self._db.execute("DELETE FROM photos WHERE Name = ?", (old_name,))
+                self._record(new_name, content_hash)
+
+    def history(self, name):
+        """Versions of name, oldest first, as (hash, timestamp) with hash None for a deletion."""
+        with self._lock:
+            return self._db.execute("SELECT Hash, At FROM history WHERE Name = ? ORDER BY At, ID", (name,)).fetchall()
+
+    def migrate(self, adopt_old=False):
+        """Links every photo not yet in the store; with adopt_old, also files rename_file_if_exists kept.
+
+        Adopted _old copies become history entries of their base name, dated by their mtime, and are
+        deleted from the photo folder. Returns (photos, old copies) adopted.
+        """
+        photos, old_copies = 0, []
+        for entry in sorted(os.scandir(self.photo_dir), key=lambda entry: entry.name):
+            if not entry.is_file() or entry.name.endswith('.tmp'):
+                continue
+            match = OLD_COPY_PATTERN.match(entry.name)
+            if match:
+                old_copies.append((match, entry))
+                continue
+            with self._transaction():
+                if self._adopt_unindexed(entry.name):
+                    photos += 1
+
+        adopted = 0
+        if adopt_old:
+            # Oldest first, so history reads in the order the versions were replaced
+            for match, entry in sorted(old_copies, key=lambda item: item[1].stat().st_mtime):
+                name = f"{match.group('base')}{match.group('ext')}"
+                uploaded_at = entry.stat().st_mtime  # os.rename kept the mtime of when this version was saved
+                content_hash = file_hash(entry.path)
+                with self._transaction():
+                    blob_path = self._blob_path(content_hash)
+                    if os.path.exists(blob_path):
+                        os.remove(entry.path)
+                    else:
+                        self._store_blob(entry.path, blob_path)
+                    self._db.execute("INSERT INTO history (Name, Hash, At) VALUES (?, ?, ?)",
+                                     (name, content_hash, uploaded_at))
+                adopted += 1
+        return photos, adopted
+
+    def compact(self, keep_days=HISTORY_KEEP_DAYS, verify=True):
+        """Deletes blobs that no photo uses and no history entry from the last keep_days refers to.
+
+        With verify, first re-hashes every blob and re-indexes any that was changed in place (see the
+        module docstring). Returns (blobs removed, bytes freed).
+        """
+        if verify:
+            self.verify()
+        cutoff = time.time() - keep_days * 24 * 3600
+        removed, freed = 0, 0
+        with self._transaction():
+            self._db.execute("""
+                DELETE FROM history
+                WHERE At < ? AND (Hash IS NULL OR Hash NOT IN (SELECT Hash FROM photos))
+            """, (cutoff,))
+            referenced = {row[0] for row in self._db.execute(
+                "SELECT Hash FROM photos UNION SELECT Hash FROM history WHERE Hash IS NOT NULL")}
+            for blob_path in self._blob_paths():
+                if os.path.splitext(os.path.basename(blob_path))[0] in referenced:
+                    continue
+                freed += os.path.getsize(blob_path)
+                os.remove(blob_path)
+                removed += 1
+        for temp in os.scandir(self.temp_dir):
+            if temp.stat().st_mtime < time.time() - TEMP_MAX_AGE:
+                os.remove(temp.path)
+        return removed, freed
+
+    def verify(self):
+        """Re-hashes every blob; one whose bytes no longer match its name was written through a linked photo.
+
+        Its content is kept as what the photos still linked to it now show: the blob moves to its new
+        hash, and each of those photos is recorded as a new version. The bytes it had before are gone,
+        so history entries of the old hash point at a missing blob. Returns the number of blobs fixed.
+        """
+        fixed = 0
+        for blob_path in self._blob_paths():
+            expected = os.path.splitext(os.path.basename(blob_path))[0]
+            os.chmod(blob_path, BLOB_MODE)  # Blobs stored before they were made read-only
+            if file_hash(blob_path) == expected:
+                continue
+            with self._transaction():
+                actual = file_hash(blob_path)  # Again under the lock, in case put() raced with the first read
+                if actual == expected:
+                    continue
+                stat = os.stat(blob_path)
+                linked = [name for name, in self._db.execute("SELECT Name FROM photos WHERE Hash = ?", (expected,))
+                          if self._same_file(os.path.join(self.photo_dir, name), stat)]
+                new_blob_path = self._blob_path(actual)
+                if os.path.exists(new_blob_path):
+                    os.remove(blob_path)
+                else:
+                    os.makedirs(os.path.dirname(new_blob_path), exist_ok=True)
+                    os.replace(blob_path, new_blob_path)
+                    os.chmod(new_blob_path, BLOB_MODE)
+                for name in linked:
+                    self._record(name, actual, stat.st_mtime)
+                    self._link(new_blob_path, name)
+            fixed += 1
+            # Not silent: something wrote into a read-only photo, and the version before it is lost
+            logger.error(f"Blob {expected} was changed in place; re-indexed as {actual} for {linked}")
+        return fixed
+
+    def _blob_paths(self):
+        for prefix in os.scandir(self.blob_dir):
+            if prefix.is_dir():
+                for blob in os.scandir(prefix.path):
+                    yield blob.path
+
+    @staticmethod
+    def _same_file(path, stat):
+        try:
+            return os.path.samestat(os.stat(path), stat)
+        except FileNotFoundError:
+            return False
+
+    def _store_blob(self, source_path, blob_path):
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        os.chmod(source_path, BLOB_MODE)
+        os.replace(source_path, blob_path)
+
+    def _transaction(self):
+        return _Transaction(self)
+
+    def _blob_path(self, content_hash):
+        return os.path.join(self.blob_dir, content_hash[:2], f"{content_hash}.jpg")
+
+    def _current(self, name):
+        row = self._db.execute("SELECT Hash FROM photos WHERE Name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def _record(self, name, content_hash, at=None):
+        self._db.execute("INSERT OR REPLACE INTO photos (Name, Hash) VALUES (?, ?)", (name, content_hash))
+        self._db.execute("INSERT INTO history (Name, Hash, At) VALUES (?, ?, ?)",
+                         (name, content_hash, time.time() if at is None else at))
+
+    def _link(self, blob_path, name):
+        """Points name at blob_path in one rename, so readers see either the old photo or the new one."""
+        # Renaming the temp file into the photo folder needs it on the photo folder's filesystem
+        hard_links = os.stat(self.store_dir).st_dev == os.stat(self.photo_dir).st_dev
+        if hard_links:
+            temp_dir = self.temp_dir
+        else:
+            temp_dir = os.path.join(os.path.dirname(os.path.normpath(self.photo_dir)), LINK_TEMP_DIR_NAME)
+            os.makedirs(temp_dir, exist_ok=True)
+        temp_path = os.path.join(temp_dir, f"{uuid.uuid4().hex}.tmp")
+        try:
+            if hard_links:
+                os.link(blob_path, temp_path)
+            else:
+                shutil.copy2(blob_path, temp_path)  # Store on another filesystem: a copy, but still indexed
+                os.chmod(temp_path, COPY_MODE)
+            os.replace(temp_path, os.path.join(self.photo_dir, name))
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+    def _adopt_unindexed(self, name):
+        """Brings a photo written before the store existed, or replaced behind its back, into it.
+
+        Only called inside a transaction. Returns True if name was adopted.
+        """
+        path = os.path.join(self.photo_dir, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return False
+        content_hash = self._current(name)
+        if content_hash is not None:
+            try:
+                if os.path.samestat(stat, os.stat(self._blob_path(content_hash))):
+                    return False
+            except FileNotFoundError:
+                pass
+        content_hash = file_hash(path)
+        blob_path = self._blob_path(content_hash)
+        if not os.path.exists(blob_path):
+            temp_path = self.temp_path()
+            shutil.copy2(path, temp_path)
+            self._store_blob(temp_path, blob_path)
+        self._record(name, content_hash, stat.st_mtime)
+        self._link(blob_path, name)
+        return True
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT under the store's thread lock; rolls back if the block raises."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def __enter__(self):
+        self.store._lock.acquire()
+        try:
+            self.store._db.execute("BEGIN IMMEDIATE")
+        except Exception:
+            self.store._lock.release()
+            raise
+        return self.store._db
+
+    def __exit__(self, exc_type, exc, traceback):
+        try:
+            self.store._db.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self.store._lock.release()
+        return False
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Maintain the content-addressed photo store")
+    parser.add_argument('--photo-dir', default=PHOTO_FOLDER)
+    parser.add_argument('--store-dir', default=PHOTO_STORE_DIR)
+    commands = parser.add_subparsers(dest='command', required=True)
+    migrate_parser = commands.add_parser('migrate', help="link existing photos into the store")
+    migrate_parser.add_argument('--adopt-old', action='store_true',
+                                help="also move _old copies into the store as history, "
+                                     "removing them from the photo folder")
+    compact_parser = commands.add_parser('compact', help="delete blobs nothing refers to anymore")
+    compact_parser.add_argument('--keep-days', type=float, default=HISTORY_KEEP_DAYS,
+                                help="keep replaced versions this many days (default %(default)s)")
+    compact_parser.add_argument('--skip-verify', action='store_true',
+                                help="don't re-hash blobs to catch photos written in place")
+    history_parser = commands.add_parser('history', help="list the versions of one photo")
+    history_parser.add_argument('filename')
+    args = parser.parse_args()
+
+    store = PhotoStore(args.photo_dir, args.store_dir)
+    if args.command == 'migrate':
+        photos, adopted = store.migrate(adopt_old=args.adopt_old)
+        print(f"Linked {photos} photos into the store, adopted {adopted} _old copies")
+    elif args.command == 'compact':
+        removed, freed = store.compact(keep_days=args.keep_days, verify=not args.skip_verify)
+        print(f"Removed {removed} blobs, freed {freed / (1024 * 1024):.1f} MB")
+    else:
+        for content_hash, at in store.history(args.filename):
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(at))}  {content_hash or 'deleted'}")
@@ -0,0 +1,149 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class BatchRejected(Exception):
+    """Raised by send_batch when the DB server refused the batch itself, so sending it again can't help."""
+
+
+class PhotoUpdateQueue:
+    """Photo column updates waiting to reach the DB server, kept in a JSON file until it accepts them.
+
+    Updates are keyed by (stockID, photoIndex), so a photo replaced several times while the DB server
+    is slow or down is sent once, with its latest URL. A background thread sends up to batch_size of
+    them per call to send_batch(updates) and retries failures with exponential backoff, except
+    BatchRejected, which means the DB server rejected the batch without applying any of it: the batch
+    is split in halves and resent until only the rejected entries are left, and those are dropped.
+    The file is rewritten atomically on every change, so an accepted upload survives a restart; it
+    belongs to one process, so run http_server with a single worker process.
+    """
+
+    def __init__(self, path, send_batch, batch_size, max_backoff):
+        self.path = path
+        self._send_batch = send_batch
+        self.batch_size = batch_size
+        self.max_backoff = max_backoff
+        self._condition = threading.Condition()
+        self._pending = {}  # (stockID, photoIndex) -> photoUrl (None clears the column), oldest first
+        self._thread = None
+        self.sent = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.failures = 0
+        self.last_error = None
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._load()
+
+    def put(self, stock_id, photo_index, photo_url):
+        key = (str(stock_id), str(photo_index))
+        with self._condition:
+            if key in self._pending:
+                self.coalesced += 1
+                del self._pending[key]  # Re-inserted at the end, keeping the dict in arrival order
+            self._pending[key] = photo_url
+            self._save()
+            self._condition.notify()
+        self.start()
+
+    def start(self):
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def stats(self):
+        with self._condition:
+            return {
+                'pending': len(self._pending),
+                'sent': self.sent,
+                'coalesced': self.coalesced,
+                'rejected': self.rejected,
+                'failures': self.failures,
+                'last_error': self.last_error,
+            }
+
+    def _run(self):
+        backoff = 1
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending)
+                batch = list(self._pending.items())[:self.batch_size]
+
+            try:
+                sent = self._deliver(batch)
+            except Exception as e:
+                with self._condition:
+                    self.failures += 1
+                    self.last_error = str(e)
+                delay = backoff * random.uniform(0.5, 1.0)  # Jitter, so a recovering DB server isn't hit in step
+                logger.warning(f"Photo column update of {len(batch)} entries failed, retrying in {delay:.1f}s: {str(e)}")
+                backoff = min(backoff * 2, self.max_backoff)
+                time.sleep(delay)
+                continue
+
+            backoff = 1
+            with self._condition:
+                self.last_error = None
+            logger.info(f"Sent {sent} photo column updates to the DB server")
+
+    def _deliver(self, batch):
+        """Sends batch, removing what was sent or rejected from the queue; returns how many were sent.
+
+        A rejected batch is bisected until each rejected entry is on its own, so one bad entry costs
+        about log2(batch_size) extra requests instead of the rest of its batch.
+        """
+        try:
+            self._send_batch([{'stockID': stock_id, 'photoIndex': photo_index, 'photoUrl': photo_url}
+                              for (stock_id, photo_index), photo_url in batch])
+        except BatchRejected as e:
+            if len(batch) > 1:
+                middle = len(batch) // 2
+                return self._deliver(batch[:middle]) + self._deliver(batch[middle:])
+            (stock_id, photo_index), photo_url = batch[0]
+            logger.error(f"DB server rejected the Photo{photo_index} update of StockID {stock_id} "
+                         f"to {photo_url}, dropping it: {str(e)}")
+            with self._condition:
+                self.rejected += 1
+            self._remove(batch)
+            return 0
+        with self._condition:
+            self.sent += len(batch)
+        self._remove(batch)
+        return len(batch)
+
+    def _remove(self, batch):
+        with self._condition:
+            for key, photo_url in batch:
+                # A newer URL queued while this batch was in flight still has to be sent
+                if key in self._pending and self._pending[key] == photo_url:
+                    del self._pending[key]
+            self._save()
+
+    def _save(self):
+        temp_path = f"{self.path}.tmp"
+        entries = [[stock_id, photo_index, photo_url] for (stock_id, photo_index), photo_url in self._pending.items()]
+        with open(temp_path, 'w') as file:
+            json.dump(entries, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.path)
+
+    def _load(self):
+        try:
+            with open(self.path) as file:
+                entries = json.load(file)
+        except FileNotFoundError:
+            return
+        except ValueError as e:
+            logger.error(f"Ignoring unreadable photo update queue {self.path}: {str(e)}")
+            return
+        for stock_id, photo_index, photo_url in entries:
+            self._pending[(stock_id, photo_index)] = photo_url
+        if self._pending:
+            logger.info(f"Loaded {len(self._pending)} unsent photo column updates")
@@ -0,0 +1,44 @@
+import collections
+import hashlib
+import os
+import threading
+
+VERSION_LENGTH = 16  # Hex digits of the SHA-256 kept; plenty to tell versions of one photo apart
+
+
+class PhotoVersions:
+    """Content hashes of photo files, remembered per (path, mtime, size) so a file is hashed once per change.
+
+    The hash doubles as the strong ETag of the photo and as the ?v= parameter written into the
+    Photo1..4 URLs, which lets a response for a matching ?v= be cached as immutable.
+    """
+
+    def __init__(self, max_entries=20000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._versions = collections.OrderedDict()  # path -> (mtime_ns, size, version)
+
+    def version(self, path):
+        stat = os.stat(path)
+        with self._lock:
+            cached = self._versions.get(path)
+            if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+                self._versions.move_to_end(path)
+                return cached[2]
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1024 * 1024), b''):
+                digest.update(block)
+        version = digest.hexdigest()[:VERSION_LENGTH]
+
+        with self._lock:
+            self._versions[path] = (stat.st_mtime_ns, stat.st_size, version)
+            self._versions.move_to_end(path)
+            while len(self._versions) > self.max_entries:
+                self._versions.popitem(last=False)
+        return version
+
+
+def versioned_url(url, version):
+    return f"{url}?v={version}"
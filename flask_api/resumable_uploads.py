@@ -0,0 +1,214 @@
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class UploadError(Exception):
+    """A request that doesn't fit the session's state; carries the HTTP status to answer with."""
+
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset  # Bytes the server holds, so the client knows where to resume
+
+
+class UploadStaging:
+    """Partial uploads kept in directory until they are complete, then moved into place in one rename.
+
+    Each session is <id>.part (the bytes received so far) plus <id>.json (filename, expected size and
+    optional SHA-256). Both are plain files, so a session survives a server restart; the .part size is
+    the resume offset. Sessions untouched for ttl seconds are deleted by collect_garbage().
+    """
+
+    def __init__(self, directory, ttl, max_size):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._session_locks = {}  # Upload id -> Lock, so two chunk requests for one session can't interleave
+        os.makedirs(directory, exist_ok=True)
+
+    def create(self, filename, size, sha256=None):
+        if size <= 0:
+            raise UploadError("Upload size must be positive")
+        if size > self.max_size:
+            raise UploadError(f"Upload size is limited to {self.max_size} bytes", 413)
+        upload_id = uuid.uuid4().hex
+        meta = {'filename': filename, 'size': size, 'sha256': sha256.lower() if sha256 else None,
+                'created': time.time()}
+        with open(self._part_path(upload_id), 'wb'):
+            pass
+        self._write_meta(upload_id, meta)
+        logger.info(f"Started upload {upload_id} for {filename} ({size} bytes)")
+        return upload_id
+
+    def status(self, upload_id):
+        meta = self._read_meta(upload_id)
+        return {'uploadId': upload_id, 'filename': meta['filename'], 'size': meta['size'],
+                'offset': self._received(upload_id)}
+
+    def write_chunk(self, upload_id, offset, stream, length):
+        """Appends length bytes from stream at offset, which must equal the bytes received so far.
+
+        A chunk that was received but whose response was lost is re-sent at an offset the server has
+        already passed; that answers 409 with the current offset instead of writing the bytes twice.
+        """
+        with self._session(upload_id):
+            meta = self._read_meta(upload_id)
+            part_path = self._part_path(upload_id)
+            received = self._received(upload_id)
+            if offset != received:
+                raise UploadError(f"Expected offset {received}", 409, received)
+            if length is None or received + length > meta['size']:
+                raise UploadError(f"Chunk would exceed the declared size of {meta['size']} bytes", 400, received)
+
+            written = 0
+            with open(part_path, 'r+b') as part:
+                part.seek(offset)
+                try:
+                    while written < length:
+                        block = stream.read(min(1024 * 1024, length - written))
+                        if not block:
+                            break
+                        part.write(block)
+                        written += len(block)
+                finally:
+                    # A dropped connection keeps what arrived; the client resumes from the new offset
+                    part.truncate(offset + written)
+                    part.flush()
+                    os.fsync(part.fileno())
+            return offset + written
+
+    def finish(self, upload_id, target_path):
+        """Checks the session is complete and renames it to target_path; returns the session's metadata."""
+        with self._session(upload_id):
+            meta = self._read_meta(upload_id)
+            part_path = self._part_path(upload_id)
+            received = self._received(upload_id)
+            if received != meta['size']:
+                raise UploadError(f"Upload incomplete: {received} of {meta['size']} bytes", 409, received)
+            if meta['sha256']:
+                digest = hashlib.sha256()
+                with open(part_path, 'rb') as part:
+                    for block in iter(lambda: part.read(1024 * 1024), b''):
+                        digest.update(block)
+                if digest.hexdigest() != meta['sha256']:
+                    # The bytes can't be trusted at any offset, so the client has to start over
+                    self._delete(upload_id)
+                    raise UploadError("Checksum mismatch, upload discarded", 422)
+            # Same filesystem is not guaranteed, so copy next to the target first and rename there
+            if os.stat(part_path).st_dev != os.stat(os.path.dirname(target_path)).st_dev:
+                temp_path = f"{target_path}.{upload_id}.tmp"
+                with open(part_path, 'rb') as source, open(temp_path, 'wb') as target:
+                    for block in iter(lambda: source.read(1024 * 1024), b''):
+                        target.write(block)
+                    target.flush()
+                    os.fsync(target.fileno())
+                os.replace(temp_path, target_path)
+            else:
+                os.replace(part_path, target_path)
+            self._delete(upload_id)
+        logger.info(f"Finished upload {upload_id} as {target_path}")
+        return meta
+
+    def cancel(self, upload_id):
+        with self._session(upload_id):
+            self._delete(upload_id)
+        logger.info(f"Cancelled upload {upload_id}")
+
+    def collect_garbage(self):
+        """Deletes sessions with no chunk or status request for ttl seconds; returns how many."""
+        cutoff = time.time() - self.ttl
+        upload_ids = {os.path.splitext(name)[0] for name in os.listdir(self.directory)
+                      if name.endswith(('.part', '.json'))}
+        removed = 0
+        for upload_id in upload_ids:
+            with self._session_lock(upload_id):
+                mtimes = []
+                for path in (self._part_path(upload_id), self._meta_path(upload_id)):
+                    try:
+                        mtimes.append(os.path.getmtime(path))
+                    except FileNotFoundError:
+                        pass
+                # A session is stale only if neither of its files has been touched since the cutoff
+                if not mtimes or max(mtimes) >= cutoff:
+                    continue
+                self._delete(upload_id)
+            with self._lock:
+                self._session_locks.pop(upload_id, None)
+            removed += 1
+            logger.info(f"Removed stale upload {upload_id}")
+        return removed
+
+    @contextlib.contextmanager
+    def _session(self, upload_id):
+        """Holds the lock of an existing session; unknown ids get a 404 without a lock being made for them."""
+        self._check_id(upload_id)
+        if not os.path.exists(self._meta_path(upload_id)):
+            raise UploadError("Unknown upload", 404)
+        with self._session_lock(upload_id):
+            try:
+                yield
+            finally:
+                if not os.path.exists(self._meta_path(upload_id)):
+                    # Finished, cancelled or discarded, by this request or one that held the lock before it
+                    with self._lock:
+                        self._session_locks.pop(upload_id, None)
+
+    def _session_lock(self, upload_id):
+        with self._lock:
+            return self._session_locks.setdefault(upload_id, threading.Lock())
+
+    def _part_path(self, upload_id):
+        return os.path.join(self.directory, f"{upload_id}.part")
+
+    def _meta_path(self, upload_id):
+        return os.path.join(self.directory, f"{upload_id}.json")
+
+    @staticmethod
+    def _check_id(upload_id):
+        # Ids are uuid4 hex, which also keeps them from naming anything outside the directory
+        if len(upload_id) != 32 or not all(c in '0123456789abcdef' for c in upload_id):
+            raise UploadError("Unknown upload", 404)
+
+    def _read_meta(self, upload_id):
+        self._check_id(upload_id)
+        try:
+            with open(self._meta_path(upload_id)) as file:
+                meta = json.load(file)
+            os.utime(self._meta_path(upload_id))  # Any activity keeps the session from being collected
+            return meta
+        except FileNotFoundError:
+            raise UploadError("Unknown upload", 404)
+
+    def _received(self, upload_id):
+        """Size of the session's .part file; a session whose .part is gone is dropped with a 410."""
+        try:
+            return os.path.getsize(self._part_path(upload_id))
+        except FileNotFoundError:
+            # Deleted from outside (cleanup, disk full recovery); the metadata alone can't be resumed
+            self._delete(upload_id)
+            with self._lock:
+                self._session_locks.pop(upload_id, None)
+            logger.warning(f"Upload {upload_id} lost its data file; dropped the session")
+            raise UploadError("Upload data is gone, start a new upload", 410)
+
+    def _write_meta(self, upload_id, meta):
+        temp_path = f"{self._meta_path(upload_id)}.tmp"
+        with open(temp_path, 'w') as file:
+            json.dump(meta, file)
+        os.replace(temp_path, self._meta_path(upload_id))
+
+    def _delete(self, upload_id):
+        for path in (self._part_path(upload_id), self._meta_path(upload_id)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,195 @@
+import bisect
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class StockReplica:
+    """In-process copy of the stock table, kept as pre-serialized rows sorted by (Stamp, StockID).
+
+    Answering "every row with Stamp > t" is a binary search plus a concatenation of cached bytes.
+    The owner keeps it current by calling upsert()/remove() after its own writes and by running a
+    periodic catch-up; anything that may have left it inconsistent should call invalidate(), after
+    which it reports misses until the next load().
+    """
+
+    def __init__(self, wire_format, encode_row, stamp_index, max_bytes):
+        self.wire_format = wire_format  # The only representation held; other formats are misses
+        self._encode_row = encode_row  # Returns the row's bytes, or None for rows that can't be encoded
+        self._stamp_index = stamp_index
+        self.max_bytes = max_bytes  # Counts encoded row bytes; index overhead comes on top
+        self._instance = os.urandom(4).hex()  # Keeps version() unique across restarts
+        self._lock = threading.RLock()
+        self._keys = []  # Sorted (Stamp, StockID)
+        self._entries = {}  # StockID -> (Stamp, encoded row)
+        self._bytes = 0
+        self.ready = False
+        self.enabled = True
+        self.change_id = 0  # Change-log position the replica has caught up to
+        self.revision = 0
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.invalidations = 0
+
+    def load(self, rows, change_id):
+        """Replaces the contents with rows, which should be read no earlier than change_id was.
+
+        The new index is built outside the lock, so readers keep being served from the old one meanwhile.
+        """
+        keys, entries, size = [], {}, 0
+        for row in rows:
+            encoded = self._encode(row)
+            if encoded is None:
+                continue
+            stock_id, stamp = row[0], row[self._stamp_index]
+            keys.append((stamp, stock_id))
+            entries[stock_id] = (stamp, encoded)
+            size += len(encoded)
+            if size > self.max_bytes:
+                with self._lock:
+                    self._overflow()
+                return
+        keys.sort()
+
+        with self._lock:
+            self._keys, self._entries, self._bytes = keys, entries, size
+            self.change_id = change_id
+            self.ready = True
+            self.loads += 1
+            self.revision += 1
+        logger.info(f"Stock replica loaded: {len(entries)} rows, {size} bytes, change log at {change_id}")
+
+    def upsert(self, rows):
+        with self._lock:
+            if not self.ready:
+                return
+            changed = False
+            for row in rows:
+                encoded = self._encode(row)
+                stock_id, stamp = row[0], row[self._stamp_index]
+                if self._entries.get(stock_id) == (stamp, encoded):
+                    continue
+                self._discard(stock_id)
+                if encoded is not None:
+                    self._entries[stock_id] = (stamp, encoded)
+                    bisect.insort(self._keys, (stamp, stock_id))
+                    self._bytes += len(encoded)
+                changed = True
+            if changed:
+                self.revision += 1
+            if self._bytes > self.max_bytes:
+                self._overflow()
+
+    def remove(self, stock_ids):
+        with self._lock:
+            if not self.ready:
+                return
+            if sum(self._discard(stock_id) for stock_id in stock_ids):
+                self.revision += 1
+
+    def caught_up(self, change_id):
+        with self._lock:
+            self.change_id = max(self.change_id, change_id)
+
+    def invalidate(self, reason, enable=False):
+        """Drops the contents; the next catch-up reloads them. enable=True also lifts an overflow shutdown."""
+        with self._lock:
+            self._clear()
+            self.invalidations += 1
+            if enable:
+                self.enabled = True
+        logger.warning(f"Stock replica invalidated: {reason}")
+
+    def chunks_since(self, wire_format, stamp, chunk_size):
+        """Returns an iterator over the stream body for rows with Stamp > stamp, or None on a miss.
+
+        Only references to the cached rows are taken under the lock; each chunk is joined as the
+        response is sent, so a full sync holds one chunk at a time rather than a copy of the table.
+        """
+        with self._lock:
+            if not self.ready or wire_format is not self.wire_format or stamp is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            # (stamp, +inf) sorts after every key with exactly this Stamp, matching "Stamp > stamp"
+            start = bisect.bisect_right(self._keys, (stamp, float('inf')))
+            encoded = [self._entries[stock_id][1] for _, stock_id in self._keys[start:]]
+        return self._chunks(wire_format, encoded, chunk_size)
+
+    @staticmethod
+    def _chunks(wire_format, encoded, chunk_size):
+        separator = wire_format.separator
+        chunk = [wire_format.stream_prefix()]
+        size = len(chunk[0])
+        for index, row in enumerate(encoded):
+            if index:
+                chunk.append(separator)
+                size += len(separator)
+            chunk.append(row)
+            size += len(row)
+            if size >= chunk_size:
+                yield b''.join(chunk)
+                chunk = []
+                size = 0
+        chunk.append(wire_format.stream_suffix())
+        yield b''.join(chunk)
+
+    def version(self):
+        """Same shape as db_server's MySQL version tuple: (version, max Stamp, change id)."""
+        with self._lock:
+            max_stamp = self._keys[-1][0] if self._keys else None
+            return f"replica-{self._instance}-{self.revision}", max_stamp, self.change_id
+
+    @property
+    def max_stamp(self):
+        with self._lock:
+            return self._keys[-1][0] if self._keys else None
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'ready': self.ready,
+                'rows': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'change_id': self.change_id,
+                'revision': self.revision,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 3) if lookups else 0.0,
+                'loads': self.loads,
+                'invalidations': self.invalidations,
+            }
+
+    def _encode(self, row):
+        if row[self._stamp_index] is None:
+            return None
+        return self._encode_row(row)
+
+    def _discard(self, stock_id):
+        entry = self._entries.pop(stock_id, None)
+        if entry is None:
+            return False
+        stamp, encoded = entry
+        del self._keys[bisect.bisect_left(self._keys, (stamp, stock_id))]
+        self._bytes -= len(encoded)
+        return True
+
+    def _clear(self):
+        self._keys = []
+        self._entries = {}
+        self._bytes = 0
+        self.ready = False
+        self.revision += 1
+
+    def _overflow(self):
+        # Switched off rather than reloaded, since the table would only overflow again
+        self._clear()
+        self.enabled = False
+        logger.error(f"Stock replica exceeded {self.max_bytes} bytes and has been disabled; "
+                     f"raise the limit and invalidate it to turn it back on")
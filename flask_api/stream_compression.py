@@ -0,0 +1,139 @@
+import logging
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+
+class GzipCompressor:
+    def __init__(self, level):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits 31 = gzip container
+
+    def compress(self, data):
+        # Sync flush so every chunk reaches the client right away instead of waiting for zlib's window to fill
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+class ZstdCompressor:
+    def __init__(self, level):
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self._compressor.compress(data) + self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class BrotliCompressor:
+    def __init__(self, level):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+def available_encodings():
+    """Content codings this process can produce, in server preference order."""
+    encodings = []
+    if zstandard is not None:
+        encodings.append('zstd')
+    if brotli is not None:
+        encodings.append('br')
+    encodings.append('gzip')
+    return encodings
+
+
+def new_compressor(encoding, levels):
+    if encoding == 'zstd':
+        return ZstdCompressor(levels['zstd'])
+    if encoding == 'br':
+        return BrotliCompressor(levels['br'])
+    if encoding == 'gzip':
+        return GzipCompressor(levels['gzip'])
+    raise ValueError(f"Unsupported content encoding: {encoding}")
+
+
+class MeteredCompressor:
+    """Compresses one response chunk by chunk and logs the ratio and CPU cost when finished."""
+
+    def __init__(self, encoding, levels):
+        self.encoding = encoding
+        self._compressor = new_compressor(encoding, levels)
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.cpu_seconds = 0.0
+
+    def compress(self, chunk):
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        start = time.thread_time()
+        data = self._compressor.compress(chunk)
+        self.cpu_seconds += time.thread_time() - start
+        self.raw_bytes += len(chunk)
+        self.compressed_bytes += len(data)
+        return data
+
+    def finish(self):
+        start = time.thread_time()
+        data = self._compressor.finish()
+        self.cpu_seconds += time.thread_time() - start
+        self.compressed_bytes += len(data)
+
+        megabytes = self.raw_bytes / (1024 * 1024)
+        logger.info(
+            f"{self.encoding}: {self.raw_bytes} -> {self.compressed_bytes} bytes "
+            f"({self.compressed_bytes / self.raw_bytes * 100 if self.raw_bytes else 0:.1f}%), "
+            f"{self.cpu_seconds * 1000 / megabytes if megabytes else 0:.1f} ms CPU/MB"
+        )
+        return data
+
+
+def compress_chunks(chunks, encoding, levels):
+    """Compresses an iterable of response chunks incrementally, one chunk in, at most one chunk out.
+
+    Closing the returned generator closes the wrapped iterable too, so cleanup in a streaming
+    generator (e.g. releasing its DB cursor) still runs when the client disconnects.
+    """
+    compressor = MeteredCompressor(encoding, levels)
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.finish()
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+async def compress_chunks_async(chunks, encoding, levels):
+    """compress_chunks() for an async iterable of chunks, as served by db_async_server."""
+    compressor = MeteredCompressor(encoding, levels)
+    try:
+        async for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.finish()
+    finally:
+        aclose = getattr(chunks, 'aclose', None)
+        if aclose is not None:
+            await aclose()
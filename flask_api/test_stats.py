@@ -0,0 +1,100 @@
+import os
+import tempfile
+import unittest
+from datetime import date, datetime
+from decimal import Decimal
+
+# db_server sets up its photo store at import; keep it out of the real one
+os.environ.setdefault('RRHE_PHOTO_STORE_DIR', tempfile.mkdtemp())
+
+import db_server  # noqa: E402
+from db_server import STATS_COUNT_METRICS, STATS_METRICS, flatten_stats, stats_buckets  # noqa: E402
+
+
+class FakeCursor:
+    def __init__(self, results):
+        self._results = list(results)
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=()):
+        self._rows = self._results.pop(0)
+
+    def fetchall(self):
+        return self._rows
+
+
+class FakeConnection:
+    def __init__(self, results):
+        self._results = results
+
+    def cursor(self):
+        return FakeCursor(self._results)
+
+    def close(self):
+        pass
+
+
+def grouped_row(bucket_start, samples, first_stamp, last_stamp, averages):
+    """A row of stats_bucket_queries' grouped query, with min/max set around each average."""
+    row = [bucket_start, samples, first_stamp, last_stamp]
+    for metric in STATS_METRICS:
+        average = averages[metric]
+        row += [average, int(average), int(average) + 1]
+    return tuple(row)
+
+
+class FlattenStatsTest(unittest.TestCase):
+    first = datetime(2024, 3, 4, 8, 0)
+    last = datetime(2024, 3, 4, 20, 0)
+
+    def buckets(self):
+        # AVG() comes back from MySQL as Decimal; a two-sample mean of counts is often x.5
+        averages = {metric: Decimal('1234.5') for metric in STATS_METRICS}
+        averages['TotalValue'] = Decimal('98765.25')
+        grouped = [grouped_row(date(2024, 3, 4), 2, self.first, self.last, averages)]
+        last_rows = [(self.last,) + tuple(1235 if metric in STATS_COUNT_METRICS else 99000.5
+                                          for metric in STATS_METRICS)]
+        return stats_buckets(grouped, last_rows)
+
+    def test_avg_of_counts_is_a_whole_number(self):
+        row, = flatten_stats(self.buckets(), 'avg')
+        for metric in STATS_COUNT_METRICS:
+            self.assertIsInstance(row[metric], int, metric)
+            self.assertEqual(row[metric], 1235, metric)
+
+    def test_avg_of_amounts_stays_fractional(self):
+        row, = flatten_stats(self.buckets(), 'avg')
+        self.assertEqual(row['TotalValue'], 98765.25)
+        self.assertEqual(row['USD'], 1234.5)
+        self.assertEqual(row['Stamp'], self.last)
+
+    def test_nested_buckets_keep_the_exact_mean(self):
+        bucket, = self.buckets()
+        self.assertEqual(bucket['TotalRows']['avg'], 1234.5)
+
+    def test_stats_endpoint_with_agg_avg(self):
+        averages = {metric: Decimal('10.5') for metric in STATS_METRICS}
+        grouped = [grouped_row(date(2024, 3, 4), 2, self.first, self.last, averages)]
+        last_rows = [(self.last,) + (11,) * len(STATS_METRICS)]
+        original = db_server.get_db_connection, db_server.get_stats_version
+        db_server.get_db_connection = lambda: FakeConnection([grouped, last_rows])
+        db_server.get_stats_version = lambda: (self.last,)
+        try:
+            response = db_server.app.test_client().get('/stats?bucket=day&agg=avg')
+        finally:
+            db_server.get_db_connection, db_server.get_stats_version = original
+        self.assertEqual(response.status_code, 200)
+        row, = response.get_json()
+        self.assertEqual(row['TotalRows'], 11)
+        self.assertEqual(row['WebQty'], 11)
+        self.assertEqual(row['EUR'], 10.5)
+
+
+if __name__ == '__main__':
+    unittest.main()